@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#+
+# Measures the per-call cost of going through ctypes to a C function,
+# with and without a declared prototype, and through the LazyLibrary
+# proxy that mtpy uses for libmtp. Invoke from the directory containing
+# mtpy.py as follows:
+#
+#     python3 benchmarks/call_overhead.py [--calls=n]
+#
+# The libc section always runs; the libmtp section is skipped if libmtp
+# cannot be loaded. Only calls that do not talk to a device are timed.
+#-
+
+import sys
+import os
+import timeit
+import ctypes as ct
+import getopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mtpy
+
+def report(label, func, calls) :
+    elapsed = min(timeit.repeat(func, number = calls, repeat = 5))
+    sys.stdout.write("%-44s %7.1fns/call\n" % (label, elapsed / calls * 1e9))
+#end report
+
+calls = 200000
+opts, args = getopt.getopt(sys.argv[1:], "", ["calls="])
+for keyword, value in opts :
+    if keyword == "--calls" :
+        calls = int(value)
+    #end if
+#end for
+
+bare_libc = ct.CDLL("libc.so.6")
+labs = bare_libc.labs
+def setup_libc(lib) :
+    lib.labs.restype = ct.c_long
+    lib.labs.argtypes = [ct.c_long]
+#end setup_libc
+proto_libc = ct.CDLL("libc.so.6")
+setup_libc(proto_libc)
+proto_labs = proto_libc.labs
+lazy_libc = mtpy.LazyLibrary("libc.so.6", setup_libc)
+
+report("libc labs, no prototype", lambda : labs(-5), calls)
+report("libc labs, prototyped", lambda : proto_labs(-5), calls)
+report("libc labs, prototyped, lookup each call", lambda : proto_libc.labs(-5), calls)
+report("libc labs, via LazyLibrary, lookup each call", lambda : lazy_libc.labs(-5), calls)
+
+try :
+    bare_mtp = ct.CDLL("libmtp.so.9")
+except OSError :
+    sys.stdout.write("(libmtp not available, skipping libmtp calls)\n")
+    bare_mtp = None
+#end try
+if bare_mtp != None :
+    bare_mtp.LIBMTP_Get_Property_Description.restype = ct.c_char_p
+    report \
+      (
+        "Get_Property_Description, restype only",
+        lambda : bare_mtp.LIBMTP_Get_Property_Description(mtpy.PROPERTY_Name),
+        calls
+      )
+    report \
+      (
+        "Get_Property_Description, mtpy prototype",
+        lambda : mtpy.mtp.LIBMTP_Get_Property_Description(mtpy.PROPERTY_Name),
+        calls
+      )
+    report \
+      (
+        "Get_Filetype_Description, mtpy prototype",
+        lambda : mtpy.mtp.LIBMTP_Get_Filetype_Description(mtpy.FILETYPE_MP3),
+        calls
+      )
+#end if
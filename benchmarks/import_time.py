@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+#+
+# Measures how long "import mtpy" takes in a fresh interpreter, compared
+# with a bare interpreter startup, and how long the first libmtp call
+# (which now triggers loading and initialization of the library) takes.
+# Invoke from the directory containing mtpy.py as follows:
+#
+#     python3 benchmarks/import_time.py [--runs=n]
+#
+# The first-call figure is only reported if libmtp can be loaded.
+#-
+
+import sys
+import os
+import subprocess
+import statistics
+import time
+import getopt
+
+def time_command(cmd, runs) :
+    # returns a list of wall-clock times in seconds for running the specified
+    # Python code in a fresh interpreter.
+    env = dict(os.environ)
+    path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    if "PYTHONPATH" in env :
+        path.append(env["PYTHONPATH"])
+    #end if
+    env["PYTHONPATH"] = os.pathsep.join(path)
+    result = []
+    for i in range(runs) :
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", cmd], env = env, stderr = subprocess.DEVNULL, check = True)
+        result.append(time.perf_counter() - start)
+    #end for
+    return result
+#end time_command
+
+def report(label, times) :
+    sys.stdout.write \
+      (
+            "%-24s min %7.2fms  median %7.2fms\n"
+        %
+            (label, min(times) * 1000, statistics.median(times) * 1000)
+      )
+#end report
+
+runs = 20
+opts, args = getopt.getopt(sys.argv[1:], "", ["runs="])
+for keyword, value in opts :
+    if keyword == "--runs" :
+        runs = int(value)
+    #end if
+#end for
+
+baseline = time_command("pass", runs)
+report("interpreter startup", baseline)
+report("import mtpy", time_command("import mtpy", runs))
+try :
+    first_call = time_command("import mtpy; mtpy.mtp.LIBMTP_Get_Property_Description", runs)
+except subprocess.CalledProcessError :
+    sys.stdout.write("import mtpy + load libmtp  (libmtp not available)\n")
+else :
+    report("import mtpy + load libmtp", first_call)
+#end try
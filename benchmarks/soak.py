@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+#+
+# Soak test for native memory use: repeatedly discards and reloads the
+# Device caches, and fetches device information, as a long-running
+# daemon would after each change to device contents, reporting the
+# resident set size of the process as it goes. If mtpy is disposing of
+# everything libmtp hands it, the RSS should level off after the first
+# few rounds. Invoke from the directory containing mtpy.py as follows:
+#
+#     python3 benchmarks/soak.py [--rounds=n] [--objects=n] [--every=n]
+#         [--device=n]
+#
+# By default this uses a simulated device (see mtpysim) holding the
+# specified number of objects (default 2000); use --device=n to run
+# against the real device with index n in get_raw_devices() instead.
+# The RSS is reported every --every rounds; the exit status is nonzero
+# if it grew by more than 10% over the second half of the run.
+#-
+
+import sys
+import os
+import gc
+import getopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mtpy
+import mtpysim
+
+def get_rss() :
+    # returns the current resident set size of this process, in kiB.
+    with open("/proc/self/statm") as statm :
+        pages = int(statm.read().split()[1])
+    #end with
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+#end get_rss
+
+def soak_round(device) :
+    device.set_contents_changed()
+    device.get_children()
+    device.get_tracks()
+    device.get_playlists()
+    device.get_albums()
+    device.refresh_storage(max_age = 0)
+    device.get_manufacturer_name()
+    device.get_model_name()
+    device.get_serial_number()
+    device.get_friendly_name()
+    device._clear_capabilities()
+    device.get_supported_filetypes()
+#end soak_round
+
+nr_rounds = 2000
+nr_objects = 2000
+every = 100
+device_index = None
+opts, args = getopt.getopt(sys.argv[1:], "", ["device=", "every=", "objects=", "rounds="])
+for keyword, value in opts :
+    if keyword == "--device" :
+        device_index = int(value)
+    elif keyword == "--every" :
+        every = int(value)
+    elif keyword == "--objects" :
+        nr_objects = int(value)
+    elif keyword == "--rounds" :
+        nr_rounds = int(value)
+    #end if
+#end for
+
+if device_index != None :
+    device = mtpy.get_raw_devices()[device_index].open()
+else :
+    sim = mtpysim.SimulatedLibrary()
+    simdev = sim.add_device()
+    nr_tracks = nr_objects // 10
+    simdev.populate \
+      (
+        nr_files = nr_objects - nr_tracks,
+        nr_folders = max(nr_objects // 100, 1),
+        nr_tracks = nr_tracks,
+        nr_albums = max(nr_tracks // 10, 1),
+        nr_playlists = 5
+      )
+    device = mtpy.get_raw_devices(sim)[0].open()
+#end if
+samples = []
+for i in range(1, nr_rounds + 1) :
+    soak_round(device)
+    if i % every == 0 :
+        gc.collect()
+        rss = get_rss()
+        samples.append(rss)
+        sys.stdout.write("round %6d: RSS %8d kiB\n" % (i, rss))
+        sys.stdout.flush()
+    #end if
+#end for
+device.close()
+if len(samples) >= 2 :
+    midway = samples[(len(samples) - 1) // 2]
+    growth = (samples[-1] - midway) / midway
+    sys.stdout.write("RSS growth over second half: %.1f%%\n" % (growth * 100))
+    sys.exit((0, 1)[growth > 0.1])
+#end if
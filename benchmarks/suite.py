@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+#+
+# Benchmarks for the main enumeration, lookup and transfer paths in
+# mtpy, reporting results as JSON so they can be compared across
+# versions. Invoke from the directory containing mtpy.py as follows:
+#
+#     python3 benchmarks/suite.py [--sizes=n,n...] [--file-size=bytes]
+#         [--latency=secs] [--object-latency=secs] [--bandwidth=bytes-per-sec]
+#         [--lookups=n] [--uploads=n] [--output=file]
+#
+# to run against simulated devices (see mtpysim) holding each of the
+# specified numbers of objects (default 1000, 10000 and 100000), or
+#
+#     python3 benchmarks/suite.py --device=n [--folder=path] [...]
+#
+# to run against the real device with index n in get_raw_devices(), in
+# which case the number of objects is whatever is on the device. The
+# retrieval benchmark is done on the device folder given by --folder
+# (skipped if not specified). Uploads go into a temporary folder at the
+# root level of the device, which is deleted afterwards.
+#
+# Measured for each device:
+#     open_s -- time to open the device
+#     first_get_children_s -- time for the first get_children() call,
+#         which enumerates the whole device
+#     path_lookup_cold_s -- time for get_descendant_by_path on a freshly
+#         opened device
+#     path_lookup_warm_us -- mean time for get_descendant_by_path once
+#         the cache is populated
+#     retrieve_bytes_per_s, retrieve_files_per_s -- for retrieve_to_folder
+#     upload_bytes_per_s, upload_files_per_s -- for Folder.send_file
+#     cached_bytes_per_object -- Python memory held by the device cache
+#         per object, as measured by tracemalloc
+#-
+
+import sys
+import os
+import gc
+import time
+import json
+import random
+import shutil
+import tempfile
+import tracemalloc
+import platform
+import getopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mtpy
+import mtpysim
+
+def note(msg) :
+    sys.stderr.write(msg + "\n")
+#end note
+
+def timed(func, *args) :
+    # returns a tuple (elapsed seconds, result) for calling func(*args).
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+#end timed
+
+def all_file_paths(device) :
+    result = []
+    for item in device.get_descendants() :
+        if isinstance(item, mtpy.File) :
+            result.append(item.fullpath())
+        #end if
+    #end for
+    return result
+#end all_file_paths
+
+def tree_files(folder) :
+    # generates all the File objects within folder, recursing into subfolders.
+    for item in folder.get_children() :
+        if isinstance(item, mtpy.Folder) :
+            yield from tree_files(item)
+        else :
+            yield item
+        #end if
+    #end for
+#end tree_files
+
+def run_benchmarks(open_device, retrieve_folder, file_size, nr_lookups, nr_uploads) :
+    # runs all the benchmarks against the device returned by calling open_device,
+    # which is opened afresh where a cold cache is needed. Returns a dict of results.
+    result = {}
+    elapsed, device = timed(open_device)
+    result["open_s"] = elapsed
+    elapsed, children = timed(device.get_children)
+    result["first_get_children_s"] = elapsed
+    result["nr_objects"] = len(device.get_descendants())
+    paths = all_file_paths(device)
+    device.close()
+    if len(paths) != 0 :
+        samples = random.Random(0).choices(paths, k = nr_lookups)
+        device = open_device()
+        elapsed, item = timed(device.get_descendant_by_path, samples[0])
+        assert item != None
+        result["path_lookup_cold_s"] = elapsed
+        for path in samples :
+            device.get_descendant_by_path(path) # make sure every folder's children are cached
+        #end for
+        start = time.perf_counter()
+        for path in samples :
+            device.get_descendant_by_path(path)
+        #end for
+        result["path_lookup_warm_us"] = (time.perf_counter() - start) / len(samples) * 1e6
+        device.close()
+    #end if
+    workdir = tempfile.mkdtemp(prefix = "mtpy-bench-")
+    try :
+        if retrieve_folder != None :
+            note("  retrieving %s" % retrieve_folder)
+            device = open_device()
+            folder = device.get_descendant_by_path(retrieve_folder)
+            if folder == None :
+                raise RuntimeError("no folder “%s” on device" % retrieve_folder)
+            #end if
+            files = list(tree_files(folder))
+            nr_bytes = sum(f.filesize for f in files)
+            elapsed, _ = timed(folder.retrieve_to_folder, os.path.join(workdir, "retrieved"))
+            result["retrieve_files"] = len(files)
+            result["retrieve_bytes_per_s"] = nr_bytes / elapsed
+            result["retrieve_files_per_s"] = len(files) / elapsed
+            device.close()
+            shutil.rmtree(os.path.join(workdir, "retrieved"))
+        #end if
+        if nr_uploads != 0 :
+            note("  uploading %d files" % nr_uploads)
+            src = os.path.join(workdir, "upload.bin")
+            with open(src, "wb") as outfile :
+                outfile.write(os.urandom(file_size))
+            #end with
+            device = open_device()
+            folder = device.create_folder("mtpy-benchmark-%d" % os.getpid())
+            try :
+                start = time.perf_counter()
+                for i in range(nr_uploads) :
+                    folder.send_file(src, "upload%06d.bin" % i)
+                #end for
+                elapsed = time.perf_counter() - start
+            finally :
+                folder.delete(delete_descendants = True)
+                device.close()
+            #end try
+            result["upload_files"] = nr_uploads
+            result["upload_bytes_per_s"] = nr_uploads * file_size / elapsed
+            result["upload_files_per_s"] = nr_uploads / elapsed
+        #end if
+    finally :
+        shutil.rmtree(workdir)
+    #end try
+    device = open_device()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nr_objects = len(device.get_descendants())
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    device.close()
+    if nr_objects != 0 :
+        result["cached_bytes_per_object"] = (after - before) / nr_objects
+    #end if
+    return result
+#end run_benchmarks
+
+sizes = [1000, 10000, 100000]
+file_size = 4096
+latency = 0
+object_latency = 0
+bandwidth = None
+nr_lookups = 1000
+nr_uploads = 100
+device_index = None
+retrieve_folder = None
+output = None
+opts, args = getopt.getopt \
+  (
+    sys.argv[1:],
+    "",
+    [
+        "bandwidth=", "device=", "file-size=", "folder=", "latency=", "lookups=",
+        "object-latency=", "output=", "sizes=", "uploads=",
+    ]
+  )
+for keyword, value in opts :
+    if keyword == "--bandwidth" :
+        bandwidth = float(value)
+    elif keyword == "--device" :
+        device_index = int(value)
+    elif keyword == "--file-size" :
+        file_size = int(value)
+    elif keyword == "--folder" :
+        retrieve_folder = value
+    elif keyword == "--latency" :
+        latency = float(value)
+    elif keyword == "--lookups" :
+        nr_lookups = int(value)
+    elif keyword == "--object-latency" :
+        object_latency = float(value)
+    elif keyword == "--output" :
+        output = value
+    elif keyword == "--sizes" :
+        sizes = list(int(s) for s in value.split(","))
+    elif keyword == "--uploads" :
+        nr_uploads = int(value)
+    #end if
+#end for
+
+report = \
+    {
+        "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "parameters" :
+            {
+                "file_size" : file_size,
+                "lookups" : nr_lookups,
+                "uploads" : nr_uploads,
+            },
+        "runs" : [],
+    }
+if device_index != None :
+    rawdev = mtpy.get_raw_devices()[device_index]
+    note("benchmarking %s" % rawdev)
+    run = {"device" : "%s %s" % (rawdev.vendor, rawdev.product)}
+    run.update(run_benchmarks(rawdev.open, retrieve_folder, file_size, nr_lookups, nr_uploads))
+    report["runs"].append(run)
+else :
+    report["parameters"].update \
+      (
+        {
+            "latency" : latency,
+            "object_latency" : object_latency,
+            "bandwidth" : bandwidth,
+        }
+      )
+    for size in sizes :
+        note("benchmarking simulated device with %d objects" % size)
+        sim = mtpysim.SimulatedLibrary()
+        simdev = sim.add_device(latency = latency, object_latency = object_latency, bandwidth = bandwidth)
+        nr_folders = max(size // 1000, 1)
+        simdev.populate(nr_files = size - nr_folders, nr_folders = nr_folders, file_size = file_size)
+        rawdev = mtpy.get_raw_devices(sim)[0]
+        run = {"device" : "mtpysim", "size" : size}
+        run.update(run_benchmarks(rawdev.open, "/folder000000", file_size, nr_lookups, nr_uploads))
+        run["calls"] = dict(sim.calls)
+        report["runs"].append(run)
+    #end for
+#end if
+if output != None :
+    outfile = open(output, "w")
+else :
+    outfile = sys.stdout
+#end if
+json.dump(report, outfile, indent = 4, sort_keys = True)
+outfile.write("\n")
+if output != None :
+    outfile.close()
+#end if
@@ -25,32 +25,57 @@
 import ctypes as ct
 import os
 import errno
+import pickle
+import bisect
+import time
+import queue
+import select
+import socket
+import threading
+import concurrent.futures
+  # asyncio, multiprocessing, json, tarfile and zipfile are only imported
+  # as needed, since they take a while to load and are only used by
+  # particular features
+
+class LazyLibrary :
+    """stands in for a ctypes library object, deferring the loading of the
+    library until one of its functions is first needed. At that point, setup
+    is called with the loaded library, to initialize it and set up function
+    prototypes. Each function looked up is remembered as an instance attribute,
+    so subsequent references cost no more than for the library itself."""
+
+    def __init__(self, name, setup) :
+        self._name = name
+        self._setup = setup
+        self._lib = None
+        self._lock = threading.Lock()
+    #end __init__
+
+    def _load(self) :
+        with self._lock :
+            if self._lib == None :
+                lib = ct.cdll.LoadLibrary(self._name)
+                self._setup(lib)
+                self._lib = lib
+            #end if
+        #end with
+        return self._lib
+    #end _load
+
+    def __getattr__(self, attr) :
+        # only called for attributes not yet remembered
+        if attr.startswith("__") :
+            raise AttributeError(attr)
+        #end if
+        result = getattr(self._load(), attr)
+        setattr(self, attr, result)
+        return result
+    #end __getattr__
+
+#end LazyLibrary
 
-mtp = ct.cdll.LoadLibrary("libmtp.so.9")
-mtp.LIBMTP_Init()
-mtp.LIBMTP_Release_Device.restype = None
-mtp.LIBMTP_Clear_Errorstack.restype = None
-mtp.LIBMTP_Dump_Errorstack.restype = None
-mtp.LIBMTP_Get_Manufacturername.restype = ct.c_char_p
-mtp.LIBMTP_Get_Modelname.restype = ct.c_char_p
-mtp.LIBMTP_Get_Serialnumber.restype = ct.c_char_p
-mtp.LIBMTP_Get_Deviceversion.restype = ct.c_char_p
-mtp.LIBMTP_Get_Friendlyname.restype = ct.c_char_p
-mtp.LIBMTP_Get_Syncpartner.restype = ct.c_char_p
-mtp.LIBMTP_Get_Filetype_Description.restype = ct.c_char_p
-mtp.LIBMTP_destroy_file_t.restype = None
-mtp.LIBMTP_destroy_folder_t.restype = None
-mtp.LIBMTP_Get_String_From_Object.restype = ct.c_void_p # c_char_p
-mtp.LIBMTP_Get_u64_From_Object.restype = ct.c_uint64
-mtp.LIBMTP_Get_u32_From_Object.restype = ct.c_uint32
-mtp.LIBMTP_Get_u16_From_Object.restype = ct.c_uint16
-mtp.LIBMTP_Get_u8_From_Object.restype = ct.c_uint8
-mtp.LIBMTP_Get_Property_Description.restype = ct.c_char_p # I don't need to dispose of result
-mtp.LIBMTP_destroy_allowed_values_t.restype = None
-mtp.LIBMTP_Create_Folder.restype = ct.c_uint32
-mtp.LIBMTP_destroy_track_t.restype = None
-mtp.LIBMTP_destroy_playlist_t.restype = None
-mtp.LIBMTP_destroy_album_t.restype = None
+mtp = LazyLibrary("libmtp.so.9", lambda lib : common_setup_libmtp(lib))
+  # nothing is loaded until first needed
 libc = ct.cdll.LoadLibrary("libc.so.6")
 libc.malloc.restype = ct.c_void_p
 libc.free.argtypes = [ct.c_void_p]
@@ -88,21 +113,22 @@ class Error(RuntimeError) :
             8 : "CANCELLED",
         }
 
-    def __init__(self, code) :
-        RuntimeError.__init__(self, "libmtp error %d -- %s" % (code, self.name.get(code, "?")))
+    def __init__(self, code, messages = None) :
+        msg = "libmtp error %d -- %s" % (code, self.name.get(code, "?"))
+        if messages :
+            msg += ": " + "; ".join(messages)
+        #end if
+        RuntimeError.__init__(self, msg)
+        self.code = code
+        self.messages = messages # from device error stack, if available
     #end __init__
 
-#end Error
+    def __reduce__(self) :
+        # so it can be passed between processes
+        return (type(self), (self.code, self.messages))
+    #end __reduce__
 
-def check_status(status, device = None) :
-    if status != ERROR_NONE :
-        if device != None :
-            mtp.LIBMTP_Dump_Errorstack(device)
-            mtp.LIBMTP_Clear_Errorstack(device)
-        #end if
-        raise Error(status)
-    #end if
-#end check_status
+#end Error
 
 class error_t(ct.Structure) :
     pass
@@ -114,6 +140,58 @@ error_t._fields_ = \
         ("next", ct.POINTER(error_t)),
     ]
 
+def get_errorstack(device, lib = None) :
+    """returns the contents of the error stack for the specified libmtp device
+    handle, as a list of (errornumber, error_text) tuples, oldest first. lib is
+    the backend the handle came from, defaulting to libmtp."""
+    if lib == None :
+        lib = mtp
+    #end if
+    result = []
+    entry = lib.LIBMTP_Get_Errorstack(device)
+    while bool(entry) :
+        entry = entry.contents
+        text = entry.error_text
+        if text != None :
+            text = text.decode("utf-8", "replace")
+        #end if
+        result.append((entry.errornumber, text))
+        entry = entry.next
+    #end while
+    return result
+#end get_errorstack
+
+def check_status(status, device = None, lib = None) :
+    if status != ERROR_NONE :
+        messages = None
+        if device != None :
+            if lib == None :
+                lib = mtp
+            #end if
+            errorstack = get_errorstack(device, lib)
+            messages = list(text for code, text in errorstack if text != None)
+            if status not in Error.name :
+                # many libmtp calls just return -1 on failure, so get the
+                # actual error from the stack, preferring the most specific
+                status = ERROR_GENERAL
+                for code, text in errorstack :
+                    if code not in (ERROR_NONE, ERROR_GENERAL) :
+                        status = code
+                        break
+                    #end if
+                #end for
+            #end if
+            lib.LIBMTP_Dump_Errorstack(device)
+            lib.LIBMTP_Clear_Errorstack(device)
+            metrics = device_metrics.get(ct.addressof(device.contents))
+            if metrics != None :
+                metrics.add_error(status)
+            #end if
+        #end if
+        raise Error(status, messages)
+    #end if
+#end check_status
+
 # The filetypes defined here are the external types used
 # by the libmtp library interface. The types used internally
 # as PTP-defined enumerator types is something different.
@@ -443,6 +521,42 @@ PROPERTY_BuyFlag = 166
 PROPERTY_UNKNOWN = 167
 property_t = ct.c_uint
 
+property_bitsize = \
+    { # value sizes of commonly-used properties, None for string-valued ones
+        PROPERTY_StorageID : 32,
+        PROPERTY_ObjectFormat : 16,
+        PROPERTY_ProtectionStatus : 16,
+        PROPERTY_ObjectSize : 64,
+        PROPERTY_ObjectFileName : None,
+        PROPERTY_DateCreated : None,
+        PROPERTY_DateModified : None,
+        PROPERTY_Keywords : None,
+        PROPERTY_ParentObject : 32,
+        PROPERTY_Hidden : 16,
+        PROPERTY_Name : None,
+        PROPERTY_Artist : None,
+        PROPERTY_DateAuthored : None,
+        PROPERTY_Description : None,
+        PROPERTY_DateAdded : None,
+        PROPERTY_Width : 32,
+        PROPERTY_Height : 32,
+        PROPERTY_Duration : 32,
+        PROPERTY_Rating : 16,
+        PROPERTY_Track : 16,
+        PROPERTY_Genre : None,
+        PROPERTY_UseCount : 32,
+        PROPERTY_SkipCount : 32,
+        PROPERTY_Composer : None,
+        PROPERTY_OriginalReleaseDate : None,
+        PROPERTY_AlbumName : None,
+        PROPERTY_AlbumArtist : None,
+        PROPERTY_BitRateType : 16,
+        PROPERTY_SampleRate : 32,
+        PROPERTY_NumberOfChannels : 16,
+        PROPERTY_AudioWAVECodec : 32,
+        PROPERTY_AudioBitRate : 32,
+    }
+
 # These are the data types
 DATATYPE_INT8 = 0
 DATATYPE_UINT8 = 1
@@ -497,6 +611,10 @@ devicestorage_t._fields_ = \
         ("prev", ct.POINTER(devicestorage_t)),
     ]
 
+FILES_AND_FOLDERS_ROOT = 0xffffffff
+  # parent ID to pass to LIBMTP_Get_Files_And_Folders to list only the root level;
+  # 0 lists all objects at all levels.
+
 STORAGE_SORTBY_NOTSORTED = 0
 STORAGE_SORTBY_FREESPACE = 1
 STORAGE_SORTBY_MAXSPACE =  2
@@ -569,13 +687,6 @@ folder_t._fields_ = \
         ("child", ct.POINTER(folder_t)), # Child folder or NULL if no children
     ]
 
-mtp.LIBMTP_Open_Raw_Device.restype = ct.POINTER(mtpdevice_t)
-mtp.LIBMTP_Open_Raw_Device_Uncached.restype = ct.POINTER(mtpdevice_t)
-mtp.LIBMTP_Get_Files_And_Folders.restype = ct.POINTER(file_t)
-mtp.LIBMTP_Get_Filelisting.restype = ct.POINTER(file_t)
-mtp.LIBMTP_Get_Folder_List.restype = ct.POINTER(folder_t)
-mtp.LIBMTP_new_file_t.restype = ct.POINTER(file_t)
-mtp.LIBMTP_new_folder_t.restype = ct.POINTER(folder_t)
 
 class track_t(ct.Structure) :
     pass
@@ -638,15 +749,6 @@ album_t._fields_ = \
         ("next", ct.POINTER(album_t)), # Next album or NULL if last album
     ]
 
-mtp.LIBMTP_new_track_t.restype = ct.POINTER(track_t)
-mtp.LIBMTP_Get_Tracklisting_With_Callback.restype = ct.POINTER(track_t)
-mtp.LIBMTP_Get_Trackmetadata.restype = ct.POINTER(track_t)
-mtp.LIBMTP_new_playlist_t.restype = ct.POINTER(playlist_t)
-mtp.LIBMTP_Get_Playlist_List.restype = ct.POINTER(playlist_t)
-mtp.LIBMTP_Get_Playlist.restype = ct.POINTER(playlist_t)
-mtp.LIBMTP_new_album_t.restype = ct.POINTER(album_t)
-mtp.LIBMTP_Get_Album_List.restype = ct.POINTER(album_t)
-mtp.LIBMTP_Get_Album.restype = ct.POINTER(album_t)
 
 class allowed_values_t(ct.Structure) :
     # A data structure to hold allowed ranges of values
@@ -711,6 +813,110 @@ class allowed_values_t(ct.Structure) :
     del datatype, bitsize, signed
 #end allowed_values_t
 
+progressfunc_t = ct.CFUNCTYPE(ct.c_int, ct.c_uint64, ct.c_uint64, ct.c_void_p)
+  # args are bytes sent so far, total bytes, user data; return nonzero to cancel
+
+HANDLER_RETURN_OK = 0
+HANDLER_RETURN_ERROR = 1
+HANDLER_RETURN_CANCEL = 2
+dataputfunc_t = ct.CFUNCTYPE(ct.c_uint16, ct.c_void_p, ct.c_void_p, ct.c_uint32, ct.POINTER(ct.c_ubyte), ct.POINTER(ct.c_uint32))
+  # args are params, priv, sendlen, data, putlen; return one of HANDLER_RETURN_xxx
+
+device_p = ct.POINTER(mtpdevice_t)
+uint8_p = ct.POINTER(ct.c_uint8)
+libmtp_prototypes = \
+    ( # (name, restype, argtypes) for all the libmtp functions I use. Any
+      # alternative backend (see mtpysim) must provide these same functions.
+        ("LIBMTP_Init", None, []),
+        ("LIBMTP_Detect_Raw_Devices", ct.c_int, [ct.POINTER(ct.POINTER(raw_device_t)), ct.POINTER(ct.c_int)]),
+        ("LIBMTP_Check_Specific_Device", ct.c_int, [ct.c_int, ct.c_int]),
+        ("LIBMTP_Open_Raw_Device", device_p, [ct.POINTER(raw_device_t)]),
+        ("LIBMTP_Open_Raw_Device_Uncached", device_p, [ct.POINTER(raw_device_t)]),
+        ("LIBMTP_Release_Device", None, [device_p]),
+        ("LIBMTP_Get_Errorstack", ct.POINTER(error_t), [device_p]),
+        ("LIBMTP_Clear_Errorstack", None, [device_p]),
+        ("LIBMTP_Dump_Errorstack", None, [device_p]),
+      # device properties
+        ("LIBMTP_Get_Storage", ct.c_int, [device_p, ct.c_int]),
+        ("LIBMTP_Get_Manufacturername", ct.c_void_p, [device_p]), # c_char_p, caller frees
+        ("LIBMTP_Get_Modelname", ct.c_void_p, [device_p]), # c_char_p, caller frees
+        ("LIBMTP_Get_Serialnumber", ct.c_void_p, [device_p]), # c_char_p, caller frees
+        ("LIBMTP_Get_Deviceversion", ct.c_void_p, [device_p]), # c_char_p, caller frees
+        ("LIBMTP_Get_Friendlyname", ct.c_void_p, [device_p]), # c_char_p, caller frees
+        ("LIBMTP_Set_Friendlyname", ct.c_int, [device_p, ct.c_char_p]),
+        ("LIBMTP_Get_Syncpartner", ct.c_void_p, [device_p]), # c_char_p, caller frees
+        ("LIBMTP_Set_Syncpartner", ct.c_int, [device_p, ct.c_char_p]),
+        ("LIBMTP_Get_Batterylevel", ct.c_int, [device_p, uint8_p, uint8_p]),
+        ("LIBMTP_Get_Secure_Time", ct.c_int, [device_p, ct.POINTER(ct.c_void_p)]), # c_char_p, caller frees
+        ("LIBMTP_Get_Device_Certificate", ct.c_int, [device_p, ct.POINTER(ct.c_void_p)]), # c_char_p, caller frees
+        ("LIBMTP_Get_Supported_Filetypes", ct.c_int, [device_p, ct.POINTER(ct.POINTER(ct.c_uint16)), ct.POINTER(ct.c_uint16)]),
+        ("LIBMTP_Get_Filetype_Description", ct.c_char_p, [filetype_t]),
+      # object properties
+        ("LIBMTP_Get_Property_Description", ct.c_char_p, [property_t]), # I don't need to dispose of result
+        ("LIBMTP_Is_Property_Supported", ct.c_int, [device_p, property_t, filetype_t]),
+        ("LIBMTP_Get_Allowed_Property_Values", ct.c_int, [device_p, property_t, filetype_t, ct.POINTER(allowed_values_t)]),
+        ("LIBMTP_destroy_allowed_values_t", None, [ct.POINTER(allowed_values_t)]),
+        ("LIBMTP_Get_String_From_Object", ct.c_void_p, [device_p, ct.c_uint32, property_t]), # c_char_p
+        ("LIBMTP_Get_u64_From_Object", ct.c_uint64, [device_p, ct.c_uint32, property_t, ct.c_uint64]),
+        ("LIBMTP_Get_u32_From_Object", ct.c_uint32, [device_p, ct.c_uint32, property_t, ct.c_uint32]),
+        ("LIBMTP_Get_u16_From_Object", ct.c_uint16, [device_p, ct.c_uint32, property_t, ct.c_uint16]),
+        ("LIBMTP_Get_u8_From_Object", ct.c_uint8, [device_p, ct.c_uint32, property_t, ct.c_uint8]),
+        ("LIBMTP_Set_Object_String", ct.c_int, [device_p, ct.c_uint32, property_t, ct.c_char_p]),
+        ("LIBMTP_Set_Object_u32", ct.c_int, [device_p, ct.c_uint32, property_t, ct.c_uint32]),
+        ("LIBMTP_Set_Object_u16", ct.c_int, [device_p, ct.c_uint32, property_t, ct.c_uint16]),
+        ("LIBMTP_Set_Object_u8", ct.c_int, [device_p, ct.c_uint32, property_t, ct.c_uint8]),
+      # files and folders
+        ("LIBMTP_new_file_t", ct.POINTER(file_t), []),
+        ("LIBMTP_destroy_file_t", None, [ct.POINTER(file_t)]),
+        ("LIBMTP_Get_Filelisting", ct.POINTER(file_t), [device_p]),
+        ("LIBMTP_Get_Files_And_Folders", ct.POINTER(file_t), [device_p, ct.c_uint32, ct.c_uint32]),
+        ("LIBMTP_Get_Filemetadata", ct.POINTER(file_t), [device_p, ct.c_uint32]),
+        ("LIBMTP_Get_File_To_File_Descriptor", ct.c_int, [device_p, ct.c_uint32, ct.c_int, progressfunc_t, ct.c_void_p]),
+        ("LIBMTP_Get_File_To_Handler", ct.c_int, [device_p, ct.c_uint32, dataputfunc_t, ct.c_void_p, progressfunc_t, ct.c_void_p]),
+        ("LIBMTP_GetPartialObject", ct.c_int, [device_p, ct.c_uint32, ct.c_uint64, ct.c_uint32, ct.POINTER(ct.POINTER(ct.c_ubyte)), ct.POINTER(ct.c_uint)]),
+        ("LIBMTP_Send_File_From_File", ct.c_int, [device_p, ct.c_char_p, ct.POINTER(file_t), progressfunc_t, ct.c_void_p]),
+        ("LIBMTP_Set_File_Name", ct.c_int, [device_p, ct.POINTER(file_t), ct.c_char_p]),
+        ("LIBMTP_new_folder_t", ct.POINTER(folder_t), []),
+        ("LIBMTP_destroy_folder_t", None, [ct.POINTER(folder_t)]),
+        ("LIBMTP_Get_Folder_List", ct.POINTER(folder_t), [device_p]),
+        ("LIBMTP_Create_Folder", ct.c_uint32, [device_p, ct.c_char_p, ct.c_uint32, ct.c_uint32]),
+        ("LIBMTP_Set_Folder_Name", ct.c_int, [device_p, ct.POINTER(folder_t), ct.c_char_p]),
+        ("LIBMTP_Delete_Object", ct.c_int, [device_p, ct.c_uint32]),
+        ("LIBMTP_Move_Object", ct.c_int, [device_p, ct.c_uint32, ct.c_uint32, ct.c_uint32]),
+        ("LIBMTP_Copy_Object", ct.c_int, [device_p, ct.c_uint32, ct.c_uint32, ct.c_uint32]),
+      # tracks, playlists, albums
+        ("LIBMTP_new_track_t", ct.POINTER(track_t), []),
+        ("LIBMTP_destroy_track_t", None, [ct.POINTER(track_t)]),
+        ("LIBMTP_Get_Tracklisting_With_Callback", ct.POINTER(track_t), [device_p, progressfunc_t, ct.c_void_p]),
+        ("LIBMTP_Get_Trackmetadata", ct.POINTER(track_t), [device_p, ct.c_uint32]),
+        ("LIBMTP_Send_Track_From_File", ct.c_int, [device_p, ct.c_char_p, ct.POINTER(track_t), progressfunc_t, ct.c_void_p]),
+        ("LIBMTP_Set_Track_Name", ct.c_int, [device_p, ct.POINTER(track_t), ct.c_char_p]),
+        ("LIBMTP_new_playlist_t", ct.POINTER(playlist_t), []),
+        ("LIBMTP_destroy_playlist_t", None, [ct.POINTER(playlist_t)]),
+        ("LIBMTP_Get_Playlist_List", ct.POINTER(playlist_t), [device_p]),
+        ("LIBMTP_Get_Playlist", ct.POINTER(playlist_t), [device_p, ct.c_uint32]),
+        ("LIBMTP_Create_New_Playlist", ct.c_int, [device_p, ct.POINTER(playlist_t)]),
+        ("LIBMTP_Update_Playlist", ct.c_int, [device_p, ct.POINTER(playlist_t)]),
+        ("LIBMTP_new_album_t", ct.POINTER(album_t), []),
+        ("LIBMTP_destroy_album_t", None, [ct.POINTER(album_t)]),
+        ("LIBMTP_Get_Album_List", ct.POINTER(album_t), [device_p]),
+        ("LIBMTP_Get_Album", ct.POINTER(album_t), [device_p, ct.c_uint32]),
+        ("LIBMTP_Create_New_Album", ct.c_int, [device_p, ct.POINTER(album_t)]),
+        ("LIBMTP_Update_Album", ct.c_int, [device_p, ct.POINTER(album_t)]),
+    )
+del device_p, uint8_p
+
+def common_setup_libmtp(lib) :
+    # initializes libmtp and sets up full prototypes for all the functions I use,
+    # so ctypes neither guesses at argument conversions nor truncates 64-bit values.
+    for name, restype, argtypes in libmtp_prototypes :
+        func = getattr(lib, name)
+        func.restype = restype
+        func.argtypes = argtypes
+    #end for
+    lib.LIBMTP_Init()
+#end common_setup_libmtp
+
 #+
 # Internal useful stuff
 #-
@@ -733,50 +939,351 @@ class LeakProtect :
 
 #end LeakProtect
 
+def common_progress_func(progress) :
+    """wraps a Python progress(sent, total) callback for passing to libmtp. The
+    callback can return True to cancel the transfer. Returns a null function
+    pointer if progress is None. The caller must keep a reference to the result
+    for the duration of the transfer."""
+    if progress != None :
+        def progress_func(sent, total, data) :
+            return int(bool(progress(sent, total)))
+        #end progress_func
+        result = progressfunc_t(progress_func)
+    else :
+        result = progressfunc_t()
+    #end if
+    return result
+#end common_progress_func
+
 def common_return_files_and_folders(items, device) :
+    # converts a linked list of file_t (even for folders!) returned from libmtp
+    # to a list of File and Folder objects, disposing of the list as it goes.
     result = []
-    while bool(items) :
-        initem = items.contents
-        is_folder = initem.filetype == FILETYPE_FOLDER
-        outitem = (File, Folder)[is_folder](initem, device)
-        result.append(outitem)
-        # mtp.LIBMTP_destroy_file_t(items) # causes crash
-        items = initem.next # even for folder!
-    #end while
+    try :
+        while bool(items) :
+            initem = items.contents
+            is_folder = initem.filetype == FILETYPE_FOLDER
+            outitem = (File, Folder)[is_folder](initem, device)
+            result.append(outitem)
+            next = ct.cast(initem.next, ct.POINTER(file_t))
+              # copy pointer value before its containing struct is freed
+            device.lib.LIBMTP_destroy_file_t(items)
+            items = next
+        #end while
+    finally :
+        while bool(items) :
+            next = ct.cast(items.contents.next, ct.POINTER(file_t))
+            device.lib.LIBMTP_destroy_file_t(items)
+            items = next
+        #end while
+    #end try
     return result
 #end common_return_files_and_folders
 
+def common_take_string(addr) :
+    # returns the contents of a nul-terminated string allocated by libmtp as
+    # a bytes object, freeing the original, or None if addr is null.
+    if addr != None :
+        result = ct.string_at(addr)
+        libc.free(addr)
+    else :
+        result = None
+    #end if
+    return result
+#end common_take_string
+
 def common_get_files_and_folders(device, storageid, root) :
     return \
-        common_return_files_and_folders(mtp.LIBMTP_Get_Files_And_Folders(device.device, storageid, root), device)
+        common_return_files_and_folders(device.lib.LIBMTP_Get_Files_And_Folders(device.device, storageid, root), device)
 #end common_get_files_and_folders
 
-def common_send_file(device, src, parentid, destname) :
-    with LeakProtect(mtp.LIBMTP_new_file_t(), mtp.LIBMTP_destroy_file_t) as newfile :
-        newfile.contents.filesize = os.stat(src).st_size
+def common_list_children(device, storageid, parentid) :
+    """asks the device for just the immediate children of the specified Folder ID
+    (0 for the root), bypassing the cache."""
+    if parentid == 0 :
+        parentid = FILES_AND_FOLDERS_ROOT
+    #end if
+    return common_get_files_and_folders(device, storageid, parentid)
+#end common_list_children
+
+def common_check_destination(item, dest) :
+    # common validation for move/copy destination.
+    if not isinstance(dest, (Folder, Device)) :
+        raise RuntimeError("destination must be a Folder or Device")
+    #end if
+    if (dest.device, dest)[isinstance(dest, Device)] != item.device :
+        raise RuntimeError("cannot move/copy objects between devices")
+    #end if
+    if isinstance(item, Folder) :
+        ancestor = dest
+        while not isinstance(ancestor, Device) :
+            if ancestor.item_id == item.item_id :
+                raise RuntimeError("cannot move/copy folder into itself")
+            #end if
+            ancestor = ancestor.get_parent()
+        #end while
+    #end if
+#end common_check_destination
+
+def common_dest_storage_id(item, dest) :
+    # which storage a moved/copied item ends up on.
+    if isinstance(dest, Folder) :
+        result = dest.storage_id
+    else :
+        result = item.storage_id # stay on same storage at root level
+    #end if
+    return result
+#end common_dest_storage_id
+
+def common_move_object(item, dest) :
+    """moves a File or Folder into a different parent Folder (or the root level of
+    the Device) entirely on the device, updating the cache in place."""
+    device = item.device
+    common_check_destination(item, dest)
+    storageid = common_dest_storage_id(item, dest)
+    check_status \
+      (
+        device.lib.LIBMTP_Move_Object(device.device, item.item_id, storageid, dest.item_id),
+        device.device,
+        device.lib
+      )
+    device._cache_remove(item)
+    item.parent_id = dest.item_id
+    if storageid != item.storage_id :
+        if isinstance(item, Folder) :
+            for descendant in common_get_cached_descendants(item) :
+                descendant.storage_id = storageid
+                device._cache_property(descendant.item_id, PROPERTY_StorageID, storageid)
+            #end for
+        #end if
+        item.storage_id = storageid
+    #end if
+    device._cache_property(item.item_id, PROPERTY_StorageID, item.storage_id)
+    device._cache_property(item.item_id, PROPERTY_ParentObject, item.parent_id)
+    device._cache_add(item)
+    if device.tracks_by_id != None :
+        track = device.tracks_by_id.get(item.item_id)
+        if track != None :
+            track.parent_id = item.parent_id
+            track.storage_id = item.storage_id
+        #end if
+    #end if
+#end common_move_object
+
+def common_copy_object(item, dest) :
+    """copies a File or Folder (with all its contents) into the specified parent
+    Folder (or the root level of the Device) entirely on the device, and returns
+    the new File or Folder object. The cache is updated in place, or reloaded
+    if the copy cannot be identified, in which case None is returned."""
+    device = item.device
+    common_check_destination(item, dest)
+    storageid = common_dest_storage_id(item, dest)
+    # libmtp doesn't tell me the ID of the copy, so I have to look for it
+    before = set(child.item_id for child in common_list_children(device, storageid, dest.item_id))
+    check_status \
+      (
+        device.lib.LIBMTP_Copy_Object(device.device, item.item_id, storageid, dest.item_id),
+        device.device,
+        device.lib
+      )
+    new_children = list \
+      (
+        child
+        for child in common_list_children(device, storageid, dest.item_id)
+        if child.item_id not in before
+      )
+    if len(new_children) > 1 :
+        # something else also appeared meanwhile, go by name; note the device
+        # may have renamed the copy, e.g. when copying into the same folder
+        new_children = list(child for child in new_children if child.name == item.name)
+    #end if
+    if len(new_children) == 1 :
+        result = new_children[0]
+        device._cache_add(result)
+        if isinstance(result, Folder) and device.descendants_by_id != None :
+            # fill in cache entries for contents of copy
+            to_list = [result]
+            while len(to_list) != 0 :
+                folder = to_list.pop()
+                for child in common_list_children(device, storageid, folder.item_id) :
+                    device._cache_add(child)
+                    if isinstance(child, Folder) :
+                        to_list.append(child)
+                    #end if
+                #end for
+            #end while
+        #end if
+        if device.tracks_by_id != None and (isinstance(item, Folder) or FILETYPE_IS_TRACK(item.filetype)) :
+            device.tracks_by_id = None # copied tracks need reloading
+        #end if
+    else :
+        # can't identify it, fall back to complete reload
+        result = None
+        device.set_contents_changed()
+    #end if
+    return result
+#end common_copy_object
+
+def common_get_cached_descendants(folder) :
+    # generates all the cached File/Folder objects beneath the specified Folder.
+    for item in folder.get_children() :
+        yield item
+        if isinstance(item, Folder) :
+            for subitem in common_get_cached_descendants(item) :
+                yield subitem
+            #end for
+        #end if
+    #end for
+#end common_get_cached_descendants
+
+def common_host_free_space(dest) :
+    """returns the number of bytes available to an unprivileged user on the host
+    filesystem where dest is, or would be, located."""
+    dest = os.path.abspath(dest)
+    while not os.path.exists(dest) :
+        dest = os.path.dirname(dest)
+    #end while
+    info = os.statvfs(dest)
+    return info.f_bavail * info.f_frsize
+#end common_host_free_space
+
+def common_check_host_space(dest, needed) :
+    """raises OSError(ENOSPC) if the host filesystem for dest cannot hold another
+    needed bytes."""
+    available = common_host_free_space(dest)
+    if needed > available :
+        raise OSError \
+          (
+            errno.ENOSPC,
+            "need %d bytes but only %d available" % (needed, available),
+            dest
+          )
+    #end if
+#end common_check_host_space
+
+def common_free_objects(storage) :
+    # returns the number of further objects the storage can hold, or None if
+    # not known. Many devices (Android in particular) report 0 or all-ones
+    # to mean there is no limit on the number of objects; this is decided
+    # from the device's own figure, as saved by refresh_storage.
+    if storage.get("FreeSpaceInObjectsKnown", True) :
+        result = storage["FreeSpaceInObjects"]
+    else :
+        result = None
+    #end if
+    return result
+#end common_free_objects
+
+def common_check_device_space(device, storageid, needed, nr_objects = 1) :
+    """raises Error(ERROR_STORAGE_FULL) if the specified storage on the device
+    cannot hold another needed bytes in nr_objects new objects."""
+    storage = device.get_storage_by_id(storageid)
+    if storage != None :
+        free_objects = common_free_objects(storage)
+        if \
+            (
+                needed > storage["FreeSpaceInBytes"]
+            or
+                free_objects != None and nr_objects > free_objects
+            ) \
+        :
+            raise Error(ERROR_STORAGE_FULL)
+        #end if
+    #end if
+#end common_check_device_space
+
+def common_preallocate(fd, size) :
+    """reserves space for size bytes in the newly-created file open on fd, to fail
+    early if there is no room and to reduce fragmentation. Quietly does nothing on
+    filesystems that don't support this."""
+    if size > 0 :
+        try :
+            os.posix_fallocate(fd, 0, size)
+        except OSError as Err :
+            if Err.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS) :
+                pass
+            else :
+                raise
+            #end if
+        #end try
+    #end if
+#end common_preallocate
+
+def common_send_file(device, src, parentid, destname, storageid = 0, progress = None) :
+    filesize = os.stat(src).st_size
+    common_check_device_space(device, storageid, filesize)
+    progress_func = common_progress_func(progress)
+    with LeakProtect(device.lib.LIBMTP_new_file_t(), device.lib.LIBMTP_destroy_file_t) as newfile :
+        newfile.contents.filesize = filesize
         newfile.contents.name = libc.strdup(destname.encode("utf-8"))
         newfile.contents.parent_id = parentid
+        newfile.contents.storage_id = storageid
+        start = time.monotonic()
         check_status \
           (
-            mtp.LIBMTP_Send_File_From_File
+            device.lib.LIBMTP_Send_File_From_File
               (
                 device.device,
                 src.encode("utf-8"),
                 newfile,
-                None, # progress
+                progress_func,
                 None # progress arg
               ),
-            device.device
+            device.device,
+            device.lib
           )
+        device.metrics.add_transfer("sent", filesize, time.monotonic() - start)
+        device._account_storage_used(newfile.contents.storage_id, filesize, 1)
         device.set_contents_changed()
         result = device.get_descendant_by_id(newfile.contents.item_id)
     #end with
     return result
 #end common_send_file
 
-def common_retrieve_to_folder(self, dest) :
+def common_get_descendant_files(self) :
+    """generates all the File objects within this Device/Folder, recursing into
+    subfolders."""
+    for item in self.get_children() :
+        if isinstance(item, File) :
+            yield item
+        elif isinstance(item, Folder) :
+            for subitem in common_get_descendant_files(item) :
+                yield subitem
+            #end for
+        #end if
+    #end for
+#end common_get_descendant_files
+
+def common_retrieve_to_folder(self, dest, check_space = True, retry = None) :
     """retrieves the entire contents of this Device/Folder (and recursively of all
-    its subfolders) into the specified destination directory on the host filesystem."""
+    its subfolders) into the specified destination directory on the host filesystem.
+    Unless check_space is False, the total size of all the files is checked against
+    the free space on the host filesystem first, and OSError(ENOSPC) raised if there
+    is not enough room, before anything is written. If retry is a RetryPolicy,
+    failed file transfers are retried according to it, and files already present
+    at the destination with the right size and modification date (e.g. from an
+    earlier interrupted attempt) are skipped."""
+    if check_space :
+        common_check_host_space \
+          (
+            dest,
+            sum(item.filesize for item in common_get_descendant_files(self))
+          )
+    #end if
+    common_retrieve_tree(self, dest, retry)
+#end common_retrieve_to_folder
+
+def common_already_retrieved(item, destname) :
+    # does destname look like a complete earlier download of item.
+    try :
+        info = os.stat(destname)
+    except FileNotFoundError :
+        return False
+    #end try
+    return info.st_size == item.filesize and int(info.st_mtime) == item.modificationdate
+#end common_already_retrieved
+
+def common_retrieve_tree(self, dest, retry = None) :
     try :
         # only create leaf dir on demand, rest must already exist
         os.mkdir(dest)
@@ -788,13 +1295,130 @@ def common_retrieve_to_folder(self, dest) :
         #end if
     #end try
     for item in self.get_children() :
+        destname = os.path.join(dest, item.name)
         if isinstance(item, File) :
-            item.retrieve_to_file(os.path.join(dest, item.name))
+            if retry == None :
+                item.retrieve_to_file(destname)
+            elif not common_already_retrieved(item, destname) :
+                retry.call(item.device, item.retrieve_to_file, destname)
+            #end if
         elif isinstance(item, Folder) :
-            item.retrieve_to_folder(os.path.join(dest, item.name))
+            common_retrieve_tree(item, destname, retry)
         #end if
     #end for
-#end common_retrieve_to_folder
+#end common_retrieve_tree
+
+def common_walk_tree(self, prefix) :
+    # generates (arcname, item) pairs for all the Files and Folders within this
+    # Device/Folder, in a stable order with each Folder preceding its contents.
+    for item in sorted(self.get_children(), key = lambda item : item.name) :
+        arcname = prefix + item.name
+        yield arcname, item
+        if isinstance(item, Folder) :
+            for entry in common_walk_tree(item, arcname + "/") :
+                yield entry
+            #end for
+        #end if
+    #end for
+#end common_walk_tree
+
+class SizeCheckingWriter :
+    # passes writes through to a file object, making sure that no more and no
+    # less than the expected number of bytes are written.
+
+    def __init__(self, out, expected, name) :
+        self.out = out
+        self.expected = expected
+        self.name = name
+        self.written = 0
+    #end __init__
+
+    def write(self, data) :
+        self.written += len(data)
+        if self.written > self.expected :
+            raise RuntimeError("%s is larger than its reported size" % self.name)
+        #end if
+        self.out.write(data)
+    #end write
+
+    def check(self) :
+        if self.written != self.expected :
+            raise RuntimeError("%s is smaller than its reported size" % self.name)
+        #end if
+    #end check
+
+#end SizeCheckingWriter
+
+def common_retrieve_to_archive(self, fileobj, format, arcname, compression) :
+    """retrieves the entire contents of this Device/Folder (and recursively of all
+    its subfolders) into a tar or zip archive written to fileobj, without going
+    through any intermediate files."""
+    if arcname == None :
+        arcname = getattr(self, "name", "") # Device has no name
+    #end if
+    prefix = arcname.strip("/")
+    if prefix != "" :
+        prefix += "/"
+    #end if
+    now = round(time.time()) # folders have no modification date
+    if format == "tar" :
+        import tarfile
+        for name, item in common_walk_tree(self, prefix) :
+            info = tarfile.TarInfo(name)
+            if isinstance(item, Folder) :
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = now
+            else :
+                info.size = item.filesize
+                info.mode = 0o644
+                info.mtime = item.modificationdate
+            #end if
+            fileobj.write(info.tobuf(tarfile.DEFAULT_FORMAT, "utf-8", "surrogateescape"))
+            if isinstance(item, File) :
+                out = SizeCheckingWriter(fileobj, item.filesize, item.name)
+                item.retrieve_to_stream(out)
+                out.check()
+                remainder = item.filesize % tarfile.BLOCKSIZE
+                if remainder != 0 :
+                    fileobj.write(bytes(tarfile.BLOCKSIZE - remainder))
+                #end if
+            #end if
+        #end for
+        fileobj.write(bytes(tarfile.RECORDSIZE)) # end-of-archive marker and padding
+    elif format == "zip" :
+        import zipfile
+        if compression == None :
+            compression = zipfile.ZIP_STORED
+        #end if
+        with zipfile.ZipFile(fileobj, "w", compression) as archive :
+            for name, item in common_walk_tree(self, prefix) :
+                if isinstance(item, Folder) :
+                    info = zipfile.ZipInfo(name + "/", time.localtime(now)[:6])
+                    info.external_attr = 0o40755 << 16 | 0x10 # MS-DOS directory flag
+                    archive.writestr(info, b"")
+                else :
+                    info = zipfile.ZipInfo \
+                      (
+                        name,
+                        time.localtime(max(item.modificationdate, 315532800))[:6]
+                          # zip can't represent dates before 1980
+                      )
+                    info.external_attr = 0o644 << 16
+                    info.compress_type = compression
+                    info.file_size = item.filesize
+                    with archive.open(info, "w", force_zip64 = item.filesize >= zipfile.ZIP64_LIMIT) as entry :
+                        out = SizeCheckingWriter(entry, item.filesize, item.name)
+                        item.retrieve_to_stream(out)
+                        out.check()
+                    #end with
+                #end if
+            #end for
+        #end with
+    else :
+        raise RuntimeError("unsupported archive format %s" % repr(format))
+    #end if
+#end common_retrieve_to_archive
 
 def common_send_track \
   (
@@ -812,8 +1436,10 @@ def common_send_track \
     date = None,
     duration = 0, # seconds
     rating = 0,
+    progress = None,
   ) :
-    with LeakProtect(mtp.LIBMTP_new_track_t(), mtp.LIBMTP_destroy_track_t) as track :
+    progress_func = common_progress_func(progress)
+    with LeakProtect(device.lib.LIBMTP_new_track_t(), device.lib.LIBMTP_destroy_track_t) as track :
         track.contents.parent_id = parentid
         track.contents.storage_id = storageid
         for \
@@ -841,39 +1467,104 @@ def common_send_track \
         track.contents.filename = libc.strdup(destname.encode("utf-8"))
         track.contents.modificationdate = round(stat.st_mtime) # I like to preserve this
         track.contents.rating = rating
+        start = time.monotonic()
         check_status \
           (
-            mtp.LIBMTP_Send_Track_From_File
+            device.lib.LIBMTP_Send_Track_From_File
               (
                 device.device,
                 src.encode("utf-8"),
                 track,
-                None, # progress
+                progress_func,
                 None # progress arg
-              )
+              ),
+            device.device,
+            device.lib
           )
+        device.metrics.add_transfer("sent", stat.st_size, time.monotonic() - start)
+        device._account_storage_used(track.contents.storage_id, stat.st_size, 1)
         result = track.contents.item_id
     #end with
     return result
 #end common_send_track
 
+def common_cache_new_object(device, objectid) :
+    """adds a single newly-created object to the cached file/folder tree, if
+    loaded, by fetching just its metadata rather than reloading everything."""
+    if device.descendants_by_id != None :
+        with \
+            LeakProtect \
+              (
+                device.lib.LIBMTP_Get_Filemetadata(device.device, objectid),
+                device.lib.LIBMTP_destroy_file_t
+              ) \
+        as \
+            item \
+        :
+            if bool(item) :
+                device._cache_add \
+                  (
+                    (File, Folder)[item.contents.filetype == FILETYPE_FOLDER](item.contents, device)
+                  )
+            else :
+                device.lib.LIBMTP_Clear_Errorstack(device.device)
+                device.set_contents_changed()
+            #end if
+        #end with
+    #end if
+#end common_cache_new_object
+
+def common_cache_new_track(device, trackid) :
+    """adds a single newly-uploaded track to the cached file/folder tree and
+    track list, if loaded, by fetching just its metadata. Returns the new
+    Track object."""
+    common_cache_new_object(device, trackid)
+    with \
+        LeakProtect \
+          (
+            device.lib.LIBMTP_Get_Trackmetadata(device.device, trackid),
+            device.lib.LIBMTP_destroy_track_t
+          ) \
+    as \
+        track \
+    :
+        if bool(track) :
+            result = Track(track.contents, device)
+        else :
+            result = None
+        #end if
+    #end with
+    if result != None :
+        device._cache_add_track(result)
+    else :
+        device.lib.LIBMTP_Clear_Errorstack(device.device)
+        device.set_contents_changed()
+        result = device.get_track_by_id(trackid)
+    #end if
+    return result
+#end common_cache_new_track
+
 def common_create_playlist(device, parentid, name, storageid) :
-    with LeakProtect(mtp.LIBMTP_new_playlist_t(), mtp.LIBMTP_destroy_playlist_t) as playlist :
+    with LeakProtect(device.lib.LIBMTP_new_playlist_t(), device.lib.LIBMTP_destroy_playlist_t) as playlist :
         playlist.contents.parent_id = parentid
         playlist.contents.storage_id = storageid
-        playlist.name = libc.strdup(name.encode("utf-8"))
+        playlist.contents.name = libc.strdup(name.encode("utf-8"))
         # initially no tracks
         check_status \
           (
-            mtp.LIBMTP_Create_New_Playlist(device.device, playlist)
+            device.lib.LIBMTP_Create_New_Playlist(device.device, playlist)
           )
-        result = playlist.contents.playlist_id
+        result = Playlist(playlist.contents, device)
     #end with
+    common_cache_new_object(device, result.item_id)
+    if device.playlists_by_id != None :
+        device.playlists_by_id[result.item_id] = result
+    #end if
     return result
 #end common_create_playlist
 
 def common_create_album(device, parentid, name, storageid, artist = None, composer = None, genre = None) :
-    with LeakProtect(mtp.LIBMTP_new_album_t(), mtp.LIBMTP_destroy_album_t) as album :
+    with LeakProtect(device.lib.LIBMTP_new_album_t(), device.lib.LIBMTP_destroy_album_t) as album :
         album.contents.parent_id = parentid
         album.contents.storage_id = storageid
         album.contents.name = libc.strdup(name.encode("utf-8"))
@@ -894,17 +1585,69 @@ def common_create_album(device, parentid, name, storageid, artist = None, compos
         # initially no tracks
         check_status \
           (
-            mtp.LIBMTP_Create_New_Album(device.device, album)
+            device.lib.LIBMTP_Create_New_Album(device.device, album)
           )
-        result = album.contents.album_id
+        result = Album(album.contents, device)
     #end with
+    common_cache_new_object(device, result.item_id)
+    if device.albums_by_id != None :
+        device.albums_by_id[result.item_id] = result
+    #end if
     return result
 #end common_create_album
 
+def common_update_track_list(item, new_tracks) :
+    """common routine for writing a new list of track IDs to a Playlist or Album.
+    The playlist_t/album_t is built from the cached fields, rather than being
+    refetched from the device."""
+    device = item.device
+    is_album = isinstance(item, Album)
+    new = (device.lib.LIBMTP_new_playlist_t, device.lib.LIBMTP_new_album_t)[is_album]
+    destroy = (device.lib.LIBMTP_destroy_playlist_t, device.lib.LIBMTP_destroy_album_t)[is_album]
+    update = (device.lib.LIBMTP_Update_Playlist, device.lib.LIBMTP_Update_Album)[is_album]
+    idfield = ("playlist_id", "album_id")[is_album]
+    with LeakProtect(new(), destroy) as p :
+        setattr(p.contents, idfield, item.item_id)
+        p.contents.parent_id = item.parent_id
+        p.contents.storage_id = item.storage_id
+        for attr in ("name",) + (("artist", "composer", "genre"), ())[not is_album] :
+            value = getattr(item, attr)
+            if value != None :
+                setattr(p.contents, attr, libc.strdup(value.encode("utf-8")))
+                  # will be disposed by libmtp
+            #end if
+        #end for
+        p.contents.no_tracks = len(new_tracks)
+        p.contents.tracks = ct.cast(libc.malloc(max(p.contents.no_tracks, 1) * ct.sizeof(ct.c_uint32)), ct.POINTER(ct.c_uint32))
+        for i in range(0, p.contents.no_tracks) :
+            p.contents.tracks[i] = new_tracks[i]
+        #end for
+        check_status \
+          (
+            update(device.device, p),
+            device.device,
+            device.lib
+          )
+        new_id = getattr(p.contents, idfield)
+    #end with
+    item.tracks = tuple(new_tracks)
+    if new_id != item.item_id :
+        # some devices can only update by recreating the object
+        cache = (device.playlists_by_id, device.albums_by_id)[is_album]
+        if cache != None :
+            cache.pop(item.item_id, None)
+            cache[new_id] = item
+        #end if
+        device._cache_remove(item)
+        item.item_id = new_id
+        common_cache_new_object(device, new_id)
+    #end if
+#end common_update_track_list
+
 def common_delete_object(device, objectid) :
     check_status \
       (
-        mtp.LIBMTP_Delete_Object(device.device, objectid)
+        device.lib.LIBMTP_Delete_Object(device.device, objectid)
       )
     device.set_contents_changed()
 #end common_delete_object
@@ -916,7 +1659,11 @@ def common_delete_object(device, objectid) :
 class RawDevice() :
     """representation of an available MTP device, as returned by get_raw_devices."""
 
-    def __init__(self, device) :
+    def __init__(self, device, lib = None) :
+        if lib == None :
+            lib = mtp
+        #end if
+        self.lib = lib # the backend for talking to the device
         self.device = raw_device_t(device.device_entry, device.bus_location, device.devnum)
         for attr in ("vendor", "product") :
             setattr \
@@ -927,18 +1674,36 @@ class RawDevice() :
               )
             setattr(self, attr, getattr(device.device_entry, attr).decode("utf-8"))
         #end for
+        self.location = (device.bus_location, device.devnum)
+          # identifies the device among those currently attached
     #end __init__
 
-    def open(self) :
+    def _open_handle(self) :
+        # opens the device and returns the libmtp handle for it.
         cached = False # Get_Files_And_Folders won't work otherwise
-        return Device \
-          (
-            (mtp.LIBMTP_Open_Raw_Device_Uncached, mtp.LIBMTP_Open_Raw_Device)[cached]
-                (ct.byref(self.device)),
-            self
-          )
+        result = (self.lib.LIBMTP_Open_Raw_Device_Uncached, self.lib.LIBMTP_Open_Raw_Device)[cached] \
+            (ct.byref(self.device))
+        if not bool(result) :
+            raise Error(ERROR_CONNECTING)
+        #end if
+        return result
+    #end _open_handle
+
+    def open(self) :
+        return Device(self._open_handle(), self)
     #end open
 
+    def open_actor(self) :
+        """returns a DeviceActor which opens and owns the connection to this device
+        on a dedicated thread, so it can be shared among many threads."""
+        return DeviceActor(self)
+    #end open_actor
+
+    async def open_async(self) :
+        """opens the device for use from asyncio code, returning an AsyncDevice."""
+        return await open_async(self)
+    #end open_async
+
     def __repr__(self) :
         return "<RawDevice “%s %s”>" % (self.vendor, self.product)
     #end __repr__
@@ -950,9 +1715,37 @@ class Device() :
 
     def __init__(self, device, rawdev) :
         self.device = device
+        self.rawdev = rawdev
+        self.lib = rawdev.lib
         self.vendor = rawdev.vendor
         self.product = rawdev.product
-        check_status(mtp.LIBMTP_Get_Storage(device, STORAGE_SORTBY_NOTSORTED), device)
+        self.metrics = DeviceMetrics()
+        self._load_device_info()
+        self.serial_number = self._read_serial_number(device)
+          # remembered for reopen
+        self.item_id = 0
+        self.parent_id = 0
+        self.update_seq = 1 # cache coherence check
+        self.children_by_name = None
+        self.descendants_by_id = None
+        self.tracks_by_id = None
+        self.playlists_by_id = None
+        self.albums_by_id = None
+        self.track_indexes = None
+        self.track_indexes_for = None
+        self.properties_by_id = {}
+        self.capabilities_file = None
+        self._clear_capabilities()
+    #end __init__
+
+    def _load_device_info(self) :
+        # (re)loads the information that libmtp obtains on opening the device.
+        device = self.device
+        device_metrics[ct.addressof(device.contents)] = self.metrics
+        self.storage = []
+        self.storage_sortby = None
+        self.storage_refreshed = None
+        self.refresh_storage(max_age = 0)
         for \
             k \
         in \
@@ -965,25 +1758,6 @@ class Device() :
         :
             setattr(self, k, getattr(device.contents, k))
         #end for
-        self.storage = []
-        sto = device.contents.storage
-        while bool(sto) :
-            sto = sto.contents
-            self.storage.append \
-              (
-                dict
-                  (
-                    (k, getattr(sto, k))
-                    for k in
-                        (
-                            "id", "StorageType", "FilesystemType", "AccessCapability",
-                            "MaxCapacity", "FreeSpaceInBytes", "FreeSpaceInObjects",
-                            "StorageDescription", "VolumeIdentifier",
-                        )
-                  )
-              )
-            sto = sto.next
-        #end while
         self.extensions = []
         ext = device.contents.extensions
         while bool(ext) :
@@ -998,96 +1772,477 @@ class Device() :
               )
             ext = ext.next
         #end while
-        self.item_id = 0
-        self.parent_id = 0
-        self.update_seq = 1 # cache coherence check
-        self.children_by_name = None
-        self.descendants_by_id = None
-        self.tracks_by_id = None
-        self.playlists_by_id = None
-        self.albums_by_id = None
-    #end __init__
+    #end _load_device_info
 
     def close(self) :
         """closes the connection. Must be the last operation on this Device object."""
-        mtp.LIBMTP_Release_Device(self.device)
-        del self.device
+        try :
+            self.save_capabilities()
+        finally :
+            device_metrics.pop(ct.addressof(self.device.contents), None)
+            self.lib.LIBMTP_Release_Device(self.device)
+            del self.device
+        #end try
     #end close
 
+    def _read_serial_number(self, handle) :
+        # returns the serial number that libmtp obtained on opening the device
+        # with the specified handle, or None if it doesn't have one.
+        result = common_take_string(self.lib.LIBMTP_Get_Serialnumber(handle))
+        if result != None :
+            result = result.decode("utf-8")
+        else :
+            self.lib.LIBMTP_Clear_Errorstack(handle)
+        #end if
+        return result
+    #end _read_serial_number
+
+    def check_alive(self) :
+        """does a quick round trip to the device, returning True if it responds,
+        False if the connection has been lost. As a side effect, the storage
+        information is refreshed."""
+        # note most of the libmtp getters just return device info cached
+        # on opening; querying storage actually has to talk to the device.
+        try :
+            self.refresh_storage(self.storage_sortby, max_age = 0)
+            result = True
+        except Error :
+            result = False
+        #end try
+        return result
+    #end check_alive
+
+    def reopen(self) :
+        """reestablishes the connection to the device, for example after a USB
+        reset or after the cable has been unplugged and replugged. The device is
+        identified by its serial number, so it may now be at a different bus
+        location. This Device object, and any File/Folder etc objects obtained
+        from it, remain usable, but the cache of device contents is discarded.
+        A device without a serial number is only reconnected at its previous
+        location, so as not to be confused with another one of the same model."""
+        serial = self.serial_number
+        if getattr(self, "device", None) != None :
+            # not already closed, or lost by a previous failed reopen
+            device_metrics.pop(ct.addressof(self.device.contents), None)
+            self.lib.LIBMTP_Release_Device(self.device)
+        #end if
+        self.device = None
+        candidates = get_raw_devices(self.lib)
+        candidates.sort \
+          (
+            key = lambda rawdev :
+                (
+                    rawdev.location != self.rawdev.location,
+                    (rawdev.vendor, rawdev.product) != (self.vendor, self.product),
+                )
+          ) # most likely ones first
+        for rawdev in candidates :
+            try :
+                handle = rawdev._open_handle()
+            except Error :
+                continue
+            #end try
+            candidate_serial = self._read_serial_number(handle)
+            if serial != None :
+                matched = candidate_serial == serial
+            else :
+                # can't tell it apart from other devices, so don't guess
+                matched = \
+                    (
+                        candidate_serial == None
+                    and
+                        rawdev.location == self.rawdev.location
+                    and
+                        (rawdev.vendor, rawdev.product) == (self.vendor, self.product)
+                    )
+            #end if
+            if matched :
+                self.device = handle
+                self.rawdev = rawdev
+                self.serial_number = candidate_serial
+                break
+            #end if
+            self.lib.LIBMTP_Release_Device(handle)
+        #end for
+        if self.device == None :
+            raise Error(ERROR_NO_DEVICE_ATTACHED)
+        #end if
+        self._load_device_info()
+        self.set_contents_changed()
+        if self.capabilities_file != None :
+            # firmware might have been updated in the meantime
+            try :
+                self.save_capabilities()
+            finally :
+                self.load_capabilities(os.path.dirname(self.capabilities_file))
+            #end try
+        #end if
+    #end reopen
+
     def __repr__(self) :
         return "<Device “%s %s”>" % (self.vendor, self.product)
     #end __repr__
 
     def get_manufacturer_name(self) :
-        return bytes(mtp.LIBMTP_Get_Manufacturername(self.device)).decode("utf-8")
+        return common_take_string(self.lib.LIBMTP_Get_Manufacturername(self.device)).decode("utf-8")
     #end get_manufacturer_name
 
     def get_model_name(self) :
-        return bytes(mtp.LIBMTP_Get_Modelname(self.device)).decode("utf-8")
+        return common_take_string(self.lib.LIBMTP_Get_Modelname(self.device)).decode("utf-8")
     #end get_model_name
 
     def get_serial_number(self) :
-        return bytes(mtp.LIBMTP_Get_Serialnumber(self.device)).decode("utf-8")
+        self.serial_number = self._read_serial_number(self.device)
+        return self.serial_number
     #end get_serial_number
 
     def get_device_version(self) :
-        return bytes(mtp.LIBMTP_Get_Deviceversion(self.device)).decode("utf-8")
+        return common_take_string(self.lib.LIBMTP_Get_Deviceversion(self.device)).decode("utf-8")
     #end get_device_version
 
     def get_friendly_name(self) :
-        return bytes(mtp.LIBMTP_Get_Friendlyname(self.device)).decode("utf-8")
+        return common_take_string(self.lib.LIBMTP_Get_Friendlyname(self.device)).decode("utf-8")
     #end get_friendly_name
 
     def set_friendly_name(self, new_name) :
-        check_status(mtp.LIBMTP_Set_Friendlyname(self.device, new_name.encode("utf-8")), self.device)
+        check_status(self.lib.LIBMTP_Set_Friendlyname(self.device, new_name.encode("utf-8")), self.device, self.lib)
     #end set_friendly_name
 
     def get_sync_parner(self) :
-        return bytes(mtp.LIBMTP_Get_Syncpartner(self.device)).decode("utf-8")
+        return common_take_string(self.lib.LIBMTP_Get_Syncpartner(self.device)).decode("utf-8")
     #end get_sync_parner
 
     def set_sync_partner(self, new_name) :
-        check_status(mtp.LIBMTP_Set_Syncpartner(self.device, new_name.encode("utf-8")), self.device)
+        check_status(self.lib.LIBMTP_Set_Syncpartner(self.device, new_name.encode("utf-8")), self.device, self.lib)
     #end set_sync_partner
 
     def get_battery_level(self) :
         # fixme: lots of devices fail to implement this. Should follow libmtp detect.c
         # example and clear device error stack without failing.
-        maxlevel = ct.c_int(0)
-        curlevel = ct.c_int(0)
-        check_status(mtp.LIBMTP_Get_Batterylevel(self.device, ct.byref(maxlevel), ct.byref(curlevel)), self.device)
+        maxlevel = ct.c_uint8(0)
+        curlevel = ct.c_uint8(0)
+        check_status(self.lib.LIBMTP_Get_Batterylevel(self.device, ct.byref(maxlevel), ct.byref(curlevel)), self.device, self.lib)
+        self.metrics.battery_level = (maxlevel.value, curlevel.value)
         return maxlevel.value, curlevel.value
     #end get_battery_level
 
+    def get_metrics(self, battery = False) :
+        """returns a JSON-compatible snapshot of self.metrics, identifying this
+        device. If battery, the battery level is queried first; otherwise the
+        level reported is from the last call to get_battery_level, if any."""
+        if battery :
+            try :
+                self.get_battery_level()
+            except Error :
+                pass # lots of devices don't implement this
+            #end try
+        #end if
+        result = \
+            {
+                "timestamp" : time.time(),
+                "vendor" : self.vendor,
+                "product" : self.product,
+                "serial_number" : self.serial_number,
+                "location" : list(self.rawdev.location),
+            }
+        result.update(self.metrics.as_dict())
+        return result
+    #end get_metrics
+
+    def write_metrics(self, filename, format = "prometheus", battery = False) :
+        """writes a snapshot of self.metrics to the specified file, either in
+        Prometheus text format (suitable for the node_exporter textfile collector)
+        or as JSON, according to format. The file is replaced atomically, so
+        readers never see a partial snapshot. battery is as for get_metrics."""
+        if format not in ("prometheus", "json") :
+            raise RuntimeError("unrecognized metrics format “%s”" % format)
+        #end if
+        snapshot = self.get_metrics(battery)
+        if self.serial_number != None :
+            serial = self.serial_number
+        else :
+            # fall back to USB location, so identical devices still get distinct labels
+            serial = "usb-%d-%d" % self.rawdev.location
+        #end if
+        tempname = "%s-%d.tmp" % (filename, os.getpid())
+        try :
+            with open(tempname, "w") as outfile :
+                if format == "prometheus" :
+                    outfile.write \
+                      (
+                        self.metrics.format_prometheus
+                          (
+                            {
+                                "vendor" : self.vendor,
+                                "product" : self.product,
+                                "serial" : serial,
+                            }
+                          )
+                      )
+                else :
+                    import json
+                    json.dump(snapshot, outfile, indent = 4)
+                    outfile.write("\n")
+                #end if
+            #end with
+            os.replace(tempname, filename)
+        except :
+            if os.path.exists(tempname) :
+                os.unlink(tempname)
+            #end if
+            raise
+        #end try
+    #end write_metrics
+
     def get_secure_time(self) :
-        result = ct.c_char_p()
-        check_status(mtp.LIBMTP_Get_Secure_Time(self.device, ct.byref(result)), self.device)
-        return bytes(result)
+        result = ct.c_void_p()
+        check_status(self.lib.LIBMTP_Get_Secure_Time(self.device, ct.byref(result)), self.device, self.lib)
+        return common_take_string(result.value)
     #end get_secure_time
 
     def get_device_certificate(self) :
-        result = ct.c_char_p()
-        check_status(mtp.LIBMTP_Get_Device_Certificate(self.device, ct.byref(result)), self.device)
-        return bytes(result)
+        result = ct.c_void_p()
+        check_status(self.lib.LIBMTP_Get_Device_Certificate(self.device, ct.byref(result)), self.device, self.lib)
+        return common_take_string(result.value)
     #end get_device_certificate
 
     def get_supported_filetypes(self) :
-        types = ct.POINTER(ct.c_uint16)()
-        nrtypes = ct.c_uint16(0)
-        check_status(mtp.LIBMTP_Get_Supported_Filetypes(self.device, ct.byref(types), ct.byref(nrtypes)), self.device)
-        result = []
-        for i in range(0, nrtypes.value) :
-            result.append \
-              (
-                (
-                    types[i],
-                    bytes(mtp.LIBMTP_Get_Filetype_Description(filetype_t(types[i]))).decode("utf-8")
-                )
-              )
-        #end for
-        return result
+        if self.capabilities["filetypes"] == None :
+            nrtypes = ct.c_uint16(0)
+            with LeakProtect(ct.POINTER(ct.c_uint16)(), libc.free) as types :
+                check_status(self.lib.LIBMTP_Get_Supported_Filetypes(self.device, ct.byref(types), ct.byref(nrtypes)), self.device, self.lib)
+                result = []
+                for i in range(0, nrtypes.value) :
+                    result.append \
+                      (
+                        (
+                            types[i],
+                            bytes(self.lib.LIBMTP_Get_Filetype_Description(filetype_t(types[i]))).decode("utf-8")
+                        )
+                      )
+                #end for
+            #end with
+            self.capabilities["filetypes"] = result
+            self.capabilities_dirty = True
+        #end if
+        return list(self.capabilities["filetypes"])
     #end get_supported_filetypes
 
+    # Capability answers (supported filetypes and properties, allowed property
+    # values) don't change while the device is connected, so they are only
+    # asked for once per Device. They can also be kept on disk, so that later
+    # sessions with the same model and firmware need not ask at all.
+
+    def _clear_capabilities(self) :
+        self.capabilities = \
+            {
+                "filetypes" : None,
+                "property_supported" : {}, # keyed by (propid, filetypeid)
+                "allowed_values" : {}, # keyed by (propid, filetypeid)
+            }
+        self.capabilities_dirty = False
+    #end _clear_capabilities
+
+    def get_capabilities_key(self) :
+        """returns a tuple (manufacturer, model, device version) identifying
+        devices that can be expected to give the same capability answers."""
+        return \
+            (
+                self.get_manufacturer_name(),
+                self.get_model_name(),
+                self.get_device_version(),
+            )
+    #end get_capabilities_key
+
+    def load_capabilities(self, dirname = None) :
+        """loads previously-saved capability answers for this model and firmware
+        from a file in the specified directory (defaults to mtpy under the user's
+        cache directory), and arranges for new answers to be saved there by
+        save_capabilities and on close."""
+        import json
+        if dirname == None :
+            dirname = os.path.join \
+              (
+                os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                "mtpy"
+              )
+        #end if
+        filename = os.path.join \
+          (
+            dirname,
+            "".join
+              (
+                (c, "_")[not (c.isalnum() or c in ".-")]
+                for c in "-".join(self.get_capabilities_key())
+              )
+            +
+                ".json"
+          )
+        self.capabilities_file = filename
+        self._clear_capabilities()
+        try :
+            with open(filename, "r") as infile :
+                saved = json.load(infile)
+            #end with
+        except (OSError, ValueError) :
+            saved = None
+        #end try
+        if saved != None :
+            if saved.get("filetypes") != None :
+                self.capabilities["filetypes"] = list(tuple(entry) for entry in saved["filetypes"])
+            #end if
+            for propid, filetypeid, supported in saved.get("property_supported", ()) :
+                self.capabilities["property_supported"][(propid, filetypeid)] = supported
+            #end for
+            for propid, filetypeid, allowed in saved.get("allowed_values", ()) :
+                if "vals" in allowed :
+                    allowed["vals"] = tuple(allowed["vals"])
+                #end if
+                self.capabilities["allowed_values"][(propid, filetypeid)] = allowed
+            #end for
+        #end if
+    #end load_capabilities
+
+    def save_capabilities(self) :
+        """writes any new capability answers to the file set up by load_capabilities,
+        if any."""
+        if self.capabilities_file != None and self.capabilities_dirty :
+            import json
+            os.makedirs(os.path.dirname(self.capabilities_file), exist_ok = True)
+            tempname = "%s-%d.tmp" % (self.capabilities_file, os.getpid())
+            with open(tempname, "w") as outfile :
+                json.dump \
+                  (
+                    {
+                        "filetypes" : self.capabilities["filetypes"],
+                        "property_supported" :
+                            list
+                              (
+                                [propid, filetypeid, supported]
+                                for (propid, filetypeid), supported in
+                                    self.capabilities["property_supported"].items()
+                              ),
+                        "allowed_values" :
+                            list
+                              (
+                                [propid, filetypeid, allowed]
+                                for (propid, filetypeid), allowed in
+                                    self.capabilities["allowed_values"].items()
+                              ),
+                    },
+                    outfile
+                  )
+            #end with
+            os.replace(tempname, self.capabilities_file)
+            self.capabilities_dirty = False
+        #end if
+    #end save_capabilities
+
+    def refresh_storage(self, sortby = STORAGE_SORTBY_NOTSORTED, max_age = 1.0) :
+        """requeries the device for current storage information, including free
+        space, and updates self.storage accordingly. To avoid unnecessary device
+        traffic, nothing is done if this was last done less than max_age seconds
+        ago with the same sortby (one of the STORAGE_SORTBY_xxx values, which
+        determines the order of self.storage, and hence which storage is used by
+        default). Existing entries in self.storage are updated in place. Returns
+        self.storage."""
+        now = time.monotonic()
+        if \
+            (
+                self.storage_refreshed == None
+            or
+                now - self.storage_refreshed >= max_age
+            or
+                sortby != self.storage_sortby
+            ) \
+        :
+            check_status(self.lib.LIBMTP_Get_Storage(self.device, sortby), self.device, self.lib)
+            old_storage = dict((storage["id"], storage) for storage in self.storage)
+            new_storage = []
+            sto = self.device.contents.storage
+            while bool(sto) :
+                sto = sto.contents
+                entry = old_storage.get(sto.id, {})
+                entry.update \
+                  (
+                    (k, getattr(sto, k))
+                    for k in
+                        (
+                            "id", "StorageType", "FilesystemType", "AccessCapability",
+                            "MaxCapacity", "FreeSpaceInBytes", "FreeSpaceInObjects",
+                            "StorageDescription", "VolumeIdentifier",
+                        )
+                  )
+                entry["FreeSpaceInObjectsKnown"] = \
+                    sto.FreeSpaceInObjects not in (0, 0xffffffff, 0xffffffffffffffff)
+                new_storage.append(entry)
+                sto = sto.next
+            #end while
+            self.storage[:] = new_storage
+            self.storage_sortby = sortby
+            self.storage_refreshed = now
+        #end if
+        return self.storage
+    #end refresh_storage
+
+    def get_free_space(self, storageid = 0, max_age = 1.0) :
+        """returns a tuple (free bytes, free objects) for the specified storage
+        (0 for the default one), refreshed if older than max_age seconds."""
+        self.refresh_storage(self.storage_sortby, max_age)
+        storage = self.get_storage_by_id(storageid)
+        if storage == None :
+            raise RuntimeError("no such storage %#x" % storageid)
+        #end if
+        return storage["FreeSpaceInBytes"], storage["FreeSpaceInObjects"]
+    #end get_free_space
+
+    def pick_storage(self, needed = 0, nr_objects = 1, max_age = 1.0) :
+        """returns the entry in self.storage with the most free space, refreshed
+        if older than max_age seconds, or None if none of them has room for
+        needed bytes in nr_objects objects."""
+        best = None
+        for storage in self.refresh_storage(self.storage_sortby, max_age) :
+            free_objects = common_free_objects(storage)
+            if \
+                (
+                    storage["FreeSpaceInBytes"] >= needed
+                and
+                    (free_objects == None or free_objects >= nr_objects)
+                and
+                    (best == None or storage["FreeSpaceInBytes"] > best["FreeSpaceInBytes"])
+                ) \
+            :
+                best = storage
+            #end if
+        #end for
+        return best
+    #end pick_storage
+
+    def get_storage_by_id(self, storageid) :
+        """returns the entry in self.storage for the specified storage ID, or
+        None if not found. An ID of 0 returns the first (default) storage."""
+        result = None
+        for storage in self.storage :
+            if storageid == 0 or storage["id"] == storageid :
+                result = storage
+                break
+            #end if
+        #end for
+        return result
+    #end get_storage_by_id
+
+    def _account_storage_used(self, storageid, nr_bytes, nr_objects) :
+        # keeps the free-space figures in self.storage roughly current after
+        # a transfer, without having to requery the device.
+        storage = self.get_storage_by_id(storageid)
+        if storage != None :
+            storage["FreeSpaceInBytes"] = max(storage["FreeSpaceInBytes"] - nr_bytes, 0)
+            if common_free_objects(storage) != None :
+                storage["FreeSpaceInObjects"] = max(storage["FreeSpaceInObjects"] - nr_objects, 0)
+            #end if
+        #end if
+    #end _account_storage_used
+
     def fullpath(self) :
         """returns the fully-qualified pathname of the root directory."""
         return "/" # I'm always root
@@ -1101,6 +2256,7 @@ class Device() :
         self.tracks_by_id = None
         self.playlists_by_id = None
         self.albums_by_id = None
+        self.properties_by_id = {}
         self.update_seq += 1
     #def set_contents_changed
 
@@ -1118,9 +2274,59 @@ class Device() :
         #end for
     #end _cache_contents
 
+    def _get_cached_children(self, parentid) :
+        # returns the children_by_name dict for the specified parent Folder or
+        # Device, or None if it is not currently cached.
+        result = None
+        if parentid == 0 :
+            result = self.children_by_name
+        elif self.descendants_by_id != None :
+            parent = self.descendants_by_id.get(parentid)
+            if \
+                (
+                    isinstance(parent, Folder)
+                and
+                    parent.children_by_name != None
+                and
+                    parent.update_seq == self.update_seq
+                ) \
+            :
+                result = parent.children_by_name
+            #end if
+        #end if
+        return result
+    #end _get_cached_children
+
+    def _cache_add(self, item) :
+        # adds a single new or moved File/Folder to the cache, if the cache is
+        # loaded. Doesn't invalidate anything else.
+        if self.descendants_by_id != None :
+            self.descendants_by_id[item.item_id] = item
+            children = self._get_cached_children(item.parent_id)
+            if children != None :
+                children[item.name] = item
+            #end if
+        #end if
+    #end _cache_add
+
+    def _cache_remove(self, item) :
+        # removes a single File/Folder from the cache, if the cache is loaded.
+        # Doesn't invalidate anything else.
+        if self.descendants_by_id != None :
+            self.descendants_by_id.pop(item.item_id, None)
+            children = self._get_cached_children(item.parent_id)
+            if children != None and children.get(item.name) is item :
+                del children[item.name]
+            #end if
+        #end if
+    #end _cache_remove
+
     def _ensure_got_descendants(self) :
+        self.metrics.cache_lookup("contents", self.descendants_by_id != None)
         if self.descendants_by_id == None :
+            start = time.monotonic()
             self._cache_contents(common_get_files_and_folders(self, 0, 0))
+            self.metrics.add_enumeration("contents", time.monotonic() - start)
         #end if
     #end _ensure_got_descendants
 
@@ -1129,28 +2335,28 @@ class Device() :
     #end _ensure_got_children
 
     def _ensure_got_tracks(self) :
-        self._ensure_got_descendants() # doesn't seem to work otherwise
         if self.tracks_by_id == None :
-            self.tracks_by_id = {}
-            track = mtp.LIBMTP_Get_Tracklisting_With_Callback(self.device, None, None)
-            while bool(track) :
-                self.tracks_by_id[track.contents.item_id] = Track(track.contents, self)
-                next = track.contents.next
-                mtp.LIBMTP_destroy_track_t(track)
-                track = next
-            #end while
+            for track in self.iter_tracks() :
+                pass
+            #end for
+        else :
+            self.metrics.cache_lookup("tracks", True)
         #end if
     #end _ensure_got_tracks
 
     def _ensure_got_playlists(self) :
         self._ensure_got_descendants() # doesn't seem to work otherwise
+        self.metrics.cache_lookup("playlists", self.playlists_by_id != None)
         if self.playlists_by_id == None :
             self.playlists_by_id = {}
-            playlist = mtp.LIBMTP_Get_Playlist_List(self.device)
+            start = time.monotonic()
+            playlist = self.lib.LIBMTP_Get_Playlist_List(self.device)
+            self.metrics.add_enumeration("playlists", time.monotonic() - start)
             while bool(playlist) :
                 self.playlists_by_id[playlist.contents.playlist_id] = Playlist(playlist.contents, self)
-                next = playlist.contents.next
-                mtp.LIBMTP_destroy_playlist_t(playlist)
+                next = ct.cast(playlist.contents.next, ct.POINTER(playlist_t))
+                  # copy pointer value before its containing struct is freed
+                self.lib.LIBMTP_destroy_playlist_t(playlist)
                 playlist = next
             #end while
         #end if
@@ -1158,13 +2364,17 @@ class Device() :
 
     def _ensure_got_albums(self) :
         self._ensure_got_descendants() # doesn't seem to work otherwise
+        self.metrics.cache_lookup("albums", self.albums_by_id != None)
         if self.albums_by_id == None :
             self.albums_by_id = {}
-            album = mtp.LIBMTP_Get_Album_List(self.device)
+            start = time.monotonic()
+            album = self.lib.LIBMTP_Get_Album_List(self.device)
+            self.metrics.add_enumeration("albums", time.monotonic() - start)
             while bool(album) :
                 self.albums_by_id[album.contents.album_id] = Album(album.contents, self)
-                next = album.contents.next
-                mtp.LIBMTP_destroy_album_t(album)
+                next = ct.cast(album.contents.next, ct.POINTER(album_t))
+                  # copy pointer value before its containing struct is freed
+                self.lib.LIBMTP_destroy_album_t(album)
                 album = next
             #end while
         #end if
@@ -1172,10 +2382,16 @@ class Device() :
 
     # higher-level access to device contents
 
-    def get_children(self) :
-        """returns all the files and folders at the root level of the device."""
+    def get_children(self, prefetch = None) :
+        """returns all the files and folders at the root level of the device.
+        prefetch is an optional sequence of properties, as for get_properties,
+        to be fetched into the property cache for all the children."""
         self._ensure_got_descendants()
-        return list(self.children_by_name.values())
+        result = list(self.children_by_name.values())
+        if prefetch != None :
+            self.get_properties((item.item_id for item in result), prefetch)
+        #end if
+        return result
     #end get_children
 
     def get_descendants(self) :
@@ -1232,6 +2448,48 @@ class Device() :
         return list(self.tracks_by_id.values())
     #end get_tracks
 
+    def iter_tracks(self, progress = None) :
+        """generator which yields the Track objects for all the tracks on the device.
+        If they are not already cached, then progress(sofar, total), if specified,
+        is called periodically while libmtp fetches the track list (its return
+        value is ignored, since the fetch cannot be cancelled), after which the
+        Track objects are yielded as the list is consumed. If the caller stops
+        early, the rest of the list is freed, and the cache is only filled in if
+        the iteration runs to completion."""
+        self._ensure_got_descendants() # doesn't seem to work otherwise
+        self.metrics.cache_lookup("tracks", self.tracks_by_id != None)
+        if self.tracks_by_id != None :
+            yield from list(self.tracks_by_id.values())
+        else :
+            update_seq = self.update_seq
+            tracks_by_id = {}
+            progress_func = common_progress_func(progress)
+            start = time.monotonic()
+            track = self.lib.LIBMTP_Get_Tracklisting_With_Callback(self.device, progress_func, None)
+            self.metrics.add_enumeration("tracks", time.monotonic() - start)
+            try :
+                while bool(track) :
+                    result = Track(track.contents, self)
+                    next = ct.cast(track.contents.next, ct.POINTER(track_t))
+                      # copy pointer value before its containing struct is freed
+                    self.lib.LIBMTP_destroy_track_t(track)
+                    track = next
+                    tracks_by_id[result.item_id] = result
+                    yield result
+                #end while
+            finally :
+                while bool(track) :
+                    next = ct.cast(track.contents.next, ct.POINTER(track_t))
+                    self.lib.LIBMTP_destroy_track_t(track)
+                    track = next
+                #end while
+            #end try
+            if self.update_seq == update_seq :
+                self.tracks_by_id = tracks_by_id
+            #end if
+        #end if
+    #end iter_tracks
+
     def get_track_by_id(self, id) :
         """returns a track on the device identified by device-wide ID,
         or None if not found."""
@@ -1239,6 +2497,92 @@ class Device() :
         return self.tracks_by_id.get(id)
     #end get_track_by_id
 
+    # Secondary indexes over tracks. These are built on first use from
+    # tracks_by_id, and rebuilt whenever that is reloaded.
+
+    track_index_fields = ("artist", "album", "genre")
+
+    def _ensure_got_track_indexes(self) :
+        self._ensure_got_tracks()
+        if self.track_indexes_for is not self.tracks_by_id :
+            self.track_indexes = dict((field, {}) for field in self.track_index_fields)
+            self.track_indexes["filename"] = []
+            self.track_indexes_for = self.tracks_by_id
+            for track in self.tracks_by_id.values() :
+                self._index_track(track, False)
+            #end for
+            self.track_indexes["filename"].sort()
+        #end if
+    #end _ensure_got_track_indexes
+
+    def _index_track(self, track, keep_sorted) :
+        # adds a Track to the secondary indexes.
+        for field in self.track_index_fields :
+            self.track_indexes[field].setdefault(getattr(track, field, None), []).append(track)
+        #end for
+        entry = (getattr(track, "filename", ""), track.item_id)
+        if keep_sorted :
+            bisect.insort(self.track_indexes["filename"], entry)
+        else :
+            self.track_indexes["filename"].append(entry)
+        #end if
+    #end _index_track
+
+    def _cache_add_track(self, track) :
+        # adds a single new Track to the cache and its indexes, if loaded.
+        if self.tracks_by_id != None :
+            if track.item_id in self.tracks_by_id :
+                self.track_indexes_for = None # replacing entry, rebuild indexes
+            #end if
+            self.tracks_by_id[track.item_id] = track
+            if self.track_indexes_for is self.tracks_by_id :
+                self._index_track(track, True)
+            #end if
+        #end if
+    #end _cache_add_track
+
+    def get_tracks_by_artist(self, artist) :
+        """returns a list of all the tracks with the specified artist (None for
+        tracks with no artist set)."""
+        self._ensure_got_track_indexes()
+        return list(self.track_indexes["artist"].get(artist, ()))
+    #end get_tracks_by_artist
+
+    def get_tracks_by_album(self, album) :
+        """returns a list of all the tracks with the specified album name (None for
+        tracks with no album set)."""
+        self._ensure_got_track_indexes()
+        return list(self.track_indexes["album"].get(album, ()))
+    #end get_tracks_by_album
+
+    def get_tracks_by_genre(self, genre) :
+        """returns a list of all the tracks with the specified genre (None for
+        tracks with no genre set)."""
+        self._ensure_got_track_indexes()
+        return list(self.track_indexes["genre"].get(genre, ()))
+    #end get_tracks_by_genre
+
+    def get_track_field_values(self, field) :
+        """returns a sorted list of the distinct non-None values of the specified
+        track field, one of "artist", "album" or "genre"."""
+        self._ensure_got_track_indexes()
+        return sorted(k for k in self.track_indexes[field] if k != None)
+    #end get_track_field_values
+
+    def get_tracks_by_filename_prefix(self, prefix) :
+        """returns a list of all the tracks whose filenames begin with prefix,
+        sorted by filename."""
+        self._ensure_got_track_indexes()
+        filenames = self.track_indexes["filename"]
+        result = []
+        pos = bisect.bisect_left(filenames, (prefix,))
+        while pos < len(filenames) and filenames[pos][0].startswith(prefix) :
+            result.append(self.tracks_by_id[filenames[pos][1]])
+            pos += 1
+        #end while
+        return result
+    #end get_tracks_by_filename_prefix
+
     def get_playlists(self) :
         self._ensure_got_playlists()
         return list(self.playlists_by_id.values())
@@ -1263,21 +2607,34 @@ class Device() :
         return self.albums_by_id.get(id)
     #end get_album_by_id
 
-    def send_file(self, src, destname) :
+    def send_file(self, src, destname, progress = None) :
         """sends the specified file to the device under the specified name
-        at the top level, and returns a new File object for it."""
+        at the top level, and returns a new File object for it. If specified,
+        progress(sent, total) is called periodically during the transfer, and can
+        return True to cancel it."""
         # should I allow default destname here as well?
-        return common_send_file(self, src, 0, destname)
+        return common_send_file(self, src, 0, destname, progress = progress)
     #end send_file
 
-    def retrieve_to_folder(self, dest) :
-        common_retrieve_to_folder(self, dest)
+    def retrieve_to_folder(self, dest, check_space = True, retry = None) :
+        common_retrieve_to_folder(self, dest, check_space, retry)
     #end retrieve_to_folder
 
+    def retrieve_to_archive(self, fileobj, format = "tar", arcname = None, compression = None) :
+        """writes the entire contents of this Device/Folder to fileobj as a tar
+        or zip archive (format is "tar" or "zip"), streaming each file straight
+        from the device into the archive. Entry names are relative to this folder,
+        prefixed with arcname, which defaults to the folder name. For compressed
+        tar archives, pass a compressing fileobj such as a gzip.GzipFile;
+        compression (a zipfile.ZIP_xxx value, default ZIP_STORED) applies to
+        zip archives only. fileobj is not closed."""
+        common_retrieve_to_archive(self, fileobj, format, arcname, compression)
+    #end retrieve_to_archive
+
     def create_folder(self, name, storageid = 0) :
         """creates a folder with the specified name at the root level of the
         device, and returns a Folder object representing it."""
-        folderid = mtp.LIBMTP_Create_Folder \
+        folderid = self.lib.LIBMTP_Create_Folder \
           (
             self.device,
             name.encode("utf-8"),
@@ -1285,8 +2642,8 @@ class Device() :
             storageid
           )
         if folderid == 0 :
-            mtp.LIBMTP_Dump_Errorstack(self.device)
-            mtp.LIBMTP_Clear_Errorstack(self.device)
+            self.lib.LIBMTP_Dump_Errorstack(self.device)
+            self.lib.LIBMTP_Clear_Errorstack(self.device)
             raise Error(ERROR_GENERAL)
         #end if
         self.set_contents_changed()
@@ -1294,12 +2651,9 @@ class Device() :
     #end create_folder
 
     def get_string_from_object(self, objectid, propertyid) :
-        resultstr = mtp.LIBMTP_Get_String_From_Object(self.device, objectid, propertyid)
-        if bool(resultstr) :
-            result = bytes(ct.cast(resultstr, ct.c_char_p)).decode("utf-8")
-            libc.free(resultstr)
-        else :
-            result = None
+        result = common_take_string(self.lib.LIBMTP_Get_String_From_Object(self.device, objectid, propertyid))
+        if result != None :
+            result = result.decode("utf-8")
         #end if
         return result
     #end get_string_from_object
@@ -1308,10 +2662,10 @@ class Device() :
         return \
             (
                 {
-                    8 : mtp.LIBMTP_Get_u8_From_Object,
-                    16 : mtp.LIBMTP_Get_u16_From_Object,
-                    32 : mtp.LIBMTP_Get_u32_From_Object,
-                    64 : mtp.LIBMTP_Get_u64_From_Object,
+                    8 : self.lib.LIBMTP_Get_u8_From_Object,
+                    16 : self.lib.LIBMTP_Get_u16_From_Object,
+                    32 : self.lib.LIBMTP_Get_u32_From_Object,
+                    64 : self.lib.LIBMTP_Get_u64_From_Object,
                 }[bitsize]
                   (
                     self.device,
@@ -1326,9 +2680,9 @@ class Device() :
         check_status \
           (
                 {
-                    8 : mtp.LIBMTP_Set_Object_u8,
-                    16 : mtp.LIBMTP_Set_Object_u16,
-                    32 : mtp.LIBMTP_Set_Object_u32,
+                    8 : self.lib.LIBMTP_Set_Object_u8,
+                    16 : self.lib.LIBMTP_Set_Object_u16,
+                    32 : self.lib.LIBMTP_Set_Object_u32,
                     # 64 : mtp.LIBMTP_Set_Object_u64, # doesn't exist!?
                 }[bitsize]
                   (
@@ -1338,6 +2692,7 @@ class Device() :
                     newvalue
                   )
           )
+        self._cache_property(objectid, propertyid, newvalue)
     #end set_object_int
 
     def get_string_property(self, propertyid) :
@@ -1351,7 +2706,7 @@ class Device() :
     def set_object_string(self, objectid, propertyid, newvalue) :
         check_status \
           (
-            mtp.LIBMTP_Set_Object_String
+            self.lib.LIBMTP_Set_Object_String
               (
                 self.device,
                 objectid,
@@ -1359,8 +2714,78 @@ class Device() :
                 newvalue.encode("utf-8")
               )
           )
+        self._cache_property(objectid, propertyid, newvalue)
     #end set_object_string
 
+    def _cache_property(self, objectid, propertyid, value) :
+        # updates the cached property value, if the object has any cached.
+        props = self.properties_by_id.get(objectid)
+        if props != None :
+            props[propertyid] = value
+        #end if
+    #end _cache_property
+
+    def get_properties(self, objectids, props, default = 0) :
+        """returns the values of the specified properties for all the specified
+        object IDs, as a dict of dicts keyed by object ID then property ID. Each
+        element of props is either a property ID listed in property_bitsize, or a
+        tuple (property ID, bitsize), where bitsize is None for a string property.
+        default is used for integer properties the object does not have. Values
+        are remembered per object until set_contents_changed is called, and ones
+        already held in cached File/Folder objects are taken from there, so only
+        properties not seen before require a round-trip to the device."""
+        props = tuple \
+          (
+            (lambda p : (p, property_bitsize[p]), tuple)[isinstance(prop, tuple)](prop)
+            for prop in props
+          )
+        result = {}
+        for objectid in objectids :
+            cached = self.properties_by_id.get(objectid)
+            if cached == None :
+                cached = {}
+                item = None
+                if self.descendants_by_id != None :
+                    item = self.descendants_by_id.get(objectid)
+                #end if
+                if item != None and item is not self :
+                    cached[PROPERTY_StorageID] = item.storage_id
+                    cached[PROPERTY_ParentObject] = item.parent_id
+                    cached[PROPERTY_ObjectFileName] = item.name
+                    if isinstance(item, File) :
+                        cached[PROPERTY_ObjectSize] = item.filesize
+                    #end if
+                #end if
+                self.properties_by_id[objectid] = cached
+            #end if
+            values = {}
+            for propertyid, bitsize in props :
+                self.metrics.cache_lookup("properties", propertyid in cached)
+                if propertyid not in cached :
+                    if bitsize != None :
+                        cached[propertyid] = self.get_int_from_object(objectid, propertyid, bitsize, default)
+                    else :
+                        cached[propertyid] = self.get_string_from_object(objectid, propertyid)
+                    #end if
+                #end if
+                values[propertyid] = cached[propertyid]
+            #end for
+            result[objectid] = values
+        #end for
+        return result
+    #end get_properties
+
+    def get_property(self, objectid, prop, default = 0) :
+        """returns a single property value for the specified object ID, using
+        the same cache as get_properties."""
+        if isinstance(prop, tuple) :
+            propertyid = prop[0]
+        else :
+            propertyid = prop
+        #end if
+        return self.get_properties((objectid,), (prop,), default)[objectid][propertyid]
+    #end get_property
+
     def set_string_property(self, propertyid, newvalue) :
         self.set_object_string(0, propertyid, newvalue)
     #end set_string_property
@@ -1370,19 +2795,37 @@ class Device() :
     #end set_int_property
 
     def is_property_supported(self, propid, filetypeid) :
-        return \
-            (
-                mtp.LIBMTP_Is_Property_Supported(self.device, propid, filetypeid)
-            !=
-                0
-            )
+        key = (propid, filetypeid)
+        result = self.capabilities["property_supported"].get(key)
+        if result == None :
+            status = self.lib.LIBMTP_Is_Property_Supported(self.device, propid, filetypeid)
+            if status < 0 :
+                # error, don't remember the answer
+                self.lib.LIBMTP_Clear_Errorstack(self.device)
+                result = False
+            else :
+                result = status != 0
+                self.capabilities["property_supported"][key] = result
+                self.capabilities_dirty = True
+            #end if
+        #end if
+        return result
     #end is_property_supported
 
     def get_allowed_property_values(self, propid, filetypeid) :
-        with LeakProtect(ct.pointer(allowed_values_t()), mtp.LIBMTP_destroy_allowed_values_t) as allowed :
+        key = (propid, filetypeid)
+        if key not in self.capabilities["allowed_values"] :
+            self.capabilities["allowed_values"][key] = self._get_allowed_property_values(propid, filetypeid)
+            self.capabilities_dirty = True
+        #end if
+        return dict(self.capabilities["allowed_values"][key])
+    #end get_allowed_property_values
+
+    def _get_allowed_property_values(self, propid, filetypeid) :
+        with LeakProtect(ct.pointer(allowed_values_t()), self.lib.LIBMTP_destroy_allowed_values_t) as allowed :
             check_status \
               (
-                mtp.LIBMTP_Get_Allowed_Property_Values
+                self.lib.LIBMTP_Get_Allowed_Property_Values
                   (
                     self.device,
                     propid,
@@ -1402,7 +2845,7 @@ class Device() :
             #end if
         #end with
         return result
-    #end get_allowed_property_values
+    #end _get_allowed_property_values
 
     def send_track \
       (
@@ -1419,6 +2862,7 @@ class Device() :
         date = None,
         duration = 0,
         rating = 0,
+        progress = None,
       ) :
         parentname, childname = os.path.split(destpath)
         parent = self.get_descendant_by_path(parentname)
@@ -1426,7 +2870,7 @@ class Device() :
             raise RuntimeError("cannot find parent folder %s" % parentname)
         #end if
         if len(childname) != 0 :
-            child = parent.find_child_by_name(childname)
+            child = parent.get_child_by_name(childname)
         else :
             child = None
         #end if
@@ -1457,21 +2901,157 @@ class Device() :
             date = date,
             duration = duration,
             rating = rating,
+            progress = progress,
           )
-        self.set_contents_changed()
-        return self.get_track_by_id(trackid)
+        return common_cache_new_track(self, trackid)
     #end send_track
 
+    def send_tracks \
+      (
+        self,
+        entries,
+        progress = None,
+        check_space = True,
+        build_albums = False,
+        playlist = None,
+        storageid = 0,
+      ) :
+        """uploads a batch of tracks. entries is a sequence of (src, metadata) pairs,
+        where metadata is a dict of keyword arguments as for send_track, which must
+        include "destpath" (the full pathname of the destination, whose parent
+        folder must already exist) and "filetype". Destination folders are looked
+        up once for the whole batch and the uploads are done back to back. Returns
+        a list with an element for each entry, which is the new Track object, or
+        the exception that caused that upload to fail, or None if it was not
+        attempted because the batch was cancelled.
+
+        If specified, progress(index, sent, total) is called periodically during
+        the upload of entries[index], and can return True to cancel the rest of
+        the batch. Unless check_space is False, the total size of the files is
+        checked against the free space on each destination storage first, and
+        Error(ERROR_STORAGE_FULL) raised before anything is sent if there is not
+        enough room. If build_albums, then afterwards the uploaded tracks are added
+        to Albums named after their "album" metadata, which are created as
+        necessary. If playlist is a Playlist object or the name of a new one, the
+        uploaded tracks are appended to it. Each album or playlist is written to
+        the device once."""
+        parents = {}
+        prepared = []
+        needed = {}
+        for src, metadata in entries :
+            metadata = dict(metadata)
+            destpath = metadata.pop("destpath")
+            parentname, destname = os.path.split(destpath)
+            if len(destname) == 0 :
+                destname = os.path.basename(src)
+            #end if
+            if parentname not in parents :
+                parents[parentname] = self.get_descendant_by_path(parentname)
+            #end if
+            parent = parents[parentname]
+            if parent != None :
+                track_storageid = metadata.pop("storageid", storageid) or getattr(parent, "storage_id", 0)
+                  # parent is the Device itself for root-level destpath
+                if track_storageid == 0 :
+                    track_storageid = self.get_storage_by_id(0)["id"]
+                #end if
+                size, count = needed.get(track_storageid, (0, 0))
+                needed[track_storageid] = (size + os.stat(src).st_size, count + 1)
+            else :
+                track_storageid = None
+            #end if
+            prepared.append((src, parentname, parent, destname, track_storageid, metadata))
+        #end for
+        if check_space :
+            for track_storageid in needed :
+                common_check_device_space(self, track_storageid, *needed[track_storageid])
+            #end for
+        #end if
+        results = [None] * len(prepared)
+        cancelled = False
+        for index, (src, parentname, parent, destname, track_storageid, metadata) in enumerate(prepared) :
+            if progress != None :
+                track_progress = \
+                    lambda sent, total : progress(index, sent, total)
+            else :
+                track_progress = None
+            #end if
+            try :
+                if parent == None :
+                    raise RuntimeError("cannot find parent folder %s" % parentname)
+                #end if
+                trackid = common_send_track \
+                  (
+                    device = self,
+                    src = src,
+                    parentid = parent.item_id,
+                    destname = destname,
+                    storageid = track_storageid,
+                    progress = track_progress,
+                    **metadata
+                  )
+                results[index] = common_cache_new_track(self, trackid)
+            except (RuntimeError, OSError) as Err : # includes Error
+                results[index] = Err
+                cancelled = isinstance(Err, Error) and Err.code == ERROR_CANCELLED
+            #end try
+            if cancelled :
+                break
+            #end if
+        #end for
+        uploaded = list \
+          (
+            (track, metadata)
+            for track, (src, parentname, parent, destname, track_storageid, metadata) in
+                zip(results, prepared)
+            if isinstance(track, Track)
+          )
+        if build_albums :
+            albums = {}
+            for album in self.get_albums() :
+                albums.setdefault(album.name, album)
+            #end for
+            editors = {}
+            for track, metadata in uploaded :
+                name = metadata.get("album")
+                if name != None :
+                    if name not in editors :
+                        if name not in albums :
+                            albums[name] = self.create_album \
+                              (
+                                name = name,
+                                storageid = track.storage_id,
+                                artist = metadata.get("artist"),
+                                composer = metadata.get("composer"),
+                                genre = metadata.get("genre"),
+                              )
+                        #end if
+                        editors[name] = albums[name].edit()
+                    #end if
+                    editors[name].append(track)
+                #end if
+            #end for
+            for editor in editors.values() :
+                editor.commit()
+            #end for
+        #end if
+        if playlist != None and len(uploaded) != 0 :
+            if not isinstance(playlist, Playlist) :
+                playlist = self.create_playlist(playlist, uploaded[0][0].storage_id)
+            #end if
+            with playlist.edit() as editor :
+                editor.extend(track for track, metadata in uploaded)
+            #end with
+        #end if
+        return results
+    #end send_tracks
+
     def create_playlist(self, name, storageid = 0) :
-        playlistid = common_create_playlist(self, 0, name, storageid)
-        self.set_contents_changed()
-        return self.get_playlist_by_id(playlistid)
+        return common_create_playlist(self, 0, name, storageid)
     #end create_playlist
 
     def create_album(self, name, storageid = 0, artist = None, composer = None, genre = None) :
-        albumid = common_create_album(self, 0, name, storageid, artist, composer, genre)
-        self.set_contents_changed()
-        return self.get_album_by_id(albumid)
+        return common_create_album(self, 0, name, storageid, artist, composer, genre)
     #end create_album
 
 #end Device
@@ -1504,35 +3084,122 @@ class File :
         return self.device.get_descendant_by_id(self.parent_id)
     #end get_parent
 
-    def retrieve_to_file(self, destname) :
+    def retrieve_to_file(self, destname, progress = None) :
         """copies the contents of the file to the host filesystem under the
-        specified name."""
+        specified name. Space for the whole file is reserved before the transfer
+        starts, and the partial file is removed if the transfer fails. If specified,
+        progress(sent, total) is called periodically during the transfer, and can
+        return True to cancel it."""
         if os.path.isdir(destname) :
             destname = os.path.join(destname, self.name)
         #end if
+        progress_func = common_progress_func(progress)
+        fd = os.open(destname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try :
+            common_preallocate(fd, self.filesize)
+            start = time.monotonic()
+            check_status \
+              (
+                self.device.lib.LIBMTP_Get_File_To_File_Descriptor
+                  (
+                    self.device.device,
+                    self.item_id,
+                    fd,
+                    progress_func,
+                    None # progress arg
+                  ),
+                self.device.device,
+                self.device.lib
+              )
+            nr_bytes = os.lseek(fd, 0, os.SEEK_CUR)
+            self.device.metrics.add_transfer("retrieved", nr_bytes, time.monotonic() - start)
+            os.ftruncate(fd, nr_bytes)
+              # in case actual size differs from preallocated size
+        except :
+            os.close(fd)
+            os.unlink(destname)
+            raise
+        #end try
+        os.close(fd)
+        os.utime(destname, 2 * (self.modificationdate,))
+    #end retrieve_to_file
+
+    def retrieve_to_stream(self, out, progress = None) :
+        """copies the contents of the file to the host, passing it in pieces to
+        out.write() as it arrives. If specified, progress(sent, total) is called
+        periodically during the transfer, and can return True to cancel it."""
+        progress_func = common_progress_func(progress)
+        failed = []
+        nr_bytes = [0]
+
+        def put_func(params, priv, sendlen, data, putlen) :
+            try :
+                out.write(ct.string_at(data, sendlen))
+            except Exception as Err :
+                failed.append(Err)
+                return HANDLER_RETURN_ERROR
+            #end try
+            putlen[0] = sendlen
+            nr_bytes[0] += sendlen
+            return HANDLER_RETURN_OK
+        #end put_func
+
+        start = time.monotonic()
+        status = self.device.lib.LIBMTP_Get_File_To_Handler \
+          (
+            self.device.device,
+            self.item_id,
+            dataputfunc_t(put_func),
+            None, # priv
+            progress_func,
+            None # progress arg
+          )
+        if len(failed) != 0 :
+            self.device.lib.LIBMTP_Clear_Errorstack(self.device.device)
+            raise failed[0]
+        #end if
+        check_status(status, self.device.device, self.device.lib)
+        self.device.metrics.add_transfer("retrieved", nr_bytes[0], time.monotonic() - start)
+    #end retrieve_to_stream
+
+    def read_partial(self, offset, size) :
+        """returns up to size bytes of the file contents starting at the specified
+        offset, without retrieving the rest of the file. Returns fewer bytes at
+        end of file. Not all devices support this."""
+        data = ct.POINTER(ct.c_ubyte)()
+        datalen = ct.c_uint(0)
+        start = time.monotonic()
         check_status \
           (
-            mtp.LIBMTP_Get_File_To_File
+            self.device.lib.LIBMTP_GetPartialObject
               (
                 self.device.device,
                 self.item_id,
-                destname.encode("utf-8"),
-                None, # progress
-                None # progress arg
+                offset,
+                min(size, 0xffffffff),
+                ct.byref(data),
+                ct.byref(datalen)
               ),
-            self.device.device
+            self.device.device,
+            self.device.lib
           )
-        os.utime(destname, 2 * (self.modificationdate,))
-    #end retrieve_to_file
+        try :
+            result = ct.string_at(data, datalen.value)
+        finally :
+            libc.free(data)
+        #end try
+        self.device.metrics.add_transfer("retrieved", len(result), time.monotonic() - start, nr_files = 0)
+        return result
+    #end read_partial
 
     def set_name(self, newname) :
         """changes the name of the file."""
-        with LeakProtect(mtp.LIBMTP_new_file_t(), mtp.LIBMTP_destroy_file_t) as item :
+        with LeakProtect(self.device.lib.LIBMTP_new_file_t(), self.device.lib.LIBMTP_destroy_file_t) as item :
             item.contents.item_id = self.item_id
             item.contents.parent_id = self.parent_id
             check_status \
               (
-                mtp.LIBMTP_Set_File_Name
+                self.device.lib.LIBMTP_Set_File_Name
                   (
                     self.device.device,
                     item,
@@ -1544,6 +3211,20 @@ class File :
         self.device.set_contents_changed()
     #end set_name
 
+    def move_to(self, dest) :
+        """moves the file into the specified Folder, or to the root level of the
+        specified Device, without transferring its contents to/from the host."""
+        common_move_object(self, dest)
+    #end move_to
+
+    def copy_to(self, dest) :
+        """makes a copy of the file in the specified Folder, or at the root level
+        of the specified Device, without transferring its contents to/from the
+        host. Returns the File object for the copy, or None if it cannot be
+        identified (in which case the cache of device contents is reloaded)."""
+        return common_copy_object(self, dest)
+    #end copy_to
+
     def get_string_property(self, propertyid) :
         return self.device.get_string_from_object(self.item_id, propertyid)
     #end get_string_property
@@ -1566,12 +3247,13 @@ class File :
         # delete_descendants ignored, allowed for compatibility with Folder.delete
         check_status \
           (
-            mtp.LIBMTP_Delete_Object
+            self.device.lib.LIBMTP_Delete_Object
               (
                 self.device.device,
                 self.item_id
               ),
-            self.device.device
+            self.device.device,
+            self.device.lib
           )
         self.device.set_contents_changed()
         # make myself unusable:
@@ -1609,6 +3291,11 @@ class Folder :
     #end __repr__
 
     def _ensure_got_children(self) :
+        self.device.metrics.cache_lookup \
+          (
+            "folder_children",
+            self.children_by_name != None and self.update_seq == self.device.update_seq
+          )
         if self.children_by_name == None or self.update_seq != self.device.update_seq :
             self.device._ensure_got_descendants()
             self.children_by_name = dict \
@@ -1632,10 +3319,16 @@ class Folder :
 
     # higher-level access to device contents
 
-    def get_children(self) :
-        """returns all the immediate child files and folders of this folder."""
+    def get_children(self, prefetch = None) :
+        """returns all the immediate child files and folders of this folder.
+        prefetch is an optional sequence of properties, as for Device.get_properties,
+        to be fetched into the property cache for all the children."""
         self._ensure_got_children()
-        return list(self.children_by_name.values())
+        result = list(self.children_by_name.values())
+        if prefetch != None :
+            self.device.get_properties((item.item_id for item in result), prefetch)
+        #end if
+        return result
     #end get_children
 
     def get_child_by_name(self, name) :
@@ -1645,23 +3338,36 @@ class Folder :
         return self.children_by_name.get(name)
     #end get_child_by_name
 
-    def retrieve_to_folder(self, dest) :
-        common_retrieve_to_folder(self, dest)
+    def retrieve_to_folder(self, dest, check_space = True, retry = None) :
+        common_retrieve_to_folder(self, dest, check_space, retry)
     #end retrieve_to_folder
 
-    def send_file(self, src, destname = None) :
+    def retrieve_to_archive(self, fileobj, format = "tar", arcname = None, compression = None) :
+        """writes the entire contents of this Device/Folder to fileobj as a tar
+        or zip archive (format is "tar" or "zip"), streaming each file straight
+        from the device into the archive. Entry names are relative to this folder,
+        prefixed with arcname, which defaults to the folder name. For compressed
+        tar archives, pass a compressing fileobj such as a gzip.GzipFile;
+        compression (a zipfile.ZIP_xxx value, default ZIP_STORED) applies to
+        zip archives only. fileobj is not closed."""
+        common_retrieve_to_archive(self, fileobj, format, arcname, compression)
+    #end retrieve_to_archive
+
+    def send_file(self, src, destname = None, progress = None) :
         """sends the specified file to the device under the specified name within
-        this Folder, and returns a new File object for it."""
+        this Folder, and returns a new File object for it. If specified,
+        progress(sent, total) is called periodically during the transfer, and can
+        return True to cancel it."""
         if destname == None :
             destname = os.path.basename(src)
         #end if
-        return common_send_file(self.device, src, self.item_id, destname)
+        return common_send_file(self.device, src, self.item_id, destname, self.storage_id, progress)
     #end send_file
 
     def create_folder(self, name, storageid = 0) :
         """creates a folder with the specified name at the top level of this
         Folder, and returns a Folder object representing it."""
-        folderid = mtp.LIBMTP_Create_Folder \
+        folderid = self.device.lib.LIBMTP_Create_Folder \
           (
             self.device.device,
             name.encode("utf-8"),
@@ -1669,8 +3375,8 @@ class Folder :
             storageid
           )
         if folderid == 0 :
-            mtp.LIBMTP_Dump_Errorstack(self.device.device)
-            mtp.LIBMTP_Clear_Errorstack(self.device.device)
+            self.device.lib.LIBMTP_Dump_Errorstack(self.device.device)
+            self.device.lib.LIBMTP_Clear_Errorstack(self.device.device)
             raise Error(ERROR_GENERAL)
         #end if
         self.device.set_contents_changed()
@@ -1679,12 +3385,12 @@ class Folder :
 
     def set_name(self, newname) :
         """changes the name of the folder."""
-        with LeakProtect(mtp.LIBMTP_new_folder_t(), mtp.LIBMTP_destroy_folder_t) as item :
+        with LeakProtect(self.device.lib.LIBMTP_new_folder_t(), self.device.lib.LIBMTP_destroy_folder_t) as item :
             item.contents.item_id = self.item_id
             item.contents.parent_id = self.parent_id
             check_status \
               (
-                mtp.LIBMTP_Set_Folder_Name
+                self.device.lib.LIBMTP_Set_Folder_Name
                   (
                     self.device.device,
                     item,
@@ -1696,6 +3402,22 @@ class Folder :
         self.device.set_contents_changed()
     #end set_name
 
+    def move_to(self, dest) :
+        """moves the folder and all its contents into the specified Folder, or to
+        the root level of the specified Device, without transferring anything
+        to/from the host."""
+        common_move_object(self, dest)
+    #end move_to
+
+    def copy_to(self, dest) :
+        """makes a copy of the folder and all its contents in the specified Folder,
+        or at the root level of the specified Device, without transferring anything
+        to/from the host. Returns the Folder object for the copy, or None if it
+        cannot be identified (in which case the cache of device contents is
+        reloaded)."""
+        return common_copy_object(self, dest)
+    #end copy_to
+
     def get_string_property(self, propertyid) :
         return self.device.get_string_from_object(self.item_id, propertyid)
     #end get_string_property
@@ -1727,12 +3449,13 @@ class Folder :
         #end if
         check_status \
           (
-            mtp.LIBMTP_Delete_Object
+            self.device.lib.LIBMTP_Delete_Object
               (
                 self.device.device,
                 self.item_id
               ),
-            self.device.device
+            self.device.device,
+            self.device.lib
           )
         self.set_contents_changed()
         # make myself unusable:
@@ -1756,6 +3479,7 @@ class Folder :
         date = None,
         duration = 0,
         rating = 0,
+        progress = None,
       ) :
         trackid = common_send_track \
           (
@@ -1773,21 +3497,17 @@ class Folder :
             date = date,
             duration = duration,
             rating = rating,
+            progress = progress,
           )
-        self.device.set_contents_changed()
-        return self.device.get_track_by_id(trackid)
+        return common_cache_new_track(self.device, trackid)
       #end send_track
 
     def create_playlist(self, name, storageid = 0) :
-        playlistid = common_create_playlist(self.device, self.item_id, name, storageid)
-        self.device.set_contents_changed()
-        return self.device.get_playlist_by_id(playlistid)
+        return common_create_playlist(self.device, self.item_id, name, storageid or self.storage_id)
     #end create_playlist
 
     def create_album(self, name, storageid = 0, artist = None, composer = None, genre = None) :
-        albumid = common_create_album(self.device, self.item_id, name, storageid, artist, composer, genre)
-        self.device.set_contents_changed()
-        return self.device.get_album_by_id(albumid)
+        return common_create_album(self.device, self.item_id, name, storageid or self.storage_id, artist, composer, genre)
     #end create_album
 
 #end Folder
@@ -1816,18 +3536,19 @@ class Track :
         with \
             LeakProtect \
               (
-                mtp.LIBMTP_Get_Trackmetadata(self.device.device, self.item_id),
-                mtp.LIBMTP_destroy_track_t
+                self.device.lib.LIBMTP_Get_Trackmetadata(self.device.device, self.item_id),
+                self.device.lib.LIBMTP_destroy_track_t
               ) \
         as \
             track \
         :
             check_status \
               (
-                mtp.LIBMTP_Set_Track_Name(self.device.device, track, newname.encode("utf-8"))
+                self.device.lib.LIBMTP_Set_Track_Name(self.device.device, track, newname.encode("utf-8"))
               )
         #end with
         self.name = newname
+        self.device._cache_property(self.item_id, PROPERTY_Name, newname)
     #end set_name
 
     def delete(self) :
@@ -1858,27 +3579,7 @@ class Playlist :
     #end __init__
 
     def _update_tracks(self, new_tracks) :
-        with \
-            LeakProtect \
-              (
-                mtp.LIBMTP_Get_Playlist(self.device.device, self.item_id),
-                mtp.LIBMTP_destroy_playlist_t
-              ) \
-        as \
-            p \
-        :
-            libc.free(p.contents.tracks)
-            p.contents.no_tracks = len(new_tracks)
-            p.contents.tracks = ct.cast(libc.malloc(p.contents.no_tracks * ct.sizeof(ct.c_uint32)), ct.POINTER(ct.c_uint32))
-            for i in range(0, p.contents.no_tracks) :
-                p.contents.tracks[i] = new_tracks[i]
-            #end for
-            check_status \
-              (
-                mtp.LIBMTP_Update_Playlist(self.device.device, p)
-              )
-        #end with
-        self.tracks = new_tracks
+        common_update_track_list(self, new_tracks)
     #end _update_tracks
 
     def get_tracks(self) :
@@ -1891,6 +3592,12 @@ class Playlist :
         self._update_tracks(tuple(t.item_id for t in new_tracks))
     #end set_tracks
 
+    def edit(self) :
+        """returns a TrackListEditor for making a batch of changes to the contents
+        of this playlist, to be written back to the device in one go."""
+        return TrackListEditor(self)
+    #end edit
+
     def delete(self) :
         common_delete_object(self.device, self.item_id)
         # make myself unusable:
@@ -1911,34 +3618,21 @@ class Album :
     def __init__(self, a, device) :
         self.device = device
         self.item_id = a.album_id # consistent name
-        for attr in ("parent_id", "storage_id", "name", "artist", "composer", "genre") :
-            setattr(self, attr, getattr(a, attr).decode("utf-8"))
+        for attr in ("parent_id", "storage_id") :
+            setattr(self, attr, getattr(a, attr))
+        #end for
+        for attr in ("name", "artist", "composer", "genre") :
+            value = getattr(a, attr)
+            if value != None :
+                value = value.decode("utf-8")
+            #end if
+            setattr(self, attr, value)
         #end for
         self.tracks = tuple(a.tracks[i] for i in range(0, a.no_tracks))
     #end __init__
 
     def _update_tracks(self, new_tracks) :
-        with \
-            LeakProtect \
-              (
-                mtp.LIBMTP_Get_Album(self.device.device, self.item_id),
-                mtp.LIBMTP_destroy_album_t
-              ) \
-        as \
-            p \
-        :
-            libc.free(p.contents.tracks)
-            p.contents.no_tracks = len(new_tracks)
-            p.contents.tracks = ct.cast(libc.malloc(p.contents.no_tracks * ct.sizeof(ct.c_uint32)), ct.POINTER(ct.c_uint32))
-            for i in range(0, p.contents.no_tracks) :
-                p.contents.tracks[i] = new_tracks[i]
-            #end for
-            check_status \
-              (
-                mtp.LIBMTP_Update_Album(self.device.device, p)
-              )
-        #end with
-        self.tracks = new_tracks
+        common_update_track_list(self, new_tracks)
     #end _update_tracks
 
     def get_tracks(self) :
@@ -1951,6 +3645,12 @@ class Album :
         self._update_tracks(tuple(t.item_id for t in new_tracks))
     #end set_tracks
 
+    def edit(self) :
+        """returns a TrackListEditor for making a batch of changes to the contents
+        of this album, to be written back to the device in one go."""
+        return TrackListEditor(self)
+    #end edit
+
     def delete(self) :
         common_delete_object(self.device, self.item_id)
         # make myself unusable:
@@ -1964,19 +3664,1575 @@ class Album :
 
 #end Album
 
-def get_raw_devices() :
-    """returns a list of all MTP devices detected on the system."""
+class TrackListEditor :
+    """accumulates changes to the contents of a Playlist or Album, which are written
+    to the device in a single update by commit(). Don't create these yourself,
+    get them from the edit() method of the Playlist or Album. Can be used as a
+    context manager, which commits on normal exit and discards the changes if
+    an exception is raised. Tracks can be specified either as Track objects or
+    as track IDs."""
+
+    def __init__(self, owner) :
+        self.owner = owner
+        self.tracks = list(owner.tracks) # track IDs
+    #end __init__
+
+    @staticmethod
+    def _id(track) :
+        if isinstance(track, Track) :
+            track = track.item_id
+        #end if
+        return track
+    #end _id
+
+    def __len__(self) :
+        return len(self.tracks)
+    #end __len__
+
+    def get_tracks(self) :
+        """returns a list of Track objects for the edited contents."""
+        return list(self.owner.device.get_track_by_id(t) for t in self.tracks)
+    #end get_tracks
+
+    def append(self, track) :
+        self.tracks.append(self._id(track))
+    #end append
+
+    def extend(self, tracks) :
+        self.tracks.extend(self._id(t) for t in tracks)
+    #end extend
+
+    def insert(self, index, track) :
+        self.tracks.insert(index, self._id(track))
+    #end insert
+
+    def remove(self, track) :
+        """removes the first occurrence of the specified track."""
+        self.tracks.remove(self._id(track))
+    #end remove
+
+    def pop(self, index = -1) :
+        """removes and returns the ID of the track at the specified position."""
+        return self.tracks.pop(index)
+    #end pop
+
+    def move(self, from_index, to_index) :
+        """moves the track at position from_index so it ends up at to_index."""
+        self.tracks.insert(to_index, self.tracks.pop(from_index))
+    #end move
+
+    def sort(self, key, reverse = False) :
+        """reorders the tracks according to key, which is passed the Track objects."""
+        device = self.owner.device
+        self.tracks.sort(key = lambda t : key(device.get_track_by_id(t)), reverse = reverse)
+    #end sort
+
+    def is_changed(self) :
+        return tuple(self.tracks) != tuple(self.owner.tracks)
+    #end is_changed
+
+    def commit(self) :
+        """writes the changes, if any, to the device."""
+        if self.is_changed() :
+            self.owner._update_tracks(tuple(self.tracks))
+        #end if
+    #end commit
+
+    def __enter__(self) :
+        return self
+    #end __enter__
+
+    def __exit__(self, exception_type, exception_value, traceback) :
+        if exception_type == None :
+            self.commit()
+        #end if
+    #end __exit__
+
+#end TrackListEditor
+
+def get_raw_devices(lib = None) :
+    """returns a list of all MTP devices detected on the system. lib is the
+    backend to use, which defaults to libmtp; pass an mtpysim.SimulatedLibrary
+    to get simulated devices instead."""
+    if lib == None :
+        lib = mtp
+    #end if
     with LeakProtect(ct.POINTER(raw_device_t)(), libc.free) as devices :
         nr_devices = ct.c_int(0)
-        check_status(mtp.LIBMTP_Detect_Raw_Devices(ct.byref(devices), ct.byref(nr_devices)))
+        check_status(lib.LIBMTP_Detect_Raw_Devices(ct.byref(devices), ct.byref(nr_devices)))
         result = []
         for i in range(0, nr_devices.value) :
-            result.append(RawDevice(devices[i]))
+            result.append(RawDevice(devices[i], lib))
         #end for
     #end with
     return result
 #end get_raw_devices
 
-def get_property_description(propertyid) :
-    return bytes(mtp.LIBMTP_Get_Property_Description(propertyid)).decode("utf-8")
+def get_property_description(propertyid, lib = None) :
+    if lib == None :
+        lib = mtp
+    #end if
+    return bytes(lib.LIBMTP_Get_Property_Description(propertyid)).decode("utf-8")
 #end get_property_description
+
+#+
+# Tracing calls to libmtp
+#-
+
+class CallStats :
+    """accumulated statistics for the calls to a single libmtp function: the
+    number of calls, the total and maximum time taken, and the number of bytes
+    of file contents transferred. Percentiles are computed from the durations
+    of the most recent max_samples calls."""
+
+    def __init__(self, name, max_samples) :
+        self.name = name
+        self.max_samples = max_samples
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.nr_bytes = 0
+        self.samples = []
+    #end __init__
+
+    def add(self, elapsed, nr_bytes) :
+        if len(self.samples) < self.max_samples :
+            self.samples.append(elapsed)
+        else :
+            self.samples[self.count % self.max_samples] = elapsed
+        #end if
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.nr_bytes += nr_bytes
+    #end add
+
+    def percentile(self, pct) :
+        """returns the call duration (in seconds) below which pct percent of
+        the sampled calls fall."""
+        if len(self.samples) != 0 :
+            samples = sorted(self.samples)
+            result = samples[min(max(round(pct / 100 * len(samples)) - 1, 0), len(samples) - 1)]
+        else :
+            result = None
+        #end if
+        return result
+    #end percentile
+
+    def as_dict(self) :
+        if self.count != 0 :
+            mean_time = self.total_time / self.count
+        else :
+            mean_time = None
+        #end if
+        return \
+            {
+                "count" : self.count,
+                "total_time" : self.total_time,
+                "mean_time" : mean_time,
+                "p50_time" : self.percentile(50),
+                "p90_time" : self.percentile(90),
+                "p99_time" : self.percentile(99),
+                "max_time" : self.max_time,
+                "bytes" : self.nr_bytes,
+            }
+    #end as_dict
+
+#end CallStats
+
+class CallProfile :
+    """collects CallStats for each libmtp function called through a
+    TracingLibrary. Use TracingLibrary.profile() to obtain one for collecting
+    statistics over a block of code, as a context manager."""
+
+    def __init__(self, tracer = None, max_samples = 10000) :
+        self.tracer = tracer
+        self.max_samples = max_samples
+        self.stats = {} # keyed by function name
+    #end __init__
+
+    def add(self, name, elapsed, nr_bytes) :
+        stats = self.stats.get(name)
+        if stats == None :
+            stats = CallStats(name, self.max_samples)
+            self.stats[name] = stats
+        #end if
+        stats.add(elapsed, nr_bytes)
+    #end add
+
+    def __enter__(self) :
+        with self.tracer.lock :
+            self.tracer.profiles.append(self)
+        #end with
+        return self
+    #end __enter__
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        with self.tracer.lock :
+            self.tracer.profiles.remove(self)
+        #end with
+    #end __exit__
+
+    def as_dict(self) :
+        """returns the statistics as a dict keyed by function name, with
+        values as returned by CallStats.as_dict."""
+        return dict((name, stats.as_dict()) for name, stats in self.stats.items())
+    #end as_dict
+
+    def format(self) :
+        """returns the statistics as a human-readable table, the most
+        time-consuming functions first."""
+        lines = \
+            [
+                    "%-40s %8s %10s %10s %10s %10s %12s"
+                %
+                    ("function", "calls", "total s", "mean ms", "p50 ms", "p99 ms", "bytes")
+            ]
+        for stats in sorted(self.stats.values(), key = lambda s : s.total_time, reverse = True) :
+            lines.append \
+              (
+                    "%-40s %8d %10.3f %10.3f %10.3f %10.3f %12d"
+                %
+                    (
+                        stats.name,
+                        stats.count,
+                        stats.total_time,
+                        stats.total_time / stats.count * 1000,
+                        stats.percentile(50) * 1000,
+                        stats.percentile(99) * 1000,
+                        stats.nr_bytes,
+                    )
+              )
+        #end for
+        return "\n".join(lines) + "\n"
+    #end format
+
+#end CallProfile
+
+class TracingLibrary :
+    """wraps a libmtp backend (by default libmtp itself), timing every call made
+    through it and keeping statistics in self.totals, a CallProfile. Use it
+    by passing it to get_raw_devices or DevicePool, by assigning it to the lib
+    attribute of an existing Device, or by calling enable_tracing() to use it
+    for all devices obtained afterwards. Use profile() to collect separate
+    statistics for a block of code."""
+
+    def __init__(self, lib = None, max_samples = 10000) :
+        if lib == None :
+            lib = mtp
+        #end if
+        self.lib = lib
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.totals = CallProfile(self, max_samples)
+        self.profiles = []
+    #end __init__
+
+    def __getattr__(self, name) :
+        if name.startswith("__") :
+            raise AttributeError(name)
+        #end if
+        func = getattr(self.lib, name)
+
+        def traced(*args) :
+            return self._call(name, func, args)
+        #end traced
+
+    #begin __getattr__
+        setattr(self, name, traced)
+        return traced
+    #end __getattr__
+
+    def _call(self, name, func, args) :
+        # calls func with args, recording the time taken and any bytes transferred.
+        args = list(args)
+        nr_bytes = [0]
+        start_pos = None
+        if name in ("LIBMTP_Send_File_From_File", "LIBMTP_Send_Track_From_File") :
+            nr_bytes[0] = args[2].contents.filesize
+        elif name == "LIBMTP_Get_File_To_File_Descriptor" :
+            try :
+                start_pos = os.lseek(args[2], 0, os.SEEK_CUR)
+            except OSError :
+                pass # not seekable, don't know how much was transferred
+            #end try
+        elif name == "LIBMTP_Get_File_To_Handler" :
+            put_func = args[2]
+
+            def counting_put_func(params, priv, sendlen, data, putlen) :
+                status = put_func(params, priv, sendlen, data, putlen)
+                nr_bytes[0] += putlen[0]
+                return status
+            #end counting_put_func
+
+            args[2] = dataputfunc_t(counting_put_func)
+        #end if
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if name == "LIBMTP_GetPartialObject" :
+            nr_bytes[0] = args[5]._obj.value
+        elif start_pos != None :
+            nr_bytes[0] = os.lseek(args[2], 0, os.SEEK_CUR) - start_pos
+        elif name.startswith("LIBMTP_Send_") and result != 0 :
+            nr_bytes[0] = 0
+        #end if
+        with self.lock :
+            self.totals.add(name, elapsed, nr_bytes[0])
+            for profile in self.profiles :
+                profile.add(name, elapsed, nr_bytes[0])
+            #end for
+        #end with
+        return result
+    #end _call
+
+    def profile(self) :
+        """returns a new CallProfile which, when used as a context manager,
+        collects statistics for all the calls made during its block."""
+        return CallProfile(self, self.max_samples)
+    #end profile
+
+    def reset(self) :
+        """discards the statistics collected so far in self.totals."""
+        with self.lock :
+            self.totals = CallProfile(self, self.max_samples)
+        #end with
+    #end reset
+
+#end TracingLibrary
+
+def enable_tracing(max_samples = 10000) :
+    """wraps the default libmtp backend in a TracingLibrary, which is returned,
+    so that calls made by devices obtained from get_raw_devices() from now on
+    are traced. Existing Device objects are not affected."""
+    global mtp
+    if not isinstance(mtp, TracingLibrary) :
+        mtp = TracingLibrary(mtp, max_samples)
+    #end if
+    return mtp
+#end enable_tracing
+
+def disable_tracing() :
+    """restores the default libmtp backend replaced by enable_tracing()."""
+    global mtp
+    if isinstance(mtp, TracingLibrary) :
+        mtp = mtp.lib
+    #end if
+#end disable_tracing
+
+#+
+# Device metrics
+#-
+
+device_metrics = {}
+  # DeviceMetrics for currently-open Devices, keyed by address of libmtp device
+  # handle, so check_status can count errors against the right device
+
+class DeviceMetrics :
+    """running totals of activity on a Device, available as its metrics
+    attribute: bytes and files transferred and the time taken (keyed by
+    direction, "retrieved" or "sent"), Error counts keyed by code, cache hits
+    and misses keyed by cache name, and enumeration counts and durations
+    keyed by kind. Snapshots can be obtained from Device.get_metrics and
+    Device.write_metrics."""
+
+    def __init__(self) :
+        self.started = time.time()
+        self.bytes_transferred = {"retrieved" : 0, "sent" : 0}
+        self.files_transferred = {"retrieved" : 0, "sent" : 0}
+        self.transfer_time = {"retrieved" : 0.0, "sent" : 0.0}
+        self.errors = {}
+        self.cache_hits = {}
+        self.cache_misses = {}
+        self.enumerations = {}
+          # values are [count, total seconds, seconds for most recent]
+        self.battery_level = None # (maximum, current) when last asked
+    #end __init__
+
+    def add_transfer(self, direction, nr_bytes, elapsed, nr_files = 1) :
+        self.bytes_transferred[direction] += nr_bytes
+        self.files_transferred[direction] += nr_files
+        self.transfer_time[direction] += elapsed
+    #end add_transfer
+
+    def add_error(self, code) :
+        self.errors[code] = self.errors.get(code, 0) + 1
+    #end add_error
+
+    def cache_lookup(self, cache, hit) :
+        if hit :
+            counts = self.cache_hits
+        else :
+            counts = self.cache_misses
+        #end if
+        counts[cache] = counts.get(cache, 0) + 1
+    #end cache_lookup
+
+    def add_enumeration(self, kind, elapsed) :
+        entry = self.enumerations.setdefault(kind, [0, 0.0, None])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = elapsed
+    #end add_enumeration
+
+    def files_per_second(self, direction) :
+        """average rate of file transfers in the specified direction, counting
+        only the time actually spent transferring."""
+        if self.transfer_time[direction] != 0 :
+            result = self.files_transferred[direction] / self.transfer_time[direction]
+        else :
+            result = None
+        #end if
+        return result
+    #end files_per_second
+
+    def as_dict(self) :
+        return \
+            {
+                "uptime" : time.time() - self.started,
+                "bytes_transferred" : dict(self.bytes_transferred),
+                "files_transferred" : dict(self.files_transferred),
+                "transfer_time" : dict(self.transfer_time),
+                "files_per_second" :
+                    dict((d, self.files_per_second(d)) for d in self.transfer_time),
+                "errors" :
+                    dict((Error.name.get(code, str(code)), count) for code, count in self.errors.items()),
+                "cache_hits" : dict(self.cache_hits),
+                "cache_misses" : dict(self.cache_misses),
+                "enumerations" :
+                    dict
+                      (
+                        (kind, {"count" : count, "total_time" : total, "last_time" : last})
+                        for kind, (count, total, last) in self.enumerations.items()
+                      ),
+                "battery_level" : self.battery_level,
+            }
+    #end as_dict
+
+    def format_prometheus(self, labels) :
+        """returns the metrics in Prometheus text exposition format, with the
+        specified dict of labels attached to every sample."""
+
+        def quote(s) :
+            return '"%s"' % str(s).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        #end quote
+
+        lines = []
+
+        def metric(name, kind, helptext, samples) :
+            # samples is a sequence of (extra labels dict, value) pairs.
+            lines.append("# HELP mtpy_%s %s" % (name, helptext))
+            lines.append("# TYPE mtpy_%s %s" % (name, kind))
+            for extra, value in samples :
+                if value != None :
+                    all_labels = dict(labels)
+                    all_labels.update(extra)
+                    lines.append \
+                      (
+                            "mtpy_%s{%s} %s"
+                        %
+                            (
+                                name,
+                                ",".join("%s=%s" % (k, quote(v)) for k, v in sorted(all_labels.items())),
+                                repr(value),
+                            )
+                      )
+                #end if
+            #end for
+        #end metric
+
+    #begin format_prometheus
+        metric \
+          (
+            "bytes_transferred_total", "counter", "Bytes of file contents transferred.",
+            (({"direction" : d}, n) for d, n in sorted(self.bytes_transferred.items()))
+          )
+        metric \
+          (
+            "files_transferred_total", "counter", "Files transferred.",
+            (({"direction" : d}, n) for d, n in sorted(self.files_transferred.items()))
+          )
+        metric \
+          (
+            "transfer_seconds_total", "counter", "Time spent transferring files.",
+            (({"direction" : d}, t) for d, t in sorted(self.transfer_time.items()))
+          )
+        metric \
+          (
+            "files_per_second", "gauge", "Average file transfer rate while transferring.",
+            (({"direction" : d}, self.files_per_second(d)) for d in sorted(self.transfer_time))
+          )
+        metric \
+          (
+            "errors_total", "counter", "libmtp errors, by error code.",
+            (
+                ({"code" : code, "name" : Error.name.get(code, "?")}, n)
+                for code, n in sorted(self.errors.items())
+            )
+          )
+        metric \
+          (
+            "cache_requests_total", "counter", "Device cache lookups, by cache and result.",
+            tuple(({"cache" : c, "result" : "hit"}, n) for c, n in sorted(self.cache_hits.items()))
+            +
+            tuple(({"cache" : c, "result" : "miss"}, n) for c, n in sorted(self.cache_misses.items()))
+          )
+        metric \
+          (
+            "enumerations_total", "counter", "Enumerations of device contents, by kind.",
+            (({"kind" : k}, e[0]) for k, e in sorted(self.enumerations.items()))
+          )
+        metric \
+          (
+            "enumeration_seconds_total", "counter", "Time spent enumerating device contents, by kind.",
+            (({"kind" : k}, e[1]) for k, e in sorted(self.enumerations.items()))
+          )
+        metric \
+          (
+            "last_enumeration_seconds", "gauge", "Duration of the most recent enumeration, by kind.",
+            (({"kind" : k}, e[2]) for k, e in sorted(self.enumerations.items()))
+          )
+        if self.battery_level != None :
+            metric("battery_level", "gauge", "Current battery level.", (({}, self.battery_level[1]),))
+            metric("battery_level_max", "gauge", "Maximum battery level.", (({}, self.battery_level[0]),))
+        #end if
+        return "\n".join(lines) + "\n"
+    #end format_prometheus
+
+#end DeviceMetrics
+
+#+
+# Watching for devices coming and going
+#-
+
+WATCH_ATTACHED = "attached"
+WATCH_DETACHED = "detached"
+
+NETLINK_KOBJECT_UEVENT = 15 # from <linux/netlink.h>
+
+class DeviceWatcher :
+    """keeps track of which MTP devices are attached, without doing a full USB
+    probe every time. The list of USB devices is read from sysfs (cheap, no
+    USB traffic), and only newly-appeared devices are probed to see if they
+    speak MTP; detaching needs no probing at all. Kernel uevents are used to
+    notice changes promptly if available, otherwise sysfs is polled every
+    poll_interval seconds. After a change is noticed, the watcher waits for
+    things to be quiet for debounce seconds before rescanning, since devices
+    tend to reenumerate a few times when plugged in.
+
+    Use get_devices() for the current list of RawDevices, events() to iterate
+    over (WATCH_xxx, RawDevice) events as they happen, or add_callback() and
+    start() to have a background thread call you back."""
+
+    def __init__(self, poll_interval = 2.0, debounce = 0.5, sysfs_dir = "/sys/bus/usb/devices") :
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.sysfs_dir = sysfs_dir
+        self.rawdevs = None # RawDevices keyed by location, once scanned
+        self.usb_locations = set() # all USB devices seen by the last scan
+        self.callbacks = []
+        self.uevents = None
+        self.thread = None
+        self.stopping = False
+        self.lock = threading.Lock()
+        try :
+            self.uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.uevents.bind((0, 1)) # kernel event multicast group
+            self.uevents.setblocking(False)
+        except (AttributeError, OSError) :
+            # not Linux, or not allowed
+            if self.uevents != None :
+                self.uevents.close()
+                self.uevents = None
+            #end if
+        #end try
+    #end __init__
+
+    def _get_usb_locations(self) :
+        # returns the set of (bus, devnum) for all currently-attached USB devices,
+        # or None if this cannot be determined from sysfs.
+        try :
+            entries = os.listdir(self.sysfs_dir)
+        except OSError :
+            return None
+        #end try
+        result = set()
+        for entry in entries :
+            try :
+                with open(os.path.join(self.sysfs_dir, entry, "busnum")) as busnum :
+                    bus = int(busnum.read())
+                #end with
+                with open(os.path.join(self.sysfs_dir, entry, "devnum")) as devnum :
+                    dev = int(devnum.read())
+                #end with
+            except (OSError, ValueError) :
+                continue # interface rather than device, or went away
+            #end try
+            result.add((bus, dev))
+        #end for
+        return result
+    #end _get_usb_locations
+
+    def scan(self) :
+        """rescans for attached devices, returning a list of (WATCH_xxx, RawDevice)
+        events for any changes since the last scan."""
+        with self.lock :
+            events = []
+            if self.rawdevs == None :
+                # first time
+                self.rawdevs = {}
+                self.usb_locations = set()
+            #end if
+            usb_locations = self._get_usb_locations()
+            if usb_locations != None :
+                for location in list(self.rawdevs.keys()) :
+                    if location not in usb_locations :
+                        events.append((WATCH_DETACHED, self.rawdevs.pop(location)))
+                    #end if
+                #end for
+                probe = False
+                for location in usb_locations - self.usb_locations :
+                    if mtp.LIBMTP_Check_Specific_Device(*location) != 0 :
+                        probe = True
+                    #end if
+                #end for
+                self.usb_locations = usb_locations
+                if probe :
+                    for rawdev in get_raw_devices() :
+                        if rawdev.location not in self.rawdevs :
+                            self.rawdevs[rawdev.location] = rawdev
+                            events.append((WATCH_ATTACHED, rawdev))
+                        #end if
+                    #end for
+                #end if
+            else :
+                # no sysfs, have to do it the expensive way
+                current = dict((rawdev.location, rawdev) for rawdev in get_raw_devices())
+                for location in list(self.rawdevs.keys()) :
+                    if location not in current :
+                        events.append((WATCH_DETACHED, self.rawdevs.pop(location)))
+                    #end if
+                #end for
+                for location, rawdev in current.items() :
+                    if location not in self.rawdevs :
+                        self.rawdevs[location] = rawdev
+                        events.append((WATCH_ATTACHED, rawdev))
+                    #end if
+                #end for
+            #end if
+        #end with
+        return events
+    #end scan
+
+    def get_devices(self) :
+        """returns the list of RawDevices for the currently-attached MTP devices.
+        Only scans if not scanned before; use scan() or events() to keep this
+        up to date."""
+        if self.rawdevs == None :
+            self.scan()
+        #end if
+        return list(self.rawdevs.values())
+    #end get_devices
+
+    def _drain_uevents(self) :
+        # reads all pending uevents, returning True iff any concerned USB.
+        result = False
+        while True :
+            try :
+                msg = self.uevents.recv(16384)
+            except (BlockingIOError, InterruptedError) :
+                break
+            #end try
+            if b"\0SUBSYSTEM=usb\0" in msg :
+                result = True
+            #end if
+        #end while
+        return result
+    #end _drain_uevents
+
+    def _wait_for_change(self, timeout) :
+        # waits up to timeout seconds for a possible device change, then
+        # waits for things to settle.
+        if self.uevents != None :
+            readable = select.select([self.uevents], [], [], timeout)[0]
+            if len(readable) != 0 and self._drain_uevents() :
+                while len(select.select([self.uevents], [], [], self.debounce)[0]) != 0 :
+                    self._drain_uevents()
+                #end while
+            #end if
+        else :
+            time.sleep(timeout)
+            if self._get_usb_locations() != self.usb_locations :
+                time.sleep(self.debounce)
+            #end if
+        #end if
+    #end _wait_for_change
+
+    def events(self, timeout = None) :
+        """generates (WATCH_xxx, RawDevice) events as devices are attached and
+        detached. If timeout is not None, stops after that many seconds with no
+        events. The first events reported are attachments for all the devices
+        already present, unless get_devices() or scan() have already been called."""
+        if self.rawdevs == None :
+            for event in self.scan() :
+                yield event
+            #end for
+        #end if
+        deadline = None
+        while not self.stopping :
+            if timeout != None :
+                if deadline == None :
+                    deadline = time.monotonic() + timeout
+                #end if
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 :
+                    break
+                wait = min(remaining, self.poll_interval)
+            else :
+                wait = self.poll_interval
+            #end if
+            self._wait_for_change(wait)
+            for event in self.scan() :
+                deadline = None
+                yield event
+            #end for
+        #end while
+    #end events
+
+    def add_callback(self, callback) :
+        """arranges for callback(event, rawdev) to be called from the background
+        thread (see start()) for each WATCH_xxx event."""
+        self.callbacks.append(callback)
+    #end add_callback
+
+    def remove_callback(self, callback) :
+        self.callbacks.remove(callback)
+    #end remove_callback
+
+    def _run(self) :
+        for event, rawdev in self.events() :
+            for callback in list(self.callbacks) :
+                callback(event, rawdev)
+            #end for
+        #end for
+    #end _run
+
+    def start(self) :
+        """starts a background thread which watches for changes and invokes the
+        callbacks."""
+        if self.thread == None :
+            self.stopping = False
+            self.thread = threading.Thread(target = self._run, name = "mtpy DeviceWatcher", daemon = True)
+            self.thread.start()
+        #end if
+    #end start
+
+    def stop(self) :
+        """stops the background thread, waiting up to poll_interval seconds for
+        it to notice."""
+        if self.thread != None :
+            self.stopping = True
+            self.thread.join()
+            self.thread = None
+        #end if
+    #end stop
+
+    def close(self) :
+        self.stop()
+        if self.uevents != None :
+            self.uevents.close()
+            self.uevents = None
+        #end if
+    #end close
+
+    def __enter__(self) :
+        return self
+    #end __enter__
+
+    def __exit__(self, exception_type, exception_value, traceback) :
+        self.close()
+    #end __exit__
+
+#end DeviceWatcher
+
+#+
+# Recovering from transient errors
+#-
+
+class RetryPolicy :
+    """decides whether and when to retry operations that fail with an Error.
+    Only Errors with codes in retry_codes are retried, up to a total of
+    attempts tries, waiting delay seconds before the first retry and
+    multiplying the wait by backoff each time after, up to max_delay. If
+    the device has stopped responding after a failure, it is reopened
+    (see Device.reopen) before the next attempt. If specified, on_retry(error,
+    attempt) is called before each retry, e.g. for logging."""
+
+    def __init__ \
+      (
+        self,
+        attempts = 5,
+        delay = 0.5,
+        backoff = 2.0,
+        max_delay = 30.0,
+        retry_codes = (ERROR_PTP_LAYER, ERROR_USB_LAYER, ERROR_NO_DEVICE_ATTACHED, ERROR_CONNECTING),
+        on_retry = None,
+      ) :
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retry_codes = frozenset(retry_codes)
+        self.on_retry = on_retry
+    #end __init__
+
+    def is_retryable(self, error) :
+        return isinstance(error, Error) and error.code in self.retry_codes
+    #end is_retryable
+
+    def call(self, device, func, *args, **kwargs) :
+        """calls func(*args, **kwargs), which must be an idempotent operation on
+        the specified Device (or its contents), retrying according to this
+        policy. Returns func’s result, or raises its last exception."""
+        attempt = 0
+        reopen = False
+        while True :
+            try :
+                if reopen :
+                    device.reopen()
+                    reopen = False
+                #end if
+                result = func(*args, **kwargs)
+                break
+            except Error as Err :
+                attempt += 1
+                if attempt >= self.attempts or not self.is_retryable(Err) :
+                    raise
+                #end if
+                if self.on_retry != None :
+                    self.on_retry(Err, attempt)
+                #end if
+                time.sleep(min(self.delay * self.backoff ** (attempt - 1), self.max_delay))
+                reopen = getattr(device, "device", None) == None or not device.check_alive()
+                  # no device attribute once closed
+            #end try
+        #end while
+        return result
+    #end call
+
+#end RetryPolicy
+
+class Batch :
+    """applies an operation to each of a sequence of items on the specified
+    Device, retrying failures according to the specified RetryPolicy. The
+    operation is called as operation(item) and must be idempotent. If an item
+    still fails after all retries, run() raises the exception, leaving
+    position indicating the failed item; calling run() again resumes from
+    there, without repeating the items already done. The results of the
+    operation calls so far are in results."""
+
+    def __init__(self, device, items, operation, policy = None) :
+        self.device = device
+        self.items = list(items)
+        self.operation = operation
+        self.policy = policy or RetryPolicy()
+        self.position = 0
+        self.results = []
+    #end __init__
+
+    def __repr__(self) :
+        return "<Batch %d/%d done>" % (self.position, len(self.items))
+    #end __repr__
+
+    def done(self) :
+        return self.position == len(self.items)
+    #end done
+
+    def run(self) :
+        """processes the remaining items, returning the list of all results."""
+        while self.position < len(self.items) :
+            self.results.append \
+              (
+                self.policy.call(self.device, self.operation, self.items[self.position])
+              )
+            self.position += 1
+        #end while
+        return self.results
+    #end run
+
+#end Batch
+
+#+
+# Keeping devices open between uses
+#-
+
+class DevicePool :
+    """keeps opened Device connections alive between jobs, so each job doesn’t
+    have to pay the cost of opening the device and reloading its contents.
+    Devices are identified by serial number. Use checkout() to obtain a
+    Device and checkin() to return it to the pool when done, or use
+    device() in a with-statement to do both. A Device is checked for
+    responsiveness each time it is checked out, and transparently reopened if
+    the connection has been lost (e.g. after a USB reset). Devices idle in
+    the pool for longer than max_idle seconds (if not None) are closed. lib
+    is the backend to look for devices with, defaulting to libmtp."""
+
+    def __init__(self, max_idle = None, lib = None) :
+        self.max_idle = max_idle
+        self.lib = lib
+        self.idle = {} # (Device, time returned) keyed by serial number
+        self.busy = {} # Device keyed by serial number
+        self.lock = threading.Lock()
+    #end __init__
+
+    def __repr__(self) :
+        return "<DevicePool idle %s busy %s>" % (sorted(self.idle.keys()), sorted(self.busy.keys()))
+    #end __repr__
+
+    def _expire_idle(self) :
+        if self.max_idle != None :
+            now = time.monotonic()
+            for serial, (device, last_used) in list(self.idle.items()) :
+                if now - last_used > self.max_idle :
+                    del self.idle[serial]
+                    device.close()
+                #end if
+            #end for
+        #end if
+    #end _expire_idle
+
+    def _open_more(self, serial) :
+        # opens attached devices not already in the pool until one is found
+        # with the specified serial number (or any, if serial is None), adding
+        # the others to the idle pool.
+        result = None
+        in_pool = set \
+          (
+            device.rawdev.location
+            for device in
+                list(self.busy.values()) + list(device for device, last_used in self.idle.values())
+          )
+        for rawdev in get_raw_devices(self.lib) :
+            if rawdev.location not in in_pool :
+                try :
+                    device = rawdev.open()
+                except Error :
+                    continue # can't get at it for now
+                #end try
+                device_serial = device.get_serial_number()
+                if serial == None or device_serial == serial :
+                    result = device
+                    break
+                #end if
+                self.idle[device_serial] = (device, time.monotonic())
+            #end if
+        #end for
+        return result
+    #end _open_more
+
+    def checkout(self, serial = None) :
+        """returns a Device for the device with the specified serial number,
+        or any available device if serial is None, reusing an already-opened
+        one from the pool if possible. Raises Error(ERROR_NO_DEVICE_ATTACHED)
+        if the device cannot be found."""
+        with self.lock :
+            self._expire_idle()
+            if serial == None and len(self.idle) != 0 :
+                serial = next(iter(self.idle.keys()))
+            #end if
+            if serial != None and serial in self.busy :
+                raise RuntimeError("device %s is already checked out" % serial)
+            #end if
+            if serial in self.idle :
+                device = self.idle.pop(serial)[0]
+                if not device.check_alive() :
+                    device.reopen() # if this fails, device is dropped from pool
+                #end if
+            else :
+                device = self._open_more(serial)
+                if device == None :
+                    raise Error(ERROR_NO_DEVICE_ATTACHED)
+                #end if
+            #end if
+            self.busy[device.serial_number] = device
+        #end with
+        return device
+    #end checkout
+
+    def checkin(self, device) :
+        """returns a Device obtained from checkout() to the pool, keeping it open
+        for reuse."""
+        with self.lock :
+            del self.busy[device.serial_number]
+            self.idle[device.serial_number] = (device, time.monotonic())
+            self._expire_idle()
+        #end with
+    #end checkin
+
+    def device(self, serial = None) :
+        """for use in a with-statement: checks out the Device with the specified
+        serial number (see checkout()) for the duration of the statement, then
+        checks it back in."""
+        return LeakProtect(self.checkout(serial), self.checkin)
+    #end device
+
+    def close(self) :
+        """closes all idle devices. Devices currently checked out are left alone."""
+        with self.lock :
+            for device, last_used in self.idle.values() :
+                device.close()
+            #end for
+            self.idle.clear()
+        #end with
+    #end close
+
+#end DevicePool
+
+#+
+# Sharing a device among threads
+#-
+
+class DeviceActor :
+    """libmtp device handles must not be used from more than one thread at a time.
+    A DeviceActor opens the specified RawDevice on its own dedicated thread, and
+    executes all operations on the resulting Device in that thread, in the order
+    they are submitted. Any number of other threads can submit operations
+    concurrently; each submission returns a concurrent.futures.Future for the
+    result. The Device is available as the device attribute, and calls on it
+    can also be submitted by calling them on the DeviceActor, e.g.
+    actor.get_children() returns a Future for the result of
+    actor.device.get_children(). Calls on the File, Folder etc objects you get
+    back must be submitted too, e.g. actor.submit(f.retrieve_to_file, dest)."""
+
+    def __init__(self, rawdev) :
+        self.rawdev = rawdev
+        self.device = None
+        self.requests = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()
+          # makes checking closed and queueing a request atomic with closing
+        self.thread = threading.Thread \
+          (
+            target = self._run,
+            name = "mtpy %s %s" % (rawdev.vendor, rawdev.product),
+            daemon = True
+          )
+        self.thread.start()
+        try :
+            self.device = self.submit(rawdev.open).result()
+        except :
+            self._stop()
+            raise
+        #end try
+    #end __init__
+
+    def _run(self) :
+        # body of the owner thread.
+        while True :
+            request = self.requests.get()
+            if request == None :
+                break
+            future, func, args, kwargs = request
+            if future.set_running_or_notify_cancel() :
+                try :
+                    result = func(*args, **kwargs)
+                except BaseException as Err :
+                    future.set_exception(Err)
+                else :
+                    future.set_result(result)
+                #end try
+            #end if
+        #end while
+    #end _run
+
+    def _queue(self, func, args, kwargs) :
+        # queues a request and returns its Future. Caller must hold self.lock
+        # and have checked that the DeviceActor is not closed.
+        future = concurrent.futures.Future()
+        self.requests.put((future, func, args, kwargs))
+        return future
+    #end _queue
+
+    def _shut(self) :
+        # queues the sentinel that stops the owner thread, after which no more
+        # requests are accepted. Caller must hold self.lock.
+        self.closed = True
+        self.requests.put(None)
+    #end _shut
+
+    def _join(self) :
+        if threading.current_thread() != self.thread :
+            self.thread.join()
+        #end if
+    #end _join
+
+    def _stop(self) :
+        with self.lock :
+            if not self.closed :
+                self._shut()
+            #end if
+        #end with
+        self._join()
+    #end _stop
+
+    def submit(self, func, *args, **kwargs) :
+        """queues a call to func(*args, **kwargs) for execution on the owner
+        thread, returning a Future for the result."""
+        with self.lock :
+            if self.closed :
+                raise RuntimeError("DeviceActor is closed")
+            #end if
+            future = self._queue(func, args, kwargs)
+        #end with
+        return future
+    #end submit
+
+    def call(self, func, *args, **kwargs) :
+        """executes func(*args, **kwargs) on the owner thread, waits for it to
+        complete, and returns its result."""
+        return self.submit(func, *args, **kwargs).result()
+    #end call
+
+    def __getattr__(self, name) :
+        # forward Device method calls as submissions.
+        if name.startswith("_") or self.__dict__.get("device") == None :
+            raise AttributeError(name)
+        #end if
+        attr = getattr(self.device, name)
+        if callable(attr) :
+            def submit_call(*args, **kwargs) :
+                return self.submit(attr, *args, **kwargs)
+            #end submit_call
+            result = submit_call
+        else :
+            result = attr
+        #end if
+        return result
+    #end __getattr__
+
+    def close(self) :
+        """closes the device connection once all previously-submitted calls have
+        completed, and shuts down the owner thread."""
+        with self.lock :
+            if not self.closed :
+                future = self._queue(self.device.close, (), {})
+                self._shut()
+            else :
+                future = None
+            #end if
+        #end with
+        if future != None :
+            self._join()
+            future.result()
+        #end if
+    #end close
+
+    def __enter__(self) :
+        return self
+    #end __enter__
+
+    def __exit__(self, exception_type, exception_value, traceback) :
+        self.close()
+    #end __exit__
+
+    def __repr__(self) :
+        return "<DeviceActor “%s %s”>" % (self.rawdev.vendor, self.rawdev.product)
+    #end __repr__
+
+#end DeviceActor
+
+#+
+# asyncio interface
+#-
+
+async def open_async(rawdev) :
+    """opens the specified RawDevice without blocking the event loop, returning
+    an AsyncDevice."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return AsyncDevice(await loop.run_in_executor(None, DeviceActor, rawdev))
+#end open_async
+
+class AsyncDevice :
+    """asyncio wrapper around a DeviceActor: all the blocking libmtp calls are
+    executed on the actor’s owner thread, and awaited without blocking the
+    event loop. Get one of these from open_async or RawDevice.open_async. The
+    File and Folder objects returned are the usual ones; pass them back to
+    the methods here rather than calling their methods directly. Methods
+    that take an optional folder argument default to the root of the device."""
+
+    def __init__(self, actor) :
+        self.actor = actor
+        self.device = actor.device
+    #end __init__
+
+    def __repr__(self) :
+        return "<AsyncDevice “%s %s”>" % (self.device.vendor, self.device.product)
+    #end __repr__
+
+    async def run(self, func, *args, **kwargs) :
+        """executes func(*args, **kwargs) on the device thread, and returns its
+        result. Use this for any operation not otherwise wrapped here."""
+        import asyncio
+        return await asyncio.wrap_future(self.actor.submit(func, *args, **kwargs))
+    #end run
+
+    async def close(self) :
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(None, self.actor.close)
+    #end close
+
+    async def __aenter__(self) :
+        return self
+    #end __aenter__
+
+    async def __aexit__(self, exception_type, exception_value, traceback) :
+        await self.close()
+    #end __aexit__
+
+    async def get_children(self, folder = None, prefetch = None) :
+        return await self.run((folder or self.device).get_children, prefetch)
+    #end get_children
+
+    async def get_child_by_name(self, name, folder = None) :
+        return await self.run((folder or self.device).get_child_by_name, name)
+    #end get_child_by_name
+
+    async def get_descendants(self) :
+        return await self.run(self.device.get_descendants)
+    #end get_descendants
+
+    async def get_descendant_by_id(self, id) :
+        return await self.run(self.device.get_descendant_by_id, id)
+    #end get_descendant_by_id
+
+    async def get_descendant_by_path(self, path) :
+        return await self.run(self.device.get_descendant_by_path, path)
+    #end get_descendant_by_path
+
+    async def walk(self, folder = None) :
+        """asynchronously generates a (folder, subfolders, files) tuple for the
+        specified folder and each folder beneath it, top-down, in the manner
+        of os.walk."""
+        folder = folder or self.device
+        children = await self.get_children(folder)
+        subfolders = list(item for item in children if isinstance(item, Folder))
+        files = list(item for item in children if isinstance(item, File))
+        yield folder, subfolders, files
+        for subfolder in subfolders :
+            async for entry in self.walk(subfolder) :
+                yield entry
+            #end for
+        #end for
+    #end walk
+
+    async def retrieve_to_file(self, item, destname, progress = None) :
+        """downloads the specified File to the host filesystem. progress, if
+        specified, is called on the device thread."""
+        await self.run(item.retrieve_to_file, destname, progress)
+    #end retrieve_to_file
+
+    async def retrieve_to_folder(self, dest, folder = None) :
+        await self.run((folder or self.device).retrieve_to_folder, dest)
+    #end retrieve_to_folder
+
+    async def send_file(self, src, destname = None, folder = None, progress = None) :
+        """uploads the specified file into the specified folder, returning
+        the new File object. progress, if specified, is called on the device
+        thread."""
+        folder = folder or self.device
+        if destname == None :
+            destname = os.path.basename(src)
+        #end if
+        return await self.run(folder.send_file, src, destname, progress = progress)
+    #end send_file
+
+    async def _transfer_progress(self, func, *args) :
+        # runs func(*args, progress = ...) on the device thread, asynchronously
+        # generating the (sent, total) progress reports as they come in.
+        # Abandoning the iteration cancels the transfer.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        reports = asyncio.Queue()
+        cancelled = False
+
+        def progress(sent, total) :
+            loop.call_soon_threadsafe(reports.put_nowait, (sent, total))
+            return cancelled
+        #end progress
+
+        done = asyncio.wrap_future(self.actor.submit(func, *args, progress = progress))
+        try :
+            while True :
+                get_report = asyncio.ensure_future(reports.get())
+                await asyncio.wait((get_report, done), return_when = asyncio.FIRST_COMPLETED)
+                if not get_report.done() :
+                    get_report.cancel()
+                    break
+                #end if
+                yield get_report.result()
+            #end while
+            while not reports.empty() :
+                yield reports.get_nowait()
+            #end while
+            await done # raise exception if transfer failed
+        finally :
+            if not done.done() :
+                cancelled = True
+            #end if
+        #end try
+    #end _transfer_progress
+
+    def retrieve_to_file_progress(self, item, destname) :
+        """downloads the specified File to the host filesystem, asynchronously
+        generating (sent, total) progress reports until the transfer completes.
+        Stopping the iteration early cancels the transfer."""
+        return self._transfer_progress(item.retrieve_to_file, destname)
+    #end retrieve_to_file_progress
+
+    def send_file_progress(self, src, destname = None, folder = None) :
+        """uploads the specified file into the specified folder, asynchronously
+        generating (sent, total) progress reports until the transfer completes.
+        Stopping the iteration early cancels the transfer."""
+        folder = folder or self.device
+        if destname == None :
+            destname = os.path.basename(src)
+        #end if
+        return self._transfer_progress(folder.send_file, src, destname)
+    #end send_file_progress
+
+#end AsyncDevice
+
+#+
+# Parallel operation on multiple devices
+#-
+
+FLEET_STARTED = "started" # device opened, job about to run; value is None
+FLEET_PROGRESS = "progress" # value is whatever the job passed to its report function
+FLEET_RESULT = "result" # value is the job's return value
+FLEET_ERROR = "error" # value is the exception raised by the job
+FLEET_FINISHED = "finished" # worker process is done with this device; value is None
+
+class FleetEvent :
+    """an event reported back from a Fleet worker. kind is one of the FLEET_xxx
+    values, rawdev is the RawDevice the worker is operating on, and the meaning
+    of value depends on kind."""
+
+    def __init__(self, kind, rawdev, value) :
+        self.kind = kind
+        self.rawdev = rawdev
+        self.value = value
+    #end __init__
+
+    def __repr__(self) :
+        return "<FleetEvent %s %s %r>" % (self.kind, self.rawdev, self.value)
+    #end __repr__
+
+#end FleetEvent
+
+def _fleet_worker(location, job, args, events) :
+    # body of a Fleet worker process.
+
+    def report(value) :
+        events.put((FLEET_PROGRESS, location, value))
+    #end report
+
+    def picklable(value) :
+        # the Queue only pickles objects later, in its feeder thread, where
+        # failures are merely logged, so check beforehand.
+        try :
+            pickle.dumps(value)
+            result = True
+        except Exception :
+            result = False
+        #end try
+        return result
+    #end picklable
+
+#begin _fleet_worker
+    try :
+        rawdev = None
+        for candidate in get_raw_devices() :
+            if candidate.location == location :
+                rawdev = candidate
+                break
+            #end if
+        #end for
+        if rawdev == None :
+            raise Error(ERROR_NO_DEVICE_ATTACHED)
+        #end if
+        device = rawdev.open()
+        try :
+            events.put((FLEET_STARTED, location, None))
+            result = job(device, report, *args)
+        finally :
+            device.close()
+        #end try
+        if not picklable(result) :
+            raise RuntimeError("job result %r cannot be pickled" % type(result).__name__)
+        #end if
+        events.put((FLEET_RESULT, location, result))
+    except Exception as Err :
+        if not picklable(Err) :
+            Err = RuntimeError(str(Err))
+        #end if
+        events.put((FLEET_ERROR, location, Err))
+    #end try
+    events.put((FLEET_FINISHED, location, None))
+#end _fleet_worker
+
+class Fleet :
+    """runs a job on each of a number of MTP devices in parallel, each in its own
+    worker process, so transfers to/from different devices are not serialized
+    by a single Python process. Construct with a list of RawDevice objects (defaults
+    to all currently attached devices) and an optional limit on how many workers
+    may run at once.
+
+    The job must be a picklable (i.e. module-level) function, which is called in
+    the worker as job(device, report, *args), where device is the opened Device
+    and report is a function the job can call with any picklable value to send
+    a progress report back to the parent. Because workers are started with the
+    “spawn” method, the main module of your program must be importable without
+    side effects (i.e. use an ‘if __name__ == "__main__"’ guard)."""
+
+    def __init__(self, rawdevs = None, max_workers = None) :
+        if rawdevs == None :
+            rawdevs = get_raw_devices()
+        #end if
+        self.rawdevs = list(rawdevs)
+        self.max_workers = max_workers
+    #end __init__
+
+    def __repr__(self) :
+        return "<Fleet %s>" % ", ".join(repr(rawdev) for rawdev in self.rawdevs)
+    #end __repr__
+
+    def run(self, job, *args) :
+        """runs the job on every device in the fleet, generating a sequence of
+        FleetEvent objects as the workers report back. The sequence ends when all
+        the workers have finished."""
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+          # don't want children inheriting libusb state from the parent
+        events = context.Queue()
+        rawdev_by_location = dict((rawdev.location, rawdev) for rawdev in self.rawdevs)
+        pending = list(self.rawdevs)
+        running = {}
+        max_workers = self.max_workers
+        if max_workers == None :
+            max_workers = len(pending)
+        #end if
+        try :
+            while len(pending) + len(running) != 0 :
+                while len(pending) != 0 and len(running) < max_workers :
+                    rawdev = pending.pop(0)
+                    worker = context.Process \
+                      (
+                        target = _fleet_worker,
+                        args = (rawdev.location, job, args, events),
+                        daemon = True
+                      )
+                    worker.start()
+                    running[rawdev.location] = worker
+                #end while
+                received = []
+                try :
+                    received.append(events.get(timeout = 1.0))
+                except queue.Empty :
+                    dead = list(location for location, worker in running.items() if not worker.is_alive())
+                    if len(dead) != 0 :
+                        # a worker might have sent its last events and exited since
+                        # the get timed out, so collect those first
+                        while True :
+                            try :
+                                received.append(events.get(timeout = 0.1))
+                            except queue.Empty :
+                                break
+                            #end try
+                        #end while
+                        finished = set(location for kind, location, value in received if kind == FLEET_FINISHED)
+                        for location in dead :
+                            if location not in finished :
+                                # died without reporting back, e.g. crashed in libmtp
+                                worker = running[location]
+                                worker.join()
+                                if worker.exitcode != 0 :
+                                    received.append \
+                                      (
+                                        (
+                                            FLEET_ERROR,
+                                            location,
+                                            RuntimeError("worker exited with status %d" % worker.exitcode)
+                                        )
+                                      )
+                                #end if
+                                received.append((FLEET_FINISHED, location, None))
+                            #end if
+                        #end for
+                    #end if
+                #end try
+                for kind, location, value in received :
+                    if location in running :
+                        # (ignore stragglers from a worker already given up on)
+                        if kind == FLEET_FINISHED :
+                            running.pop(location).join()
+                        #end if
+                        yield FleetEvent(kind, rawdev_by_location[location], value)
+                    #end if
+                #end for
+            #end while
+        finally :
+            for worker in running.values() :
+                # only if caller abandoned the sequence early
+                worker.terminate()
+                worker.join()
+            #end for
+        #end try
+    #end run
+
+    def run_all(self, job, *args) :
+        """runs the job on every device in the fleet and waits for them all to
+        finish, discarding progress reports. Returns a dict mapping each RawDevice
+        to the job's result on that device, or the exception it raised."""
+        result = {}
+        for event in self.run(job, *args) :
+            if event.kind in (FLEET_RESULT, FLEET_ERROR) :
+                result[event.rawdev] = event.value
+            #end if
+        #end for
+        return result
+    #end run_all
+
+#end Fleet
+
+def fleet_enumerate(device, report) :
+    """a Fleet job which returns a list of (fullpath, filesize, modificationdate)
+    tuples for all the files on the device."""
+    return \
+        list \
+          (
+            (item.fullpath(), item.filesize, item.modificationdate)
+            for item in common_get_descendant_files(device)
+          )
+#end fleet_enumerate
+
+def fleet_retrieve_to_folder(device, report, dest) :
+    """a Fleet job which retrieves the entire contents of the device into a
+    subdirectory of dest named after the device serial number, reporting
+    (fullpath, sent, total) progress tuples along the way. Returns the
+    number of files retrieved."""
+    dest = os.path.join(dest, device.get_serial_number())
+    items = list(common_get_descendant_files(device))
+    common_check_host_space(dest, sum(item.filesize for item in items))
+    for item in items :
+        fullpath = item.fullpath()
+        destname = os.path.join(dest, *fullpath.split("/")[1:])
+        os.makedirs(os.path.dirname(destname), exist_ok = True)
+        item.retrieve_to_file \
+          (
+            destname,
+            lambda sent, total : report((fullpath, sent, total))
+          )
+    #end for
+    return len(items)
+#end fleet_retrieve_to_folder
@@ -0,0 +1,423 @@
+#+
+# FUSE filesystem frontend for mtpy, so that ordinary tools can be
+# pointed at the contents of an MTP device. Directory listings and
+# file attributes are served from the mtpy Device object cache.
+# Reads are done a block at a time with LIBMTP_GetPartialObject,
+# with recently-read blocks kept in a cache, so random access to
+# large files only transfers the parts actually read. Files opened
+# for writing are buffered in temporary files on the host, and
+# uploaded when closed.
+#
+# Requires fusepy <https://github.com/fusepy/fusepy>. Invoke as
+#
+#     python3 -m mtpyfs [--device=n] [--foreground] «mountpoint»
+#
+# Copyright 2012 by Lawrence D'Oliveiro <ldo@geek-central.gen.nz>.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#-
+
+import os
+import errno
+import stat
+import threading
+import tempfile
+import collections
+import argparse
+import fuse
+import mtpy
+
+class Writing :
+    """state for a file open for writing."""
+
+    def __init__(self, path, item) :
+        self.path = path
+        self.item = item # existing File being replaced, if any
+        self.buffer = tempfile.NamedTemporaryFile(prefix = "mtpyfs-")
+        self.nr_opens = 0
+        self.dirty = False
+    #end __init__
+
+    def size(self) :
+        return os.fstat(self.buffer.fileno()).st_size
+    #end size
+
+#end Writing
+
+class MTPFS(fuse.Operations) :
+    """the filesystem operations. device is an open mtpy.Device. block_size is
+    the unit in which file contents are read from the device, and cache_blocks
+    is the maximum number of such blocks to keep cached. storage_max_age is the
+    number of seconds for which free-space figures are reused before being
+    requeried from the device."""
+
+    def __init__(self, device, block_size = 128 * 1024, cache_blocks = 256, storage_max_age = 5.0) :
+        self.device = device
+        self.storage_max_age = storage_max_age
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.blocks = collections.OrderedDict() # keyed by (item_id, block number), in LRU order
+        self.writing = {} # Writing objects keyed by path
+        self.lock = threading.RLock()
+          # libmtp calls must be serialized, in case fusepy is running multithreaded
+    #end __init__
+
+    def __call__(self, op, *args) :
+        with self.lock :
+            try :
+                return super().__call__(op, *args)
+            except mtpy.Error as Err :
+                raise fuse.FuseOSError \
+                  (
+                    {
+                        mtpy.ERROR_STORAGE_FULL : errno.ENOSPC,
+                        mtpy.ERROR_NO_DEVICE_ATTACHED : errno.ENODEV,
+                        mtpy.ERROR_MEMORY_ALLOCATION : errno.ENOMEM,
+                    }.get(Err.code, errno.EIO)
+                  )
+            #end try
+        #end with
+    #end __call__
+
+    def _lookup(self, path) :
+        # returns the File/Folder/Device at path, raising ENOENT if not found.
+        item = self.device.get_descendant_by_path(path)
+        if item == None :
+            raise fuse.FuseOSError(errno.ENOENT)
+        #end if
+        return item
+    #end _lookup
+
+    def _lookup_parent(self, path) :
+        # returns the Folder/Device that is to contain path, and the last
+        # component of path.
+        parentpath, name = os.path.split(path)
+        parent = self._lookup(parentpath)
+        if isinstance(parent, mtpy.File) :
+            raise fuse.FuseOSError(errno.ENOTDIR)
+        #end if
+        return parent, name
+    #end _lookup_parent
+
+    def _forget_blocks(self, item_id) :
+        # drops cached contents of a changed or deleted file.
+        for key in list(self.blocks.keys()) :
+            if key[0] == item_id :
+                del self.blocks[key]
+            #end if
+        #end for
+    #end _forget_blocks
+
+    def _get_block(self, item, blocknr) :
+        key = (item.item_id, blocknr)
+        block = self.blocks.get(key)
+        if block != None :
+            self.blocks.move_to_end(key)
+        else :
+            block = item.read_partial(blocknr * self.block_size, self.block_size)
+            self.blocks[key] = block
+            while len(self.blocks) > self.cache_blocks :
+                self.blocks.popitem(last = False)
+            #end while
+        #end if
+        return block
+    #end _get_block
+
+    def _start_writing(self, path, truncate) :
+        # returns the Writing object for path, creating it if necessary.
+        writing = self.writing.get(path)
+        if writing == None :
+            item = self.device.get_descendant_by_path(path)
+            if isinstance(item, (mtpy.Folder, mtpy.Device)) :
+                raise fuse.FuseOSError(errno.EISDIR)
+            #end if
+            writing = Writing(path, item)
+            if item != None and not truncate :
+                item.retrieve_to_stream(writing.buffer)
+            #end if
+            writing.dirty = item == None or truncate
+            self.writing[path] = writing
+        elif truncate :
+            writing.buffer.truncate(0)
+            writing.dirty = True
+        #end if
+        return writing
+    #end _start_writing
+
+    def _upload(self, writing) :
+        # sends the new contents of a file to the device, replacing any
+        # previous version. The new contents are sent under a temporary name,
+        # and the previous version only deleted once that has succeeded, so
+        # a failed transfer does not lose it.
+        parent, name = self._lookup_parent(writing.path)
+        writing.buffer.flush()
+        if writing.item != None :
+            tempname = ".%s.mtpyfs-%d" % (name, os.getpid())
+            newitem = parent.send_file(writing.buffer.name, tempname)
+            self._forget_blocks(writing.item.item_id)
+            writing.item.delete()
+            newitem.set_name(name)
+        else :
+            newitem = parent.send_file(writing.buffer.name, name)
+        #end if
+        writing.item = newitem
+        writing.dirty = False
+    #end _upload
+
+    def getattr(self, path, fh = None) :
+        writing = self.writing.get(path)
+        if writing != None :
+            result = dict(st_mode = stat.S_IFREG | 0o644, st_nlink = 1, st_size = writing.size())
+        else :
+            item = self._lookup(path)
+            if isinstance(item, mtpy.File) :
+                result = dict \
+                  (
+                    st_mode = stat.S_IFREG | 0o644,
+                    st_nlink = 1,
+                    st_size = item.filesize,
+                    st_mtime = item.modificationdate,
+                    st_ctime = item.modificationdate,
+                    st_atime = item.modificationdate,
+                  )
+            else :
+                result = dict(st_mode = stat.S_IFDIR | 0o755, st_nlink = 2)
+            #end if
+        #end if
+        return result
+    #end getattr
+
+    def readdir(self, path, fh) :
+        folder = self._lookup(path)
+        if isinstance(folder, mtpy.File) :
+            raise fuse.FuseOSError(errno.ENOTDIR)
+        #end if
+        names = set(item.name for item in folder.get_children())
+        # include files created but not yet uploaded
+        prefix = path.rstrip("/") + "/"
+        for wpath in self.writing :
+            if wpath.startswith(prefix) and "/" not in wpath[len(prefix):] :
+                names.add(wpath[len(prefix):])
+            #end if
+        #end for
+        return [".", ".."] + sorted(names)
+    #end readdir
+
+    def statfs(self, path) :
+        self.device.refresh_storage(self.device.storage_sortby, self.storage_max_age)
+        storage = self.device.get_storage_by_id(0)
+        return dict \
+          (
+            f_bsize = self.block_size,
+            f_frsize = self.block_size,
+            f_blocks = storage["MaxCapacity"] // self.block_size,
+            f_bfree = storage["FreeSpaceInBytes"] // self.block_size,
+            f_bavail = storage["FreeSpaceInBytes"] // self.block_size,
+            f_files = storage["FreeSpaceInObjects"] + len(self.device.get_descendants()),
+            f_ffree = storage["FreeSpaceInObjects"],
+            f_favail = storage["FreeSpaceInObjects"],
+            f_namemax = 255,
+          )
+    #end statfs
+
+    def open(self, path, flags) :
+        if flags & os.O_ACCMODE != os.O_RDONLY or flags & os.O_TRUNC != 0 :
+            writing = self._start_writing(path, flags & os.O_TRUNC != 0)
+            writing.nr_opens += 1
+        else :
+            item = self._lookup(path)
+            if not isinstance(item, mtpy.File) :
+                raise fuse.FuseOSError(errno.EISDIR)
+            #end if
+        #end if
+        return 0
+    #end open
+
+    def create(self, path, mode, fi = None) :
+        self._lookup_parent(path)
+        writing = self._start_writing(path, True)
+        writing.nr_opens += 1
+        return 0
+    #end create
+
+    def read(self, path, size, offset, fh) :
+        writing = self.writing.get(path)
+        if writing != None :
+            writing.buffer.seek(offset)
+            result = writing.buffer.read(size)
+        else :
+            item = self._lookup(path)
+            end = min(offset + size, item.filesize)
+            pieces = []
+            pos = offset
+            while pos < end :
+                blocknr, blockoffset = divmod(pos, self.block_size)
+                block = self._get_block(item, blocknr)
+                if len(block) <= blockoffset :
+                    break # file shorter than it said
+                piece = block[blockoffset : blockoffset + end - pos]
+                pieces.append(piece)
+                pos += len(piece)
+            #end while
+            result = b"".join(pieces)
+        #end if
+        return result
+    #end read
+
+    def write(self, path, data, offset, fh) :
+        writing = self.writing.get(path)
+        if writing == None :
+            raise fuse.FuseOSError(errno.EBADF)
+        #end if
+        writing.buffer.seek(offset)
+        writing.buffer.write(data)
+        writing.dirty = True
+        return len(data)
+    #end write
+
+    def truncate(self, path, length, fh = None) :
+        writing = self.writing.get(path)
+        if writing != None :
+            writing.buffer.truncate(length)
+            writing.dirty = True
+        else :
+            self._lookup(path) # raises ENOENT rather than creating it
+            writing = self._start_writing(path, length == 0)
+            try :
+                writing.buffer.truncate(length)
+                self._upload(writing)
+            finally :
+                writing.buffer.close()
+                del self.writing[path]
+            #end try
+        #end if
+    #end truncate
+
+    def flush(self, path, fh) :
+        writing = self.writing.get(path)
+        if writing != None and writing.dirty :
+            self._upload(writing)
+        #end if
+    #end flush
+
+    def release(self, path, fh) :
+        writing = self.writing.get(path)
+        if writing != None :
+            writing.nr_opens -= 1
+            if writing.nr_opens <= 0 :
+                try :
+                    if writing.dirty :
+                        self._upload(writing)
+                    #end if
+                finally :
+                    writing.buffer.close()
+                    del self.writing[path]
+                #end try
+            #end if
+        #end if
+    #end release
+
+    def mkdir(self, path, mode) :
+        parent, name = self._lookup_parent(path)
+        if parent.get_child_by_name(name) != None :
+            raise fuse.FuseOSError(errno.EEXIST)
+        #end if
+        parent.create_folder(name)
+    #end mkdir
+
+    def unlink(self, path) :
+        item = self._lookup(path)
+        if not isinstance(item, mtpy.File) :
+            raise fuse.FuseOSError(errno.EISDIR)
+        #end if
+        self._forget_blocks(item.item_id)
+        item.delete()
+    #end unlink
+
+    def rmdir(self, path) :
+        item = self._lookup(path)
+        if not isinstance(item, mtpy.Folder) :
+            raise fuse.FuseOSError(errno.ENOTDIR)
+        #end if
+        if len(item.get_children()) != 0 :
+            raise fuse.FuseOSError(errno.ENOTEMPTY)
+        #end if
+        item.delete()
+    #end rmdir
+
+    def rename(self, old, new) :
+        item = self._lookup(old)
+        if isinstance(item, mtpy.Device) :
+            raise fuse.FuseOSError(errno.EBUSY)
+        #end if
+        newparent, newname = self._lookup_parent(new)
+        existing = newparent.get_child_by_name(newname)
+        if existing != None :
+            if isinstance(existing, mtpy.Folder) :
+                raise fuse.FuseOSError(errno.EISDIR)
+            #end if
+            self._forget_blocks(existing.item_id)
+            existing.delete()
+        #end if
+        if newparent.item_id != item.parent_id :
+            item.move_to(newparent)
+        #end if
+        if newname != item.name :
+            item.set_name(newname)
+        #end if
+    #end rename
+
+    def utimens(self, path, times = None) :
+        pass # can't set modification date on device
+    #end utimens
+
+    def chmod(self, path, mode) :
+        pass # no permissions on device
+    #end chmod
+
+    def chown(self, path, uid, gid) :
+        pass # no ownership on device
+    #end chown
+
+#end MTPFS
+
+def mount(device, mountpoint, foreground = False, **kwargs) :
+    """mounts the specified open mtpy.Device on the specified mountpoint, which
+    must be an existing empty directory. Does not return until the filesystem
+    is unmounted. kwargs are passed to the MTPFS constructor."""
+    fuse.FUSE(MTPFS(device, **kwargs), mountpoint, foreground = foreground, nothreads = True)
+#end mount
+
+def main() :
+    parser = argparse.ArgumentParser(description = "mount an MTP device as a filesystem")
+    parser.add_argument("--device", type = int, default = 0, help = "which detected device to mount (default 0)")
+    parser.add_argument("--foreground", action = "store_true", help = "don't detach from the terminal")
+    parser.add_argument("--block-size", type = int, default = 128 * 1024, help = "read unit in bytes")
+    parser.add_argument("--cache-blocks", type = int, default = 256, help = "number of blocks to cache")
+    parser.add_argument("mountpoint")
+    args = parser.parse_args()
+    rawdevs = mtpy.get_raw_devices()
+    if args.device >= len(rawdevs) :
+        raise SystemExit("no device %d found" % args.device)
+    #end if
+    device = rawdevs[args.device].open()
+    try :
+        mount \
+          (
+            device,
+            args.mountpoint,
+            foreground = args.foreground,
+            block_size = args.block_size,
+            cache_blocks = args.cache_blocks
+          )
+    finally :
+        device.close()
+    #end try
+#end main
+
+if __name__ == "__main__" :
+    main()
+#end if
@@ -0,0 +1,1580 @@
+#+
+# Simulated MTP devices for mtpy, implemented entirely in Python, so
+# that mtpy's caching and transfer code can be exercised, timed and
+# regression-tested without any real hardware attached. A
+# SimulatedLibrary stands in for libmtp: it provides every function
+# listed in mtpy.libmtp_prototypes, taking and returning the same
+# ctypes structures, allocated and freed with the C library just as
+# libmtp would, so the ownership rules mtpy must follow are the same.
+# Pass it to mtpy.get_raw_devices (or DevicePool) in place of the
+# default libmtp backend:
+#
+#     import mtpy, mtpysim
+#     sim = mtpysim.SimulatedLibrary()
+#     simdev = sim.add_device(latency = 0.001, bandwidth = 20e6)
+#     simdev.populate(nr_folders = 100, nr_files = 10000)
+#     dev = mtpy.get_raw_devices(sim)[0].open()
+#
+# Each SimulatedDevice can be given a fixed latency added to every call,
+# an additional latency per object returned by listing calls, and a
+# bandwidth limiting file transfers. Failures can be injected into
+# specific calls with SimulatedDevice.fail_next, and a device can be
+# made to vanish and reappear by setting its connected attribute. As in
+# libmtp, the error-stack calls and the getters for device info read when
+# the device was opened never fail.
+#
+# Abstract playlists and albums are only visible via the playlist and
+# album calls, not in file listings.
+#
+# Copyright 2012 by Lawrence D'Oliveiro <ldo@geek-central.gen.nz>.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#-
+
+import sys
+import os
+import time
+import ctypes as ct
+import mtpy
+
+libc = ct.cdll.LoadLibrary("libc.so.6")
+libc.malloc.restype = ct.c_void_p
+libc.malloc.argtypes = [ct.c_size_t]
+libc.calloc.restype = ct.c_void_p
+libc.calloc.argtypes = [ct.c_size_t, ct.c_size_t]
+libc.free.restype = None
+libc.free.argtypes = [ct.c_void_p]
+libc.strdup.restype = ct.c_void_p
+libc.strdup.argtypes = [ct.c_char_p]
+
+filetype_names = dict \
+  (
+    (value, name[9:])
+    for name, value in vars(mtpy).items()
+    if name.startswith("FILETYPE_") and isinstance(value, int)
+  )
+property_names = dict \
+  (
+    (value, name[9:])
+    for name, value in vars(mtpy).items()
+    if name.startswith("PROPERTY_") and isinstance(value, int)
+  )
+
+track_fields = \
+    ( # track_t fields kept as track metadata, other than the ones
+      # common to all objects
+        "title", "artist", "composer", "genre", "album", "date",
+        "tracknumber", "duration", "samplerate", "nochannels", "wavecodec",
+        "bitrate", "bitratetype", "rating", "usecount",
+    )
+album_fields = ("artist", "composer", "genre")
+
+#+
+# Internal useful stuff
+#-
+
+def alloc(structtype, count = 1) :
+    # allocates zeroed memory for count instances of structtype with the
+    # C library, so it can be freed with free(3), and returns a pointer to it.
+    return ct.cast(libc.calloc(max(count, 1), ct.sizeof(structtype)), ct.POINTER(structtype))
+#end alloc
+
+def new_string(s) :
+    # returns the address of a newly-allocated C copy of s, or None if s is None.
+    if s != None :
+        if isinstance(s, str) :
+            s = s.encode("utf-8")
+        #end if
+        result = libc.strdup(s)
+    else :
+        result = None
+    #end if
+    return result
+#end new_string
+
+def decode_string(s) :
+    if s != None :
+        s = bytes(s).decode("utf-8")
+    #end if
+    return s
+#end decode_string
+
+def field_address(struct, fieldname) :
+    # returns the address stored in the specified pointer field of struct,
+    # which for a c_char_p field is not otherwise obtainable.
+    return ct.c_void_p.from_address(ct.addressof(struct) + getattr(type(struct), fieldname).offset).value
+#end field_address
+
+def out_arg(arg) :
+    # returns the object that an output argument, passed either as a pointer
+    # or with ct.byref, refers to.
+    if hasattr(arg, "contents") :
+        result = arg.contents
+    else :
+        result = arg._obj
+    #end if
+    return result
+#end out_arg
+
+def set_pointer(arg, address) :
+    # stores address into the pointer variable referred to by the output argument arg.
+    ct.c_void_p.from_address(ct.addressof(out_arg(arg))).value = address
+#end set_pointer
+
+def make_list(items) :
+    # links the list of pointers to structs via their next fields, returning
+    # the head pointer, or None for an empty list.
+    for i in range(len(items) - 1) :
+        items[i].contents.next = items[i + 1]
+    #end for
+    if len(items) != 0 :
+        result = items[0]
+    else :
+        result = None
+    #end if
+    return result
+#end make_list
+
+class SimulatedFunction :
+    """stands in for a single libmtp function, checking its arguments against
+    the declared prototype as ctypes would, then dispatching to the
+    implementation in the SimulatedLibrary or (for functions taking a device
+    handle) the SimulatedDevice, and converting the result as ctypes would
+    for the declared restype."""
+
+    def __init__(self, lib, name, restype, argtypes) :
+        self.lib = lib
+        self.name = name
+        self.implname = name[len("LIBMTP_"):]
+        self.restype = restype
+        self.argtypes = argtypes
+        self.on_device = len(argtypes) != 0 and argtypes[0] == ct.POINTER(mtpy.mtpdevice_t)
+    #end __init__
+
+    def failure_result(self, args) :
+        # what the function returns when it fails.
+        if self.restype == ct.c_int :
+            result = -1
+        elif self.implname.endswith("_From_Object") and self.restype != ct.c_void_p :
+            result = args[3] # the default value
+        elif self.restype == ct.c_uint32 :
+            result = 0 # as from Create_Folder
+        else :
+            result = None
+        #end if
+        return result
+    #end failure_result
+
+    def convert_result(self, result) :
+        if self.restype == None :
+            result = None
+        elif self.restype == ct.c_char_p :
+            if isinstance(result, str) :
+                result = result.encode("utf-8")
+            #end if
+        elif self.restype == ct.c_void_p :
+            if isinstance(result, (str, bytes)) :
+                result = new_string(result) # caller must free
+            #end if
+        elif hasattr(self.restype, "contents") :
+            if result == None :
+                result = self.restype()
+            #end if
+        elif result != None :
+            result = self.restype(result).value
+        #end if
+        return result
+    #end convert_result
+
+    def __call__(self, *args) :
+        if len(args) != len(self.argtypes) :
+            raise TypeError \
+              (
+                "%s takes exactly %d arguments (%d given)" % (self.name, len(self.argtypes), len(args))
+              )
+        #end if
+        args = list(args)
+        for i in range(len(args)) :
+            try :
+                self.argtypes[i].from_param(args[i])
+            except (TypeError, ct.ArgumentError) as err :
+                raise ct.ArgumentError("%s argument %d: %s" % (self.name, i + 1, err))
+            #end try
+            value = getattr(args[i], "value", None)
+            if isinstance(value, int) and not isinstance(args[i], ct.c_void_p) :
+                args[i] = value
+            #end if
+        #end for
+        self.lib.calls[self.name] = self.lib.calls.get(self.name, 0) + 1
+        if self.on_device :
+            simdev = self.lib.devices_by_handle.get(ct.addressof(args[0].contents))
+            if simdev == None :
+                raise ValueError("%s: not an open simulated device handle" % self.name)
+            #end if
+            if self.name in simdev.host_side :
+                failure = None
+            else :
+                failure = simdev._check_failure(self.name)
+            #end if
+            if failure != None :
+                simdev.errors.append(failure)
+                result = self.failure_result(args)
+            else :
+                if simdev.latency != 0 and self.name not in simdev.host_side :
+                    time.sleep(simdev.latency)
+                #end if
+                result = getattr(simdev, self.implname)(*args)
+            #end if
+        else :
+            result = getattr(self.lib, self.implname)(*args)
+        #end if
+        return self.convert_result(result)
+    #end __call__
+
+#end SimulatedFunction
+
+#+
+# User-visible high-level classes
+#-
+
+class SimulatedObject :
+    """an object stored on a SimulatedDevice. data is the contents as a bytes
+    object, or None for contents generated on demand to the given size. track
+    is a dict of track metadata if the object is a track, tracks is the list
+    of track IDs if it is a playlist or album."""
+
+    __slots__ = \
+        (
+            "item_id", "parent_id", "storage_id", "name", "filetype", "size",
+            "data", "mtime", "track", "tracks", "props",
+        )
+
+    pattern = bytes(range(256))
+
+    def __init__(self, item_id, parent_id, storage_id, name, filetype, size = 0, data = None) :
+        self.item_id = item_id
+        self.parent_id = parent_id
+        self.storage_id = storage_id
+        self.name = name
+        self.filetype = filetype
+        if data != None :
+            size = len(data)
+        #end if
+        self.size = size
+        self.data = data
+        self.mtime = 1338681600 + item_id
+        self.track = None
+        self.tracks = None
+        self.props = {}
+    #end __init__
+
+    def read(self, offset, count) :
+        """returns up to count bytes of the contents starting at offset."""
+        count = max(min(count, self.size - offset), 0)
+        if self.data != None :
+            result = self.data[offset : offset + count]
+        else :
+            start = (offset + self.item_id) % 256
+            result = (self.pattern * ((start + count) // 256 + 1))[start : start + count]
+        #end if
+        return result
+    #end read
+
+#end SimulatedObject
+
+class SimulatedStorage :
+    """a storage area on a SimulatedDevice."""
+
+    def __init__(self, storage_id, description, capacity, max_objects) :
+        self.storage_id = storage_id
+        self.description = description
+        self.volume_identifier = "sim%08x" % storage_id
+        self.capacity = capacity
+        self.max_objects = max_objects
+        self.used_bytes = 0
+        self.nr_objects = 0
+        self.description_addr = new_string(description) # never freed
+        self.volume_identifier_addr = new_string(self.volume_identifier) # never freed
+    #end __init__
+
+#end SimulatedStorage
+
+class SimulatedDevice :
+    """a simulated MTP device, created with SimulatedLibrary.add_device. Its
+    contents can be set up with add_storage, add_folder, add_file, add_track,
+    add_playlist, add_album and populate; mtpy then sees it as a RawDevice via
+    get_raw_devices. Every call taking a device handle sleeps for latency
+    seconds, listing calls additionally sleep for object_latency seconds per
+    object returned, and transfers are limited to bandwidth bytes per second
+    (if not None)."""
+
+    chunk_size = 65536 # for transfers and progress callbacks
+
+    host_side = frozenset \
+        (
+            "LIBMTP_" + name
+            for name in
+                (
+                    "Release_Device", "Get_Errorstack", "Clear_Errorstack", "Dump_Errorstack",
+                    "Get_Manufacturername", "Get_Modelname", "Get_Serialnumber",
+                    "Get_Deviceversion",
+                )
+        )
+      # functions which, in real libmtp, only touch host-side state (including
+      # device info cached when the device was opened), so they cannot fail
+      # from loss of the connection, and take no time
+
+    def __init__(self, lib, bus_location, devnum, serial_number, latency, object_latency, bandwidth) :
+        self.lib = lib
+        self.bus_location = bus_location
+        self.devnum = devnum
+        self.serial_number = serial_number
+        self.latency = latency
+        self.object_latency = object_latency
+        self.bandwidth = bandwidth
+        self.connected = True
+        self.vendor = "mtpysim"
+        self.product = "Simulated Device"
+        self.vendor_addr = new_string(self.vendor) # never freed
+        self.product_addr = new_string(self.product) # never freed
+        self.manufacturer_name = "mtpysim"
+        self.model_name = "Simulated Device"
+        self.device_version = "1.0"
+        self.friendly_name = "Simulated Device %d" % devnum
+        self.sync_partner = ""
+        self.maximum_battery_level = 100
+        self.battery_level = 100
+        self.secure_time = None # string to return, if supported
+        self.device_certificate = None # string to return, if supported
+        self.supported_filetypes = [mtpy.FILETYPE_FOLDER, mtpy.FILETYPE_MP3, mtpy.FILETYPE_JPEG, mtpy.FILETYPE_UNKNOWN]
+        self.allowed_values = {}
+          # keys are (propid, filetype), values are dicts in the format returned
+          # by mtpy.Device.get_allowed_property_values
+        self.storage = []
+        self.objects = {}
+        self.children = {0 : {}}
+          # keys are parent IDs (0 for root), values are dicts of children
+          # with values of None, used as insertion-ordered sets
+        self.next_id = 1
+        self.errors = []
+        self.errorstack_allocs = []
+        self.failures = {}
+    #end __init__
+
+    def __repr__(self) :
+        return "<SimulatedDevice %d:%d, %d objects>" % (self.bus_location, self.devnum, len(self.objects))
+    #end __repr__
+
+    # setting up device contents
+
+    def add_storage(self, description = "Internal Storage", capacity = 16 * 1024 ** 3, max_objects = 0xffffffff) :
+        """adds a new storage area, returning its ID. If no storage has been
+        added when objects are created, a default one is added."""
+        storage = SimulatedStorage(0x10001 + len(self.storage) * 0x10000, description, capacity, max_objects)
+        self.storage.append(storage)
+        return storage.storage_id
+    #end add_storage
+
+    def get_storage(self, storage_id) :
+        """returns the SimulatedStorage with the specified ID, or the default one
+        if 0. Returns None if there is no such storage."""
+        if len(self.storage) == 0 :
+            self.add_storage()
+        #end if
+        if storage_id == 0 :
+            result = self.storage[0]
+        else :
+            result = None
+            for storage in self.storage :
+                if storage.storage_id == storage_id :
+                    result = storage
+                    break
+                #end if
+            #end for
+        #end if
+        return result
+    #end get_storage
+
+    def _add_object(self, name, parent_id, storage_id, filetype, size = 0, data = None) :
+        # common code for adding a new object to the device, with no checking.
+        if parent_id == mtpy.FILES_AND_FOLDERS_ROOT :
+            parent_id = 0
+        #end if
+        storage = self.get_storage(storage_id)
+        obj = SimulatedObject(self.next_id, parent_id, storage.storage_id, name, filetype, size, data)
+        self.next_id += 1
+        self.objects[obj.item_id] = obj
+        self.children.setdefault(parent_id, {})[obj.item_id] = None
+        if filetype == mtpy.FILETYPE_FOLDER :
+            self.children[obj.item_id] = {}
+        #end if
+        storage.used_bytes += obj.size
+        storage.nr_objects += 1
+        return obj
+    #end _add_object
+
+    def add_folder(self, name, parent_id = 0, storage_id = 0) :
+        """adds a folder, returning its ID."""
+        return self._add_object(name, parent_id, storage_id, mtpy.FILETYPE_FOLDER).item_id
+    #end add_folder
+
+    def add_file(self, name, parent_id = 0, size = 0, data = None, filetype = mtpy.FILETYPE_UNKNOWN, storage_id = 0) :
+        """adds a file, returning its ID. Its contents are data if specified,
+        otherwise a generated pattern of the specified size."""
+        return self._add_object(name, parent_id, storage_id, filetype, size, data).item_id
+    #end add_file
+
+    def add_track(self, name, parent_id = 0, size = 0, data = None, filetype = mtpy.FILETYPE_MP3, storage_id = 0, **metadata) :
+        """adds a track, returning its ID. metadata can include any of the
+        fields in track_fields."""
+        obj = self._add_object(name, parent_id, storage_id, filetype, size, data)
+        obj.track = dict((k, metadata.get(k)) for k in track_fields)
+        for k in metadata :
+            if k not in track_fields :
+                raise TypeError("unrecognized track field “%s”" % k)
+            #end if
+        #end for
+        return obj.item_id
+    #end add_track
+
+    def add_playlist(self, name, tracks = (), parent_id = 0, storage_id = 0) :
+        """adds an abstract playlist with the specified track IDs, returning its ID."""
+        obj = self._add_object(name, parent_id, storage_id, mtpy.FILETYPE_PLAYLIST)
+        obj.tracks = list(tracks)
+        return obj.item_id
+    #end add_playlist
+
+    def add_album(self, name, tracks = (), parent_id = 0, storage_id = 0, artist = None, composer = None, genre = None) :
+        """adds an abstract album with the specified track IDs, returning its ID."""
+        obj = self._add_object(name, parent_id, storage_id, mtpy.FILETYPE_ALBUM)
+        obj.tracks = list(tracks)
+        obj.props["album"] = {"artist" : artist, "composer" : composer, "genre" : genre}
+        return obj.item_id
+    #end add_album
+
+    def populate \
+      (
+        self,
+        nr_files = 0,
+        nr_folders = 0,
+        file_size = 4096,
+        nr_tracks = 0,
+        nr_artists = 10,
+        nr_albums = 0,
+        nr_playlists = 0,
+        storage_id = 0
+      ) :
+        """fills the device with a synthetic collection of content: nr_folders
+        folders at the root level, named folder000000 and so on, with nr_files
+        files of file_size bytes distributed evenly among them (or at the root
+        level if there are no folders). Tracks go in a root-level Music folder,
+        spread across nr_artists artists, and can be grouped into nr_albums
+        albums and nr_playlists playlists."""
+        folders = []
+        for i in range(nr_folders) :
+            folders.append(self.add_folder("folder%06d" % i, 0, storage_id))
+        #end for
+        for i in range(nr_files) :
+            if len(folders) != 0 :
+                parent_id = folders[i % len(folders)]
+            else :
+                parent_id = 0
+            #end if
+            self.add_file("file%06d.bin" % i, parent_id, file_size, storage_id = storage_id)
+        #end for
+        if nr_tracks != 0 :
+            music = self.add_folder("Music", 0, storage_id)
+            tracks = []
+            for i in range(nr_tracks) :
+                tracks.append \
+                  (
+                    self.add_track
+                      (
+                        "track%06d.mp3" % i,
+                        music,
+                        file_size,
+                        storage_id = storage_id,
+                        title = "Track %d" % i,
+                        artist = "Artist %d" % (i % nr_artists),
+                        album = "Album %d" % (i % max(nr_albums, 1)),
+                        genre = "Genre %d" % (i % 5),
+                        tracknumber = i // max(nr_albums, 1) + 1,
+                        duration = 180000,
+                      )
+                  )
+            #end for
+            for i in range(nr_albums) :
+                self.add_album("Album %d" % i, tracks[i::nr_albums], music, storage_id)
+            #end for
+            for i in range(nr_playlists) :
+                self.add_playlist("Playlist %d" % i, tracks[i::nr_playlists], music, storage_id)
+            #end for
+        #end if
+    #end populate
+
+    def fail_next(self, funcname, count = 1, code = mtpy.ERROR_USB_LAYER, text = "simulated failure") :
+        """makes the next count calls to the named libmtp function (e.g.
+        "LIBMTP_Get_File_To_File_Descriptor") fail with the specified error.
+        Has no effect on the functions in host_side."""
+        self.failures[funcname] = [count, (code, text)]
+    #end fail_next
+
+    def _check_failure(self, funcname) :
+        # returns the (code, text) error that a call to the specified function
+        # should fail with, or None if it should be carried out.
+        if not self.connected :
+            result = (mtpy.ERROR_USB_LAYER, "simulated device disconnected")
+        else :
+            failure = self.failures.get(funcname)
+            if failure != None :
+                failure[0] -= 1
+                if failure[0] <= 0 :
+                    del self.failures[funcname]
+                #end if
+                result = failure[1]
+            else :
+                result = None
+            #end if
+        #end if
+        return result
+    #end _check_failure
+
+    def fail(self, code, text) :
+        # records an error on the error stack and returns the usual
+        # failure status.
+        self.errors.append((code, text))
+        return -1
+    #end fail
+
+    def _delay(self, nr_objects = 0, nr_bytes = 0) :
+        # simulates the time taken to return objects or transfer data.
+        delay = nr_objects * self.object_latency
+        if self.bandwidth != None :
+            delay += nr_bytes / self.bandwidth
+        #end if
+        if delay != 0 :
+            time.sleep(delay)
+        #end if
+    #end _delay
+
+    def _descendants(self, parent_id) :
+        # generates the IDs of all descendants of the specified object,
+        # parents before their children.
+        for child_id in self.children.get(parent_id, ()) :
+            yield child_id
+            yield from self._descendants(child_id)
+        #end for
+    #end _descendants
+
+    def _check_space(self, storage, nr_bytes, nr_objects = 1) :
+        return \
+            (
+                storage.used_bytes + nr_bytes <= storage.capacity
+            and
+                storage.nr_objects + nr_objects <= storage.max_objects
+            )
+    #end _check_space
+
+    def _remove_object(self, obj) :
+        del self.objects[obj.item_id]
+        del self.children[obj.parent_id][obj.item_id]
+        self.children.pop(obj.item_id, None)
+        storage = self.get_storage(obj.storage_id)
+        storage.used_bytes -= obj.size
+        storage.nr_objects -= 1
+        for other in self.objects.values() :
+            if other.tracks != None and obj.item_id in other.tracks :
+                other.tracks = list(t for t in other.tracks if t != obj.item_id)
+            #end if
+        #end for
+    #end _remove_object
+
+    def _get_object(self, item_id) :
+        # returns the SimulatedObject with the specified ID, or records an
+        # error and returns None.
+        result = self.objects.get(item_id)
+        if result == None :
+            self.errors.append((mtpy.ERROR_GENERAL, "no object with ID %d" % item_id))
+        #end if
+        return result
+    #end _get_object
+
+    def _read_to(self, obj, put, progress, data) :
+        # common code for the file-retrieval functions, passing successive
+        # chunks of the contents of obj to put, which returns False to abort.
+        status = 0
+        offset = 0
+        while True :
+            if bool(progress) and progress(offset, obj.size, data) != 0 :
+                status = self.fail(mtpy.ERROR_CANCELLED, "transfer cancelled")
+                break
+            #end if
+            if offset == obj.size :
+                break
+            chunk = obj.read(offset, self.chunk_size)
+            self._delay(nr_bytes = len(chunk))
+            if not put(chunk) :
+                status = self.fail(mtpy.ERROR_GENERAL, "error writing retrieved data")
+                break
+            #end if
+            offset += len(chunk)
+        #end while
+        return status
+    #end _read_to
+
+    def _receive(self, src, parent_id, storage_id, name, filetype, progress, data) :
+        # common code for the upload functions, returning the new
+        # SimulatedObject, or None on failure.
+        if parent_id not in (0, mtpy.FILES_AND_FOLDERS_ROOT) and parent_id not in self.objects :
+            self.fail(mtpy.ERROR_GENERAL, "no parent folder with ID %d" % parent_id)
+            return None
+        #end if
+        storage = self.get_storage(storage_id)
+        if storage == None :
+            self.fail(mtpy.ERROR_GENERAL, "no storage with ID %d" % storage_id)
+            return None
+        #end if
+        with open(src, "rb") as infile :
+            contents = infile.read()
+        #end with
+        if not self._check_space(storage, len(contents)) :
+            self.fail(mtpy.ERROR_STORAGE_FULL, "storage full")
+            return None
+        #end if
+        offset = 0
+        while True :
+            if bool(progress) and progress(offset, len(contents), data) != 0 :
+                self.fail(mtpy.ERROR_CANCELLED, "transfer cancelled")
+                return None
+            #end if
+            if offset == len(contents) :
+                break
+            count = min(self.chunk_size, len(contents) - offset)
+            self._delay(nr_bytes = count)
+            offset += count
+        #end while
+        return self._add_object(name, parent_id, storage.storage_id, filetype, data = contents)
+    #end _receive
+
+    def _file_t(self, obj) :
+        # returns a newly-allocated file_t describing obj.
+        result = alloc(mtpy.file_t)
+        item = result.contents
+        item.item_id = obj.item_id
+        item.parent_id = obj.parent_id
+        item.storage_id = obj.storage_id
+        item.name = new_string(obj.name)
+        item.filesize = obj.size
+        item.modificationdate = obj.mtime
+        item.filetype = obj.filetype
+        return result
+    #end _file_t
+
+    def _folder_t(self, parent_id) :
+        # returns a newly-allocated tree of folder_t describing the folders
+        # under the specified parent.
+        result = None
+        for child_id in reversed(list(self.children.get(parent_id, ()))) :
+            obj = self.objects[child_id]
+            if obj.filetype == mtpy.FILETYPE_FOLDER :
+                folder = alloc(mtpy.folder_t)
+                folder.contents.item_id = obj.item_id
+                folder.contents.parent_id = obj.parent_id
+                folder.contents.storage_id = obj.storage_id
+                folder.contents.name = new_string(obj.name)
+                folder.contents.child = self._folder_t(child_id)
+                if result != None :
+                    folder.contents.sibling = result
+                #end if
+                result = folder
+            #end if
+        #end for
+        return result
+    #end _folder_t
+
+    def _track_t(self, obj) :
+        # returns a newly-allocated track_t describing obj.
+        result = alloc(mtpy.track_t)
+        track = result.contents
+        track.item_id = obj.item_id
+        track.parent_id = obj.parent_id
+        track.storage_id = obj.storage_id
+        track.filename = new_string(obj.name)
+        track.filesize = obj.size
+        track.modificationdate = obj.mtime
+        track.filetype = obj.filetype
+        for k in track_fields :
+            value = obj.track[k]
+            if value != None :
+                if isinstance(value, str) :
+                    value = new_string(value)
+                #end if
+                setattr(track, k, value)
+            #end if
+        #end for
+        return result
+    #end _track_t
+
+    def _track_list_t(self, obj, structtype) :
+        # returns a newly-allocated playlist_t or album_t describing obj.
+        result = alloc(structtype)
+        item = result.contents
+        if structtype == mtpy.album_t :
+            item.album_id = obj.item_id
+            for k in album_fields :
+                item_value = obj.props["album"][k]
+                if item_value != None :
+                    setattr(item, k, new_string(item_value))
+                #end if
+            #end for
+        else :
+            item.playlist_id = obj.item_id
+        #end if
+        item.parent_id = obj.parent_id
+        item.storage_id = obj.storage_id
+        item.name = new_string(obj.name)
+        item.no_tracks = len(obj.tracks)
+        if len(obj.tracks) != 0 :
+            item.tracks = ct.cast(libc.malloc(len(obj.tracks) * ct.sizeof(ct.c_uint32)), ct.POINTER(ct.c_uint32))
+            for i in range(len(obj.tracks)) :
+                item.tracks[i] = obj.tracks[i]
+            #end for
+        #end if
+        return result
+    #end _track_list_t
+
+    def _track_lists(self, filetype, structtype) :
+        items = list(obj for obj in self.objects.values() if obj.filetype == filetype)
+        self._delay(nr_objects = len(items))
+        return make_list(list(self._track_list_t(obj, structtype) for obj in items))
+    #end _track_lists
+
+    def _create_track_list(self, item, filetype) :
+        # common code for Create_New_Playlist and Create_New_Album.
+        if item.parent_id not in (0, mtpy.FILES_AND_FOLDERS_ROOT) and item.parent_id not in self.objects :
+            return self.fail(mtpy.ERROR_GENERAL, "no parent folder with ID %d" % item.parent_id)
+        #end if
+        storage = self.get_storage(item.storage_id)
+        if storage == None :
+            return self.fail(mtpy.ERROR_GENERAL, "no storage with ID %d" % item.storage_id)
+        #end if
+        obj = self._add_object(decode_string(item.name), item.parent_id, storage.storage_id, filetype)
+        obj.tracks = list(item.tracks[i] for i in range(item.no_tracks))
+        item.parent_id = obj.parent_id
+        item.storage_id = obj.storage_id
+        return obj
+    #end _create_track_list
+
+    def _update_track_list(self, item, item_id, filetype) :
+        # common code for Update_Playlist and Update_Album.
+        obj = self._get_object(item_id)
+        if obj == None or obj.filetype != filetype :
+            return None
+        #end if
+        obj.name = decode_string(item.name)
+        obj.tracks = list(item.tracks[i] for i in range(item.no_tracks))
+        return obj
+    #end _update_track_list
+
+    def _set_struct_name(self, struct, fieldname, newname) :
+        # replaces a string field in a libmtp-allocated struct, as libmtp does
+        # when renaming objects.
+        old = field_address(struct, fieldname)
+        setattr(struct, fieldname, new_string(newname))
+        if old != None :
+            self.lib.free(old)
+        #end if
+    #end _set_struct_name
+
+    def _free_storage(self, handle) :
+        storage = handle.contents.storage
+        while bool(storage) :
+            next = ct.cast(storage.contents.next, ct.c_void_p).value
+            self.lib.free(ct.cast(storage, ct.c_void_p).value)
+            storage = ct.cast(next, ct.POINTER(mtpy.devicestorage_t))
+        #end while
+        handle.contents.storage = ct.POINTER(mtpy.devicestorage_t)()
+    #end _free_storage
+
+    # implementations of libmtp functions taking a device handle
+
+    def Release_Device(self, handle) :
+        self._free_storage(handle)
+        self.Clear_Errorstack(handle)
+        del self.lib.devices_by_handle[ct.addressof(handle.contents)]
+        self.lib.free(ct.addressof(handle.contents))
+    #end Release_Device
+
+    def Get_Errorstack(self, handle) :
+        entries = []
+        for code, text in self.errors :
+            entry = alloc(mtpy.error_t)
+            entry.contents.errornumber = code
+            entry.contents.error_text = new_string(text)
+            entries.append(entry)
+            self.errorstack_allocs.append(entry)
+        #end for
+        return make_list(entries)
+    #end Get_Errorstack
+
+    def Clear_Errorstack(self, handle) :
+        for entry in self.errorstack_allocs :
+            self.lib.free(field_address(entry.contents, "error_text"))
+            self.lib.free(ct.addressof(entry.contents))
+        #end for
+        self.errorstack_allocs = []
+        self.errors = []
+    #end Clear_Errorstack
+
+    def Dump_Errorstack(self, handle) :
+        for code, text in self.errors :
+            sys.stderr.write("Error %d: %s\n" % (code, text))
+        #end for
+    #end Dump_Errorstack
+
+    def Get_Storage(self, handle, sortby) :
+        self.get_storage(0) # ensure there is at least one
+        storage = list(self.storage)
+        if sortby == mtpy.STORAGE_SORTBY_FREESPACE :
+            storage.sort(key = lambda s : s.capacity - s.used_bytes, reverse = True)
+        elif sortby == mtpy.STORAGE_SORTBY_MAXSPACE :
+            storage.sort(key = lambda s : s.capacity, reverse = True)
+        #end if
+        entries = []
+        for s in storage :
+            entry = alloc(mtpy.devicestorage_t)
+            entry.contents.id = s.storage_id
+            entry.contents.StorageType = 3 # fixed RAM
+            entry.contents.FilesystemType = 2 # generic hierarchical
+            entry.contents.AccessCapability = 0 # read-write
+            entry.contents.MaxCapacity = s.capacity
+            entry.contents.FreeSpaceInBytes = s.capacity - s.used_bytes
+            entry.contents.FreeSpaceInObjects = s.max_objects - s.nr_objects
+            entry.contents.StorageDescription = s.description_addr
+            entry.contents.VolumeIdentifier = s.volume_identifier_addr
+            if len(entries) != 0 :
+                entry.contents.prev = entries[-1]
+            #end if
+            entries.append(entry)
+        #end for
+        self._free_storage(handle)
+        handle.contents.storage = make_list(entries)
+        return 0
+    #end Get_Storage
+
+    def Get_Manufacturername(self, handle) :
+        return self.manufacturer_name
+    #end Get_Manufacturername
+
+    def Get_Modelname(self, handle) :
+        return self.model_name
+    #end Get_Modelname
+
+    def Get_Serialnumber(self, handle) :
+        return self.serial_number
+    #end Get_Serialnumber
+
+    def Get_Deviceversion(self, handle) :
+        return self.device_version
+    #end Get_Deviceversion
+
+    def Get_Friendlyname(self, handle) :
+        return self.friendly_name
+    #end Get_Friendlyname
+
+    def Set_Friendlyname(self, handle, name) :
+        self.friendly_name = decode_string(name)
+        return 0
+    #end Set_Friendlyname
+
+    def Get_Syncpartner(self, handle) :
+        return self.sync_partner
+    #end Get_Syncpartner
+
+    def Set_Syncpartner(self, handle, name) :
+        self.sync_partner = decode_string(name)
+        return 0
+    #end Set_Syncpartner
+
+    def Get_Batterylevel(self, handle, maximum_level, current_level) :
+        out_arg(maximum_level).value = self.maximum_battery_level
+        out_arg(current_level).value = self.battery_level
+        return 0
+    #end Get_Batterylevel
+
+    def Get_Secure_Time(self, handle, result) :
+        if self.secure_time == None :
+            return self.fail(mtpy.ERROR_GENERAL, "secure time not supported")
+        #end if
+        set_pointer(result, new_string(self.secure_time))
+        return 0
+    #end Get_Secure_Time
+
+    def Get_Device_Certificate(self, handle, result) :
+        if self.device_certificate == None :
+            return self.fail(mtpy.ERROR_GENERAL, "device certificate not supported")
+        #end if
+        set_pointer(result, new_string(self.device_certificate))
+        return 0
+    #end Get_Device_Certificate
+
+    def Get_Supported_Filetypes(self, handle, filetypes, nr_filetypes) :
+        types = alloc(ct.c_uint16, len(self.supported_filetypes))
+        for i in range(len(self.supported_filetypes)) :
+            types[i] = self.supported_filetypes[i]
+        #end for
+        set_pointer(filetypes, ct.cast(types, ct.c_void_p).value)
+        out_arg(nr_filetypes).value = len(self.supported_filetypes)
+        return 0
+    #end Get_Supported_Filetypes
+
+    def Is_Property_Supported(self, handle, propid, filetype) :
+        return int(propid in property_names)
+    #end Is_Property_Supported
+
+    def Get_Allowed_Property_Values(self, handle, propid, filetype, allowed) :
+        values = self.allowed_values.get((propid, filetype))
+        if values == None :
+            return self.fail(mtpy.ERROR_GENERAL, "no allowed values for property %d" % propid)
+        #end if
+        allowed = out_arg(allowed)
+        allowed.datatype = values["datatype"]
+        allowed.is_range = int(values["is_range"])
+        use_fields = mtpy.allowed_values_t.use_fields[values["datatype"]]
+        if values["is_range"] :
+            for k in ("min", "max", "step") :
+                setattr(allowed, use_fields[k], values[k])
+            #end for
+        else :
+            elttype = dict(mtpy.allowed_values_t._fields_)[use_fields["vals"]]._type_
+            vals = alloc(elttype, len(values["vals"]))
+            for i in range(len(values["vals"])) :
+                vals[i] = values["vals"][i]
+            #end for
+            setattr(allowed, use_fields["vals"], vals)
+            allowed.num_entries = len(values["vals"])
+        #end if
+        return 0
+    #end Get_Allowed_Property_Values
+
+    def Get_String_From_Object(self, handle, item_id, propid) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return None
+        #end if
+        if propid in obj.props :
+            result = obj.props[propid]
+        elif propid == mtpy.PROPERTY_ObjectFileName :
+            result = obj.name
+        elif propid == mtpy.PROPERTY_Name :
+            if obj.track != None and obj.track["title"] != None :
+                result = obj.track["title"]
+            else :
+                result = obj.name
+            #end if
+        else :
+            result = None
+        #end if
+        return result
+    #end Get_String_From_Object
+
+    def Get_u64_From_Object(self, handle, item_id, propid, default) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return default
+        #end if
+        if propid == mtpy.PROPERTY_StorageID :
+            result = obj.storage_id
+        elif propid == mtpy.PROPERTY_ObjectSize :
+            result = obj.size
+        elif propid == mtpy.PROPERTY_ParentObject :
+            result = obj.parent_id
+        else :
+            result = obj.props.get(propid, default)
+        #end if
+        return result
+    #end Get_u64_From_Object
+    Get_u32_From_Object = Get_u16_From_Object = Get_u8_From_Object = Get_u64_From_Object
+
+    def Set_Object_String(self, handle, item_id, propid, value) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+        if propid == mtpy.PROPERTY_ObjectFileName :
+            obj.name = decode_string(value)
+        elif propid == mtpy.PROPERTY_Name and obj.track != None :
+            obj.track["title"] = decode_string(value)
+        else :
+            obj.props[propid] = decode_string(value)
+        #end if
+        return 0
+    #end Set_Object_String
+
+    def Set_Object_u32(self, handle, item_id, propid, value) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+        if propid in (mtpy.PROPERTY_StorageID, mtpy.PROPERTY_ObjectSize, mtpy.PROPERTY_ParentObject) :
+            return self.fail(mtpy.ERROR_GENERAL, "property %d is read-only" % propid)
+        #end if
+        obj.props[propid] = value
+        return 0
+    #end Set_Object_u32
+    Set_Object_u16 = Set_Object_u8 = Set_Object_u32
+
+    def Get_Filelisting(self, handle) :
+        items = list(obj for obj in self.objects.values() if obj.filetype != mtpy.FILETYPE_FOLDER)
+        self._delay(nr_objects = len(items))
+        return make_list(list(self._file_t(obj) for obj in items))
+    #end Get_Filelisting
+
+    def Get_Files_And_Folders(self, handle, storage_id, parent_id) :
+        if parent_id == 0 :
+            items = list(self.objects.values())
+        else :
+            if parent_id == mtpy.FILES_AND_FOLDERS_ROOT :
+                parent_id = 0
+            #end if
+            items = list(self.objects[i] for i in self.children.get(parent_id, ()))
+        #end if
+        items = list \
+          (
+            obj for obj in items
+            if
+                    (storage_id == 0 or obj.storage_id == storage_id)
+                and
+                    obj.filetype not in (mtpy.FILETYPE_PLAYLIST, mtpy.FILETYPE_ALBUM)
+          )
+        self._delay(nr_objects = len(items))
+        return make_list(list(self._file_t(obj) for obj in items))
+    #end Get_Files_And_Folders
+
+    def Get_Filemetadata(self, handle, item_id) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return None
+        #end if
+        self._delay(nr_objects = 1)
+        return self._file_t(obj)
+    #end Get_Filemetadata
+
+    def Get_File_To_File_Descriptor(self, handle, item_id, fd, progress, data) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+
+        def put(chunk) :
+            try :
+                os.write(fd, chunk)
+                result = True
+            except OSError :
+                result = False
+            #end try
+            return result
+        #end put
+
+    #begin Get_File_To_File_Descriptor
+        return self._read_to(obj, put, progress, data)
+    #end Get_File_To_File_Descriptor
+
+    def Get_File_To_Handler(self, handle, item_id, put_func, priv, progress, data) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+
+        def put(chunk) :
+            buf = ct.create_string_buffer(chunk, len(chunk))
+            putlen = ct.c_uint32(0)
+            status = put_func(None, priv, len(chunk), ct.cast(buf, ct.POINTER(ct.c_ubyte)), ct.byref(putlen))
+            return status == mtpy.HANDLER_RETURN_OK and putlen.value == len(chunk)
+        #end put
+
+    #begin Get_File_To_Handler
+        return self._read_to(obj, put, progress, data)
+    #end Get_File_To_Handler
+
+    def GetPartialObject(self, handle, item_id, offset, maxbytes, result, resultlen) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+        chunk = obj.read(offset, maxbytes)
+        self._delay(nr_bytes = len(chunk))
+        buf = libc.malloc(max(len(chunk), 1))
+        ct.memmove(buf, chunk, len(chunk))
+        set_pointer(result, buf)
+        out_arg(resultlen).value = len(chunk)
+        return 0
+    #end GetPartialObject
+
+    def Send_File_From_File(self, handle, src, filedesc, progress, data) :
+        item = filedesc.contents
+        obj = self._receive \
+          (
+            src,
+            item.parent_id,
+            item.storage_id,
+            decode_string(item.name),
+            item.filetype,
+            progress,
+            data
+          )
+        if obj == None :
+            return -1
+        #end if
+        item.item_id = obj.item_id
+        item.parent_id = obj.parent_id
+        item.storage_id = obj.storage_id
+        return 0
+    #end Send_File_From_File
+
+    def Set_File_Name(self, handle, filedesc, newname) :
+        obj = self._get_object(filedesc.contents.item_id)
+        if obj == None :
+            return -1
+        #end if
+        obj.name = decode_string(newname)
+        self._set_struct_name(filedesc.contents, "name", newname)
+        return 0
+    #end Set_File_Name
+
+    def Get_Folder_List(self, handle) :
+        result = self._folder_t(0)
+        self._delay(nr_objects = sum(1 for obj in self.objects.values() if obj.filetype == mtpy.FILETYPE_FOLDER))
+        return result
+    #end Get_Folder_List
+
+    def Create_Folder(self, handle, name, parent_id, storage_id) :
+        if parent_id not in (0, mtpy.FILES_AND_FOLDERS_ROOT) and parent_id not in self.objects :
+            self.fail(mtpy.ERROR_GENERAL, "no parent folder with ID %d" % parent_id)
+            return 0
+        #end if
+        storage = self.get_storage(storage_id)
+        if storage == None or not self._check_space(storage, 0) :
+            self.fail(mtpy.ERROR_STORAGE_FULL, "cannot create folder")
+            return 0
+        #end if
+        return self._add_object(decode_string(name), parent_id, storage.storage_id, mtpy.FILETYPE_FOLDER).item_id
+    #end Create_Folder
+
+    def Set_Folder_Name(self, handle, folderdesc, newname) :
+        obj = self._get_object(folderdesc.contents.item_id)
+        if obj == None :
+            return -1
+        #end if
+        obj.name = decode_string(newname)
+        self._set_struct_name(folderdesc.contents, "name", newname)
+        return 0
+    #end Set_Folder_Name
+
+    def Delete_Object(self, handle, item_id) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+        if len(self.children.get(item_id, ())) != 0 :
+            return self.fail(mtpy.ERROR_GENERAL, "folder not empty")
+        #end if
+        self._remove_object(obj)
+        return 0
+    #end Delete_Object
+
+    def Move_Object(self, handle, item_id, storage_id, parent_id) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+        if parent_id == mtpy.FILES_AND_FOLDERS_ROOT :
+            parent_id = 0
+        #end if
+        if parent_id != 0 and parent_id not in self.objects :
+            return self.fail(mtpy.ERROR_GENERAL, "no parent folder with ID %d" % parent_id)
+        #end if
+        if parent_id == item_id or parent_id in self._descendants(item_id) :
+            return self.fail(mtpy.ERROR_GENERAL, "cannot move folder into itself")
+        #end if
+        if storage_id != 0 and storage_id != obj.storage_id :
+            new_storage = self.get_storage(storage_id)
+            if new_storage == None :
+                return self.fail(mtpy.ERROR_GENERAL, "no storage with ID %d" % storage_id)
+            #end if
+            moving = [obj] + list(self.objects[i] for i in self._descendants(item_id))
+            size = sum(o.size for o in moving)
+            if not self._check_space(new_storage, size, len(moving)) :
+                return self.fail(mtpy.ERROR_STORAGE_FULL, "storage full")
+            #end if
+            old_storage = self.get_storage(obj.storage_id)
+            for o in moving :
+                o.storage_id = new_storage.storage_id
+            #end for
+            old_storage.used_bytes -= size
+            old_storage.nr_objects -= len(moving)
+            new_storage.used_bytes += size
+            new_storage.nr_objects += len(moving)
+            self._delay(nr_bytes = size)
+        #end if
+        del self.children[obj.parent_id][item_id]
+        obj.parent_id = parent_id
+        self.children.setdefault(parent_id, {})[item_id] = None
+        return 0
+    #end Move_Object
+
+    def Copy_Object(self, handle, item_id, storage_id, parent_id) :
+        obj = self._get_object(item_id)
+        if obj == None :
+            return -1
+        #end if
+        if parent_id != 0 and parent_id != mtpy.FILES_AND_FOLDERS_ROOT and parent_id not in self.objects :
+            return self.fail(mtpy.ERROR_GENERAL, "no parent folder with ID %d" % parent_id)
+        #end if
+        if storage_id == 0 :
+            storage_id = obj.storage_id
+        #end if
+        storage = self.get_storage(storage_id)
+        if storage == None :
+            return self.fail(mtpy.ERROR_GENERAL, "no storage with ID %d" % storage_id)
+        #end if
+        copying = [obj] + list(self.objects[i] for i in self._descendants(item_id))
+        size = sum(o.size for o in copying)
+        if not self._check_space(storage, size, len(copying)) :
+            return self.fail(mtpy.ERROR_STORAGE_FULL, "storage full")
+        #end if
+        new_ids = {obj.parent_id : parent_id}
+        for o in copying :
+            new = self._add_object(o.name, new_ids[o.parent_id], storage_id, o.filetype, o.size, o.data)
+            if o.track != None :
+                new.track = dict(o.track)
+            #end if
+            new.props = dict(o.props)
+            new_ids[o.item_id] = new.item_id
+        #end for
+        self._delay(nr_bytes = size)
+        return 0
+    #end Copy_Object
+
+    def Get_Tracklisting_With_Callback(self, handle, progress, data) :
+        items = list(obj for obj in self.objects.values() if obj.track != None)
+        entries = []
+        for obj in items :
+            if bool(progress) :
+                progress(len(entries), len(items), data)
+            #end if
+            entries.append(self._track_t(obj))
+        #end for
+        self._delay(nr_objects = len(items))
+        return make_list(entries)
+    #end Get_Tracklisting_With_Callback
+
+    def Get_Trackmetadata(self, handle, item_id) :
+        obj = self._get_object(item_id)
+        if obj == None or obj.track == None :
+            return None
+        #end if
+        self._delay(nr_objects = 1)
+        return self._track_t(obj)
+    #end Get_Trackmetadata
+
+    def Send_Track_From_File(self, handle, src, trackdesc, progress, data) :
+        track = trackdesc.contents
+        obj = self._receive \
+          (
+            src,
+            track.parent_id,
+            track.storage_id,
+            decode_string(track.filename),
+            track.filetype,
+            progress,
+            data
+          )
+        if obj == None :
+            return -1
+        #end if
+        obj.track = {}
+        for k in track_fields :
+            value = getattr(track, k)
+            if isinstance(value, bytes) :
+                value = decode_string(value)
+            #end if
+            obj.track[k] = value
+        #end for
+        track.item_id = obj.item_id
+        track.parent_id = obj.parent_id
+        track.storage_id = obj.storage_id
+        return 0
+    #end Send_Track_From_File
+
+    def Set_Track_Name(self, handle, trackdesc, newname) :
+        obj = self._get_object(trackdesc.contents.item_id)
+        if obj == None or obj.track == None :
+            return -1
+        #end if
+        obj.track["title"] = decode_string(newname)
+        self._set_struct_name(trackdesc.contents, "title", newname)
+        return 0
+    #end Set_Track_Name
+
+    def Get_Playlist_List(self, handle) :
+        return self._track_lists(mtpy.FILETYPE_PLAYLIST, mtpy.playlist_t)
+    #end Get_Playlist_List
+
+    def Get_Playlist(self, handle, item_id) :
+        obj = self._get_object(item_id)
+        if obj == None or obj.filetype != mtpy.FILETYPE_PLAYLIST :
+            return None
+        #end if
+        return self._track_list_t(obj, mtpy.playlist_t)
+    #end Get_Playlist
+
+    def Create_New_Playlist(self, handle, playlistdesc) :
+        item = playlistdesc.contents
+        obj = self._create_track_list(item, mtpy.FILETYPE_PLAYLIST)
+        if obj == -1 :
+            return -1
+        #end if
+        item.playlist_id = obj.item_id
+        return 0
+    #end Create_New_Playlist
+
+    def Update_Playlist(self, handle, playlistdesc) :
+        item = playlistdesc.contents
+        if self._update_track_list(item, item.playlist_id, mtpy.FILETYPE_PLAYLIST) == None :
+            return -1
+        #end if
+        return 0
+    #end Update_Playlist
+
+    def Get_Album_List(self, handle) :
+        return self._track_lists(mtpy.FILETYPE_ALBUM, mtpy.album_t)
+    #end Get_Album_List
+
+    def Get_Album(self, handle, item_id) :
+        obj = self._get_object(item_id)
+        if obj == None or obj.filetype != mtpy.FILETYPE_ALBUM :
+            return None
+        #end if
+        return self._track_list_t(obj, mtpy.album_t)
+    #end Get_Album
+
+    def Create_New_Album(self, handle, albumdesc) :
+        item = albumdesc.contents
+        obj = self._create_track_list(item, mtpy.FILETYPE_ALBUM)
+        if obj == -1 :
+            return -1
+        #end if
+        obj.props["album"] = dict((k, decode_string(getattr(item, k))) for k in album_fields)
+        item.album_id = obj.item_id
+        return 0
+    #end Create_New_Album
+
+    def Update_Album(self, handle, albumdesc) :
+        item = albumdesc.contents
+        obj = self._update_track_list(item, item.album_id, mtpy.FILETYPE_ALBUM)
+        if obj == None :
+            return -1
+        #end if
+        obj.props["album"] = dict((k, decode_string(getattr(item, k))) for k in album_fields)
+        return 0
+    #end Update_Album
+
+#end SimulatedDevice
+
+class SimulatedLibrary :
+    """a backend for mtpy which simulates libmtp and the devices attached to
+    the system, entirely in Python. Add devices with add_device, then pass
+    this object to mtpy.get_raw_devices. calls counts the calls made to
+    each libmtp function, keyed by name. If free_memory is False, memory
+    that libmtp would free is leaked instead, which can help in tracking
+    down use-after-free errors."""
+
+    def __init__(self, free_memory = True) :
+        self.free_memory = free_memory
+        self.devices = []
+        self.devices_by_handle = {}
+        self.calls = {}
+        for name, restype, argtypes in mtpy.libmtp_prototypes :
+            setattr(self, name, SimulatedFunction(self, name, restype, argtypes))
+        #end for
+    #end __init__
+
+    def __repr__(self) :
+        return "<SimulatedLibrary, %d devices>" % len(self.devices)
+    #end __repr__
+
+    def add_device(self, serial_number = None, latency = 0, object_latency = 0, bandwidth = None) :
+        """adds a new simulated device attached to the system, returning the
+        SimulatedDevice. latency is the time in seconds taken by every call to
+        the device, object_latency the additional time per object returned in
+        listings, and bandwidth (if not None) the transfer rate in bytes per
+        second."""
+        devnum = len(self.devices) + 1
+        if serial_number == None :
+            serial_number = "SIM%08d" % devnum
+        #end if
+        result = SimulatedDevice(self, 1, devnum, serial_number, latency, object_latency, bandwidth)
+        self.devices.append(result)
+        return result
+    #end add_device
+
+    def free(self, address) :
+        # frees memory that libmtp would free, unless I'm keeping it around.
+        if self.free_memory and address != None :
+            libc.free(address)
+        #end if
+    #end free
+
+    def _free_string_fields(self, struct, fieldnames) :
+        for fieldname in fieldnames :
+            self.free(field_address(struct, fieldname))
+        #end for
+    #end _free_string_fields
+
+    def _find_device(self, bus_location, devnum) :
+        result = None
+        for simdev in self.devices :
+            if simdev.connected and (simdev.bus_location, simdev.devnum) == (bus_location, devnum) :
+                result = simdev
+                break
+            #end if
+        #end for
+        return result
+    #end _find_device
+
+    # implementations of libmtp functions not taking a device handle
+
+    def Init(self) :
+        pass
+    #end Init
+
+    def Detect_Raw_Devices(self, devices, nr_devices) :
+        attached = list(simdev for simdev in self.devices if simdev.connected)
+        if len(attached) == 0 :
+            set_pointer(devices, None)
+            out_arg(nr_devices).value = 0
+            return mtpy.ERROR_NO_DEVICE_ATTACHED
+        #end if
+        result = alloc(mtpy.raw_device_t, len(attached))
+        for i in range(len(attached)) :
+            simdev = attached[i]
+            result[i].device_entry.vendor = simdev.vendor_addr
+            result[i].device_entry.product = simdev.product_addr
+            result[i].bus_location = simdev.bus_location
+            result[i].devnum = simdev.devnum
+        #end for
+        set_pointer(devices, ct.cast(result, ct.c_void_p).value)
+        out_arg(nr_devices).value = len(attached)
+        return 0
+    #end Detect_Raw_Devices
+
+    def Check_Specific_Device(self, bus_location, devnum) :
+        return int(self._find_device(bus_location, devnum) != None)
+    #end Check_Specific_Device
+
+    def Open_Raw_Device_Uncached(self, rawdevice) :
+        rawdevice = out_arg(rawdevice)
+        simdev = self._find_device(rawdevice.bus_location, rawdevice.devnum)
+        if simdev == None :
+            return None
+        #end if
+        if simdev.latency != 0 :
+            time.sleep(simdev.latency)
+        #end if
+        result = alloc(mtpy.mtpdevice_t)
+        result.contents.object_bitsize = 32
+        result.contents.maximum_battery_level = simdev.maximum_battery_level
+        self.devices_by_handle[ct.addressof(result.contents)] = simdev
+        simdev.Get_Storage(result, mtpy.STORAGE_SORTBY_NOTSORTED)
+        return result
+    #end Open_Raw_Device_Uncached
+    Open_Raw_Device = Open_Raw_Device_Uncached
+
+    def Get_Filetype_Description(self, filetype) :
+        return filetype_names.get(filetype, "Unknown filetype")
+    #end Get_Filetype_Description
+
+    def Get_Property_Description(self, propid) :
+        return property_names.get(propid, "Unknown property")
+    #end Get_Property_Description
+
+    def destroy_allowed_values_t(self, allowed) :
+        allowed = out_arg(allowed)
+        for name, fieldtype in mtpy.allowed_values_t._fields_ :
+            if name.endswith("vals") :
+                self.free(field_address(allowed, name))
+                setattr(allowed, name, fieldtype())
+            #end if
+        #end for
+    #end destroy_allowed_values_t
+
+    def new_file_t(self) :
+        result = alloc(mtpy.file_t)
+        result.contents.filetype = mtpy.FILETYPE_UNKNOWN
+        return result
+    #end new_file_t
+
+    def destroy_file_t(self, item) :
+        if bool(item) :
+            self._free_string_fields(item.contents, ("name",))
+            self.free(ct.addressof(item.contents))
+        #end if
+    #end destroy_file_t
+
+    def new_folder_t(self) :
+        return alloc(mtpy.folder_t)
+    #end new_folder_t
+
+    def destroy_folder_t(self, item) :
+        if bool(item) :
+            self.destroy_folder_t(item.contents.child)
+            self.destroy_folder_t(item.contents.sibling)
+            self._free_string_fields(item.contents, ("name",))
+            self.free(ct.addressof(item.contents))
+        #end if
+    #end destroy_folder_t
+
+    def new_track_t(self) :
+        result = alloc(mtpy.track_t)
+        result.contents.filetype = mtpy.FILETYPE_UNKNOWN
+        return result
+    #end new_track_t
+
+    def destroy_track_t(self, item) :
+        if bool(item) :
+            self._free_string_fields \
+              (
+                item.contents,
+                ("title", "artist", "composer", "genre", "album", "date", "filename")
+              )
+            self.free(ct.addressof(item.contents))
+        #end if
+    #end destroy_track_t
+
+    def new_playlist_t(self) :
+        return alloc(mtpy.playlist_t)
+    #end new_playlist_t
+
+    def destroy_playlist_t(self, item) :
+        if bool(item) :
+            self._free_string_fields(item.contents, ("name", "tracks"))
+            self.free(ct.addressof(item.contents))
+        #end if
+    #end destroy_playlist_t
+
+    def new_album_t(self) :
+        return alloc(mtpy.album_t)
+    #end new_album_t
+
+    def destroy_album_t(self, item) :
+        if bool(item) :
+            self._free_string_fields(item.contents, ("name", "artist", "composer", "genre", "tracks"))
+            self.free(ct.addressof(item.contents))
+        #end if
+    #end destroy_album_t
+
+#end SimulatedLibrary
@@ -17,5 +17,5 @@ distutils.core.setup \
     author = "Lawrence D'Oliveiro",
     author_email = "ldo@geek-central.gen.nz",
     url = "https://github.com/ldo/mtpy",
-    py_modules = ["mtpy"],
+    py_modules = ["mtpy", "mtpyfs", "mtpysim"],
   )